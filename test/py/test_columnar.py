@@ -0,0 +1,149 @@
+'''
+
+Note: to see DEBUG log even if the tests pass do:
+
+py.test test/py/test_columnar.py --tc=debug:y --nologcapture
+
+'''
+
+import pytest
+
+from versa.driver import columnar, memory
+from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def engine(request, monkeypatch):
+    '''Run each test with vectorized matching, and with the plain Python fallback'''
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(columnar, 'numpy', None)
+    return request.param
+
+
+def test_basics(engine):
+    model = columnar.connection()
+    model.add_many(RELS_1)
+    assert model.size() == 5
+
+    results = list(model.match(origin='http://copia.ogbuji.net'))
+    assert len(results) == 2
+
+    results = tuple(model.match(origin='http://uche.ogbuji.net', attrs={u'@lang': u'ig'}))
+    expected = (('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Ulo Uche', {'@context': 'http://uche.ogbuji.net#_metadata', '@lang': 'ig'}),)
+    assert results == expected, (results, expected)
+
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/creator', target='Uche Ogbuji', include_ids=True))
+    assert [ix for ix, link in results] == [0, 2]
+
+    assert list(model.match(origin='SPAM')) == []
+    assert list(model.match(origin='http://copia.ogbuji.net', target='Ulo Uche')) == []
+
+    results = list(model.multimatch(origin={'http://copia.ogbuji.net', 'http://uche.ogbuji.net'}, target={'Copia', 'Ulo Uche'}))
+    assert [link[TARGET] for link in results] == ['Copia', 'Ulo Uche']
+
+    results = list(model.match(attrs={'@lang': 'en'}, include_ids=True))
+    assert [ix for ix, link in results] == [1, 3]
+    model.remove(1)
+    results = list(model.match(attrs={'@lang': 'en'}, include_ids=True))
+    assert [ix for ix, link in results] == [3]
+    assert list(model.match(attrs={'@lang': 'fr'})) == []
+    assert model.count(attrs={'@lang': 'en'}) == 1
+    assert model.count(rel='http://purl.org/dc/elements/1.1/title') == 2
+    assert model.count() == 4
+
+
+def test_same_as_memory(engine):
+    model = columnar.connection()
+    mmodel = memory.connection()
+    for m in (model, mmodel):
+        m.add_many(RELS_1)
+        m.add('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/relation', I('http://copia.ogbuji.net'), {})
+        m.add('s1', 'p0', 'lit0', {}, index=1)
+        m.remove([0, 3])
+    assert list(model) == list(mmodel)
+    assert model == mmodel
+
+    #IRI references stay distinct from strings with the same characters
+    link = next(model.match(target='http://copia.ogbuji.net'))
+    assert isinstance(link[TARGET], I)
+    assert not isinstance(link[ORIGIN], I)
+
+    #Yielded attributes are read-only
+    with pytest.raises(TypeError):
+        link[ATTRIBUTES]['spam'] = 'eggs'
+
+
+def test_copy(engine):
+    model = columnar.connection()
+    model.add_many(RELS_1)
+    model2 = model.copy()
+    assert model == model2
+    snap = model.snapshot()
+    model2.add('s1', 'p0', 'lit0', {})
+    model.remove(0)
+    assert model.size() == 4
+    assert model2.size() == 6
+    assert snap.size() == 5
+    assert list(snap.match(origin='s1')) == []
+    assert len(list(snap.match(rel='http://purl.org/dc/elements/1.1/creator'))) == 2
+    with pytest.raises(TypeError):
+        snap.remove(1)
+
+    model3 = model.copy(contents=False)
+    assert model3.size() == 0
+
+
+def test_remove_add_ids(engine):
+    model = columnar.connection()
+    model.add_many([ ('o{0}'.format(i), 'r', 't{0}'.format(i), {}) for i in range(5) ])
+    model.remove(1)
+    #New links go after the removed ones, which keep their IDs until compaction
+    assert model.add('o5', 'r', 't5', {}) == 5
+    assert model[4][ORIGIN] == 'o4'
+    assert model[5][ORIGIN] == 'o5'
+
+
+def test_change_during_iteration(engine):
+    model = columnar.connection(compact_threshold=None)
+    model.add_many([ ('o{0}'.format(i), 'r', 't{0}'.format(i), {}) for i in range(5) ])
+    results = model.match(rel='r', include_ids=True)
+    assert next(results) == (0, ('o0', 'r', 't0', {}))
+    #Links removed meanwhile are skipped
+    model.remove(1)
+    assert next(results) == (2, ('o2', 'r', 't2', {}))
+
+    #Iterators already running carry on over the pre-compaction links & indices, as for memory
+    results = model.match(rel='r', include_ids=True)
+    links = iter(model)
+    assert next(results)[0] == 0
+    assert next(links)[0] == 0
+    model.remove(2)
+    model.compact()
+    assert [ ix for ix, link in results ] == [3, 4]
+    assert [ link[ORIGIN] for ix, link in links ] == ['o3', 'o4']
+    assert [ ix for ix, link in model.match(rel='r', include_ids=True) ] == [0, 1, 2]
+
+
+def test_no_compaction_while_iterating(engine):
+    model = columnar.connection()
+    model.add_many([ ('o{0}'.format(i), 'r', 'drop' if i % 3 else 'keep', {}) for i in range(3000) ])
+    for ix, link in model.match(rel='r', include_ids=True):
+        if link[TARGET] == 'drop':
+            model.remove(ix)
+    assert model.size() == 1000
+    assert model.count(target='drop') == 0
+    assert model.add('o3000', 'r', 'keep', {}) == 1000
+
+
+RELS_1 = [
+    ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://copia.ogbuji.net#_metadata"}),
+    ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Copia", {"@context": "http://copia.ogbuji.net#_metadata", '@lang': 'en'}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://uche.ogbuji.net#_metadata"}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Uche's home", {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'en'}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Ulo Uche", {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'ig'}),
+]
+
+if __name__ == '__main__':
+    raise SystemExit("use py.test")
@@ -12,7 +12,7 @@ py.test -s test/py/test_diskcache.py
 import pytest
 #from testconfig import config
 
-from versa.driver.diskcache import newmodel
+from versa.driver.diskcache import connection, newmodel, COUNT_KEY, TERMS_KEY, ABBREVIATIONS_KEY
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
 ##If you do this you also need --nologcapture
@@ -63,6 +63,197 @@ def test_basics_1(tmp_path, rels_1):
     results = list(model.match(attrs={'SPAM': 'EGGS'}))
     assert len(results) == 0
 
+    assert model.count('http://uche.ogbuji.net') == 3
+    assert model.count(rel='http://purl.org/dc/elements/1.1/creator') == 2
+    assert model.count('SPAM') == 0
+    assert model.exists(target='Uche Ogbuji')
+    assert not model.exists(attrs={'SPAM': 'EGGS'})
+
+
+def test_count(tmp_path, rels_1):
+    model = newmodel(dbdir=str(tmp_path))
+    assert model.size() == 0
+    model.add_many(rels_1)
+    assert model.size() == 5
+
+    #Repair a lost count
+    del model._db[COUNT_KEY]
+    assert model.size() == 5
+    assert model.recount() == 5
+    model.add(*rels_1[0])
+    assert model.size() == 6
+
+
+def test_add_many_batches(tmp_path, rels_1):
+    model = newmodel(dbdir=str(tmp_path), reverse_indexes=True)
+    #Batches of 2 split the links of http://copia.ogbuji.net & http://uche.ogbuji.net
+    model.add_many(rels_1[:1] + rels_1[2:] + rels_1[1:2], batch_size=2)
+    assert model.size() == 5
+    assert model.count('http://uche.ogbuji.net') == 3
+    assert [link[TARGET] for link in model.match('http://copia.ogbuji.net')] == ['Uche Ogbuji', 'Copia']
+    assert model._indexed_origins(target='Copia') == ['http://copia.ogbuji.net']
+
+    #Explicit batch, rolled back as a whole
+    with pytest.raises(RuntimeError):
+        with model.batch():
+            model.add('http://example.org/spam', 'http://example.org/eggs', 'ham')
+            model.add_many([('http://example.org/spam', 'http://example.org/eggs', 'toast')])
+            raise RuntimeError
+    assert model.size() == 5
+    assert list(model.match('http://example.org/spam')) == []
+    with model.batch():
+        model.add('http://example.org/spam', 'http://example.org/eggs', 'ham')
+        model.add_many([('http://example.org/spam', 'http://example.org/eggs', 'toast')])
+    assert model.size() == 7
+    assert [link[TARGET] for link in model.match(rel='http://example.org/eggs')] == ['ham', 'toast']
+
+
+def test_reverse_indexes(tmp_path, rels_1):
+    model = newmodel(dbdir=str(tmp_path))
+    model.add_many(rels_1)
+
+    #Indexes built for the existing links, then maintained
+    model = connection(dbdir=str(tmp_path), reverse_indexes=True)
+    model.add('http://example.org/spam', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji')
+    assert model._indexed_origins(target='Uche Ogbuji') == ['http://copia.ogbuji.net', 'http://example.org/spam', 'http://uche.ogbuji.net']
+    assert model._indexed_origins(rel='http://purl.org/dc/elements/1.1/title') == ['http://copia.ogbuji.net', 'http://uche.ogbuji.net']
+    results = list(model.match(target='Uche Ogbuji'))
+    assert [link[ORIGIN] for link in results] == ['http://copia.ogbuji.net', 'http://example.org/spam', 'http://uche.ogbuji.net']
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/title', target='Ulo Uche'))
+    assert results == [rels_1[4]]
+    assert model.count(rel='http://purl.org/dc/elements/1.1/title') == 3
+    assert list(model.match(target='Copia', rel='http://purl.org/dc/elements/1.1/creator')) == []
+    assert list(model.match(rel='http://example.com/spam')) == []
+
+    #Kept on reopening, cleared with the model
+    assert connection(dbdir=str(tmp_path))._targets is not None
+    model = newmodel(dbdir=str(tmp_path))
+    assert model._targets is None
+    model.add_many(rels_1[:2])
+    model = connection(dbdir=str(tmp_path), reverse_indexes=True)
+    assert model._indexed_origins(target='Uche Ogbuji') == ['http://copia.ogbuji.net']
+
+
+def test_reverse_indexes_batch(tmp_path):
+    model = newmodel(dbdir=str(tmp_path), reverse_indexes=True)
+    links = [ (f'http://example.org/book/{i}', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji') for i in range(5) ]
+    with model.batch():
+        for link in links[:3]:
+            model.add(*link)
+        #Index entries held back until commit, or a match which needs them
+        assert 'Uche Ogbuji' not in model._targets
+        assert model._indexed_origins(target='Uche Ogbuji') == [ link[ORIGIN] for link in links[:3] ]
+        for link in links[3:]:
+            model.add(*link)
+    assert model._targets['Uche Ogbuji'] == { (link[ORIGIN], 0) for link in links }
+    assert model._rels[0] == { link[ORIGIN] for link in links }
+
+    with pytest.raises(RuntimeError):
+        with model.batch():
+            model.add('http://example.org/spam', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji')
+            raise RuntimeError
+    assert len(model._targets['Uche Ogbuji']) == 5
+    assert model._pending_index is None
+
+
+def test_codec(tmp_path, rels_1):
+    pytest.importorskip('zstandard')
+    model = newmodel(dbdir=str(tmp_path))
+    links = [ (f'http://example.org/book/{i}', 'http://purl.org/dc/elements/1.1/title', f'Book {i}', {'@lang': 'en'})
+                for i in range(500) ]
+    model.add_many(links)
+    model.recompress(sample_count=100)
+    assert isinstance(model._db['http://example.org/book/1'], bytes)
+    assert sorted(model.match()) == sorted(links)
+    model.add_many(rels_1)
+    assert model.count('http://uche.ogbuji.net') == 3
+
+    #Codec is recorded in the model
+    model = connection(dbdir=str(tmp_path))
+    assert model._codec.spec['name'] == 'zstd'
+    assert list(model.match(target='Ulo Uche')) == [rels_1[4]]
+    with pytest.raises(ValueError):
+        connection(dbdir=str(tmp_path), codec='spam')
+    model.recompress(None)
+    assert model._db['http://example.org/book/1'] == {0: [['Book 1', {'@lang': 'en'}]]}
+
+    model = newmodel(dbdir=str(tmp_path), codec='zstd')
+    model.add_many(rels_1)
+    assert list(model.match()) == rels_1
+
+
+def test_node_cache(tmp_path, rels_1):
+    model = newmodel(dbdir=str(tmp_path), cache_size=1)
+    model.add_many(rels_1)
+    results = list(model.match('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'))
+    assert results == rels_1[3:]
+    assert list(model.match('http://uche.ogbuji.net', attrs={'@lang': 'ig'})) == rels_1[4:]
+    assert model.cache_info() == {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 1}
+
+    #Writes invalidate
+    model.add('http://uche.ogbuji.net', 'http://example.org/rel', 'spam')
+    assert list(model.match('http://uche.ogbuji.net', target='spam')) == [('http://uche.ogbuji.net', 'http://example.org/rel', 'spam', {})]
+    assert list(model.match('http://copia.ogbuji.net', target='Copia')) == [rels_1[1]]
+    assert model.cache_info() == {'hits': 1, 'misses': 3, 'size': 1, 'maxsize': 1}
+    assert list(model.match('@_count')) == []
+
+    #Nothing cached from a batch which was rolled back
+    with pytest.raises(RuntimeError):
+        with model.batch():
+            model.add('http://copia.ogbuji.net', 'http://example.org/rel', 'phantom')
+            assert len(list(model.match('http://copia.ogbuji.net'))) == 3
+            raise RuntimeError
+    assert list(model.match('http://copia.ogbuji.net')) == rels_1[:2]
+
+
+def test_terms(tmp_path, rels_1):
+    model = newmodel(dbdir=str(tmp_path))
+    model.add_many(rels_1)
+    model.add('http://example.org/spam', 'http://purl.org/dc/elements/1.1/creator', I('http://example.org/people/uche'))
+    model.add('http://example.org/spam', 'http://purl.org/dc/elements/1.1/source', 'http://example.org/people/uche')
+    assert model._db[TERMS_KEY] == 4
+    assert model._db['http://example.org/spam'] == {0: [([2, 'uche'], {})], 3: [('http://example.org/people/uche', {})]}
+    #IRIs & literals are kept apart, but a pattern matches either
+    results = list(model.match('http://example.org/spam'))
+    assert [type(link[TARGET]) for link in results] == [I, str]
+    assert len(list(model.match(target=I('http://example.org/people/uche')))) == 2
+
+    #Terms added by another connection
+    other = connection(dbdir=str(tmp_path))
+    other.add('http://example.org/ham', 'http://example.org/eggs', I('http://example.org/eggs'))
+    assert list(model.match(rel='http://example.org/eggs')) == [('http://example.org/ham', 'http://example.org/eggs', 'http://example.org/eggs', {})]
+    model.add('http://example.org/ham', 'http://example.com/eggs', 'ham')
+    assert model._terms.terms == other._terms.terms + ['http://example.com/eggs']
+
+    #A failed add drops just the terms it added, which a match under way doesn't need
+    results = model.match(target=I('http://example.org/people/uche'))
+    assert next(results)[RELATIONSHIP] == 'http://purl.org/dc/elements/1.1/creator'
+    with pytest.raises(TypeError):
+        with model.batch():
+            model.add('http://example.org/spam', 'http://example.com/spam', I('http://example.com/people/x'))
+            raise TypeError
+    assert 'http://example.com/spam' not in model._terms.codes and len(model._terms.terms) == model._db[TERMS_KEY]
+    assert next(results)[RELATIONSHIP] == 'http://purl.org/dc/elements/1.1/source'
+
+
+def test_upgrade(tmp_path):
+    #Model as stored by earlier versions, with abbreviations
+    model = newmodel(dbdir=str(tmp_path), reverse_indexes=True)
+    db = model._db
+    del db[TERMS_KEY]
+    db[ABBREVIATIONS_KEY] = {'a0': 'http://purl.org/dc/elements/1.1/', 'a1': 'http://example.org/'}
+    db['http://copia.ogbuji.net'] = {'{a0}creator': [('Uche Ogbuji', {})], '{a0}title': [('{a1}ham', {})]}
+    db[COUNT_KEY] = 2
+
+    model = connection(dbdir=str(tmp_path))
+    assert list(model.match()) == [
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji', {}),
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', I('http://example.org/ham'), {}),
+    ]
+    assert isinstance(next(model.match(target='http://example.org/ham'))[TARGET], I)
+    assert model._indexed_origins(target='Uche Ogbuji') == ['http://copia.ogbuji.net']
+    assert ABBREVIATIONS_KEY not in model._db
+
 
 def test_attribute_basics_1(tmp_path, rels_1):
     model = newmodel(dbdir=str(tmp_path))
@@ -12,7 +12,11 @@ py.test -s test/py/test_diskcache.py
 import pytest
 #from testconfig import config
 
-from versa.driver.lmdb import newmodel
+import lmdb
+import msgpack
+
+from versa.driver.lmdb import connection, newmodel, COUNT_KEY, TERMS_KEY, ABBREVIATIONS_KEY, NODE_LAYOUT, LINK_LAYOUT
+from versa.query import miniparse, context
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
 ##If you do this you also need --nologcapture
@@ -20,6 +24,10 @@ from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 #if config.get('debug', 'n').startswith('y'):
 #    logging.basicConfig(level=logging.DEBUG)
 
+@pytest.fixture(params=[NODE_LAYOUT, LINK_LAYOUT])
+def layout(request):
+    return request.param
+
 @pytest.fixture
 def rels_1():
     return [
@@ -38,8 +46,8 @@ def rels_2():
         ("http://copia.ogbuji.net/rbrace}/rdbrace}}", "http://example.org/rbrace}/rdbrace}}", "rbrace} rdbrace}}", {"rbrace}/rdbrace}}": "rbrace} rdbrace}}"}),
     ]
 
-def test_basics_1(tmp_path, rels_1):
-    model = newmodel(dbname=str(tmp_path))
+def test_basics_1(tmp_path, rels_1, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout)
     for (subj, pred, obj, attrs) in rels_1:
         model.add(subj, pred, obj, attrs)
     assert model.size() == 5
@@ -63,9 +71,283 @@ def test_basics_1(tmp_path, rels_1):
     results = list(model.match(attrs={'SPAM': 'EGGS'}))
     assert len(results) == 0
 
+    assert model.count('http://uche.ogbuji.net') == 3
+    assert model.count(rel='http://purl.org/dc/elements/1.1/creator') == 2
+    assert model.count('SPAM') == 0
+    assert model.exists(target='Uche Ogbuji')
+    assert not model.exists(attrs={'SPAM': 'EGGS'})
+
+
+def test_count(tmp_path, rels_1, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout)
+    assert model.size() == 0
+    model.add_many(rels_1)
+    assert model.size() == 5
+
+    #Repair a lost count
+    with model._db_env.begin(write=True) as txn:
+        txn.delete(COUNT_KEY)
+    assert model.size() == 5
+    assert model.recount() == 5
+    model.add(*rels_1[0])
+    assert model.size() == 6
 
-def test_attribute_basics_1(tmp_path, rels_1):
+
+def test_add_many_batches(tmp_path, rels_1, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout)
+    #Batches of 2 split the links of http://copia.ogbuji.net & http://uche.ogbuji.net
+    model.add_many(rels_1[:1] + rels_1[2:] + rels_1[1:2], batch_size=2)
+    assert model.size() == 5
+    assert model.count('http://uche.ogbuji.net') == 3
+    results = list(model.match('http://copia.ogbuji.net'))
+    assert [link[TARGET] for link in results] == ['Uche Ogbuji', 'Copia']
+
+    #Sorted input, appended to the database
+    model = newmodel(dbname=str(tmp_path / 'append'), layout=layout)
+    model.add_many(rels_1, batch_size=2, append=True)
+    assert model.size() == 5
+    assert [link[TARGET] for link in model.match('http://uche.ogbuji.net')] == ['Uche Ogbuji', "Uche's home", 'Ulo Uche']
+    if layout == NODE_LAYOUT:
+        with pytest.raises(ValueError):
+            model.add_many([('http://a.example.org', 'http://example.org/rel', 'spam')], append=True)
+        assert model.size() == 5
+
+
+def test_multimatch(tmp_path, rels_1, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout)
+    model.add_many(rels_1)
+    results = list(model.multimatch(origin={'http://copia.ogbuji.net', 'http://uche.ogbuji.net'}, target={'Copia', 'Ulo Uche'}))
+    assert results == [rels_1[1], rels_1[4]]
+    results = list(model.multimatch(rel={'http://purl.org/dc/elements/1.1/title'}, attrs={'@lang': 'en'}))
+    assert results == [rels_1[1], rels_1[3]]
+    results = list(model.multimatch(origin={'http://uche.ogbuji.net', 'http://example.org/spam'}, rel={'http://purl.org/dc/elements/1.1/creator', 'http://example.org/rel'}, include_ids=True))
+    assert [link for index, link in results] == [rels_1[2]]
+    assert list(model.multimatch(origin='http://example.org/spam')) == []
+
+    #The query engine runs on multimatch
+    ctx = context(rels_1[0], model, None)
+    result = miniparse("?($a, 'http://purl.org/dc/elements/1.1/title', *)").evaluate(ctx)
+    assert result == {'a': {'http://copia.ogbuji.net', 'http://uche.ogbuji.net'}}
+
+
+def test_map_growth(tmp_path, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout, map_size=64 * 1024, max_map_size=4 * 1024 * 1024)
+    links = [ (f'http://example.org/n{i:04}', 'http://example.org/rel', 'spam' * 25) for i in range(5000) ]
+    model.add_many(links, batch_size=1000)
+    assert model.size() == 5000
+    stats = model.stats()
+    assert 64 * 1024 < stats['map_size'] <= 4 * 1024 * 1024
+    assert stats['used_size'] <= stats['map_size']
+    assert stats['data_pages'] * stats['page_size'] <= stats['used_size']
+
+    #Past the ceiling the batch fails as a whole
+    with pytest.raises(lmdb.MapFullError):
+        model.add_many([ (f'http://example.org/m{i:04}', 'http://example.org/rel', 'spam' * 250) for i in range(5000) ])
+    assert model.size() == 5000
+    assert model.stats()['map_size'] == 4 * 1024 * 1024
+
+
+def test_codec(tmp_path, rels_1, layout):
+    pytest.importorskip('zstandard')
+    model = newmodel(dbname=str(tmp_path), layout=layout)
+    links = [ (f'http://example.org/book/{i}', 'http://purl.org/dc/elements/1.1/title', f'Book {i}', {'@lang': 'en'})
+                for i in range(500) ]
+    model.add_many(links)
+    model.recompress(sample_count=100)
+    assert model._codec.spec['name'] == 'zstd'
+    assert list(model.match()) == sorted(links)
+    model.add_many(rels_1)
+    assert model.count('http://uche.ogbuji.net') == 3
+    model._db_env.close()
+
+    #Codec is recorded in the model
+    model = connection(dbname=str(tmp_path))
+    assert model._codec.spec['name'] == 'zstd'
+    assert list(model.match(target='Ulo Uche')) == [rels_1[4]]
+    model.recompress(None)
+    assert model.size() == 505
+    with model._db_env.begin() as txn:
+        assert txn.get(b'@_codec') is None
+    model._db_env.close()
+
+    model = newmodel(dbname=str(tmp_path), codec='zstd')
+    model.add_many(rels_1)
+    assert list(model.match()) == rels_1
+
+
+def test_node_cache(tmp_path, rels_1, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout, cache_size=1)
+    model.add_many(rels_1)
+    results = list(model.match('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'))
+    assert results == rels_1[3:]
+    assert model.cache_info() == {'hits': 0, 'misses': 1, 'size': 1, 'maxsize': 1}
+    assert list(model.match('http://uche.ogbuji.net', attrs={'@lang': 'ig'})) == rels_1[4:]
+    assert model.cache_info()['hits'] == 1
+    #Cached attributes can't be changed through results
+    results[0][ATTRIBUTES]['@lang'] = 'spam'
+    assert list(model.match('http://uche.ogbuji.net', target="Uche's home")) == [rels_1[3]]
+
+    #Writes invalidate
+    model.add('http://uche.ogbuji.net', 'http://example.org/rel', 'spam')
+    assert model.count('http://uche.ogbuji.net', 'http://example.org/rel') == 1
+    assert model.cache_info()['misses'] == 2
+    results = list(model.multimatch(origin={'http://copia.ogbuji.net', 'http://uche.ogbuji.net'}, target={'Copia', 'Ulo Uche'}))
+    assert results == [rels_1[1], rels_1[4]]
+    assert model.cache_info() == {'hits': 2, 'misses': 4, 'size': 1, 'maxsize': 1}
+    assert list(model.match('http://example.org/spam')) == []
+
+
+def _targets(links):
+    return [ link[TARGET] for link in links ]
+
+
+def test_parallel_scan(tmp_path, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout)
+    model.add_many([ (f'http://example.org/n{i:03}', 'http://example.org/rel', f'spam{j}') for i in range(100) for j in range(3) ])
+    partitions = model.partitions(4)
+    assert len(partitions) == 4
+    assert partitions[0][0] is None and partitions[-1][1] is None
+    assert all( start < end for start, end in partitions[1:-1] )
+    #Each partition's links, in order, make up the whole model
+    results = model.parallel_scan(partitions=partitions, max_workers=2)
+    assert [ link for result in results for link in result ] == list(model.match())
+    results = model.parallel_scan(_targets, partitions=3, target='spam1', max_workers=2)
+    assert sum(results, []) == ['spam1'] * 100
+    assert list(model.match(key_range=(b'http://example.org/n010', b'http://example.org/n012'))) == \
+        list(model.multimatch(origin={'http://example.org/n010', 'http://example.org/n011'}))
+
+
+def test_link_layout(tmp_path, rels_1):
+    model = newmodel(dbname=str(tmp_path), layout=LINK_LAYOUT)
+    model.add_many(rels_1)
+    #Hub origin with many links
+    for i in range(100):
+        model.add('http://uche.ogbuji.net', 'http://example.org/rel', f'spam{i}')
+    assert model.size() == 105
+    results = list(model.match('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'))
+    assert [link[TARGET] for link in results] == ["Uche's home", 'Ulo Uche']
+    results = list(model.match('http://uche.ogbuji.net', 'http://example.org/rel'))
+    assert [link[TARGET] for link in results] == [f'spam{i}' for i in range(100)]
+    assert model.count('http://uche.ogbuji.net') == 103
+    assert list(model.match('http://uche.ogbuji.net', 'http://example.com/rel')) == []
+
+    #Layout is recorded in the model
+    with model._db_env.begin() as txn:
+        assert txn.get(b'@_layout') == LINK_LAYOUT.encode('utf-8')
+        with pytest.raises(ValueError):
+            model._ensure_layout(txn, NODE_LAYOUT)
+
+
+def test_reverse_indexes(tmp_path, rels_1, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout)
+    model.add_many(rels_1)
+    model._db_env.close()
+
+    #Indexes built for the existing links, then maintained
+    model = connection(dbname=str(tmp_path), reverse_indexes=True)
+    model.add('http://example.org/spam', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji')
+    model.add('http://example.org/spam', 'http://example.org/eggs', 'x' * 1000)
+    with model._db_env.begin() as txn:
+        assert model._indexed_origins(txn, target='Uche Ogbuji') == [b'http://copia.ogbuji.net', b'http://example.org/spam', b'http://uche.ogbuji.net']
+        assert model._indexed_origins(txn, rel=model._terms.codes['http://example.org/eggs']) == [b'http://example.org/spam']
+    results = list(model.match(target='Uche Ogbuji'))
+    assert [link[ORIGIN] for link in results] == ['http://copia.ogbuji.net', 'http://example.org/spam', 'http://uche.ogbuji.net']
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/title', target='Ulo Uche'))
+    assert results == [rels_1[4]]
+    assert model.count(rel='http://purl.org/dc/elements/1.1/title') == 3
+    assert model.count(target='x' * 1000) == 1
+    assert list(model.match(target='Copia', rel='http://purl.org/dc/elements/1.1/creator')) == []
+    assert list(model.match(target='http://example.com/spam')) == []
+    model._db_env.close()
+
+    #Kept on reopening, cleared with the model
+    model = connection(dbname=str(tmp_path))
+    assert model._reverse_indexes
+    model._db_env.close()
+    model = newmodel(dbname=str(tmp_path))
+    assert not model._reverse_indexes
+    model.add_many(rels_1)
+    assert model.count(target='Uche Ogbuji') == 2
+
+
+def test_terms(tmp_path, rels_1):
     model = newmodel(dbname=str(tmp_path))
+    model.add_many(rels_1)
+    model.add('http://example.org/spam', 'http://purl.org/dc/elements/1.1/creator', I('http://example.org/people/uche'))
+    model.add('http://example.org/spam', 'http://purl.org/dc/elements/1.1/source', 'http://example.org/people/uche')
+    assert model._terms.terms == ['http://purl.org/dc/elements/1.1/creator', 'http://purl.org/dc/elements/1.1/title',
+                                  'http://example.org/people/', 'http://purl.org/dc/elements/1.1/source']
+    with model._db_env.begin() as txn:
+        assert msgpack.loads(txn.get(TERMS_KEY)) == 4
+        assert msgpack.loads(txn.get(b'http://example.org/spam'), strict_map_key=False) == \
+            {0: [[[2, 'uche'], {}]], 3: [['http://example.org/people/uche', {}]]}
+    #IRIs & literals are kept apart, but a pattern matches either
+    results = list(model.match('http://example.org/spam'))
+    assert [type(link[TARGET]) for link in results] == [I, str]
+    assert len(list(model.match(target='http://example.org/people/uche'))) == 2
+    assert len(list(model.match(target=I('http://example.org/people/uche')))) == 2
+    assert list(model.multimatch(target={I('http://example.org/people/uche')}, rel={'http://purl.org/dc/elements/1.1/creator'})) == [results[0]]
+
+    #Terms added elsewhere, e.g. by another process
+    with model._db_env.begin(write=True) as txn:
+        txn.put(b'@_t:\x00\x00\x00\x04', b'http://example.org/eggs')
+        txn.put(TERMS_KEY, msgpack.dumps(5))
+        txn.put(b'http://example.org/ham', msgpack.dumps({4: [[[4, ''], {}]]}, use_bin_type=True))
+    assert list(model.match('http://example.org/ham')) == [('http://example.org/ham', 'http://example.org/eggs', 'http://example.org/eggs', {})]
+
+    #A failed add mustn't leave a term which was never stored, nor drop those stored, which a
+    #match under way, on any connection sharing the dictionary, might still need to decode
+    results = model.match(target=I('http://example.org/people/uche'))
+    assert next(results)[RELATIONSHIP] == 'http://purl.org/dc/elements/1.1/creator'
+    with pytest.raises(TypeError):
+        model.add('http://example.org/spam', 'http://example.com/eggs', 'ham', {'spam': object()})
+    assert len(model._terms.terms) == 5 and 'http://example.com/eggs' not in model._terms.codes
+    assert next(results)[RELATIONSHIP] == 'http://purl.org/dc/elements/1.1/source'
+    model.add('http://example.org/spam', 'http://example.com/eggs', 'ham', {})
+    assert model.count(rel='http://example.com/eggs') == 1
+    assert model._terms.codes['http://example.com/eggs'] == 5
+
+
+def test_upgrade(tmp_path, rels_1, layout):
+    #Model as stored by earlier versions, with abbreviations
+    env = lmdb.open(str(tmp_path), max_dbs=8)
+    with env.begin(write=True) as txn:
+        txn.put(ABBREVIATIONS_KEY, msgpack.dumps({'a0': 'http://purl.org/dc/elements/1.1/', 'a1': 'http://example.org/'}))
+        txn.put(COUNT_KEY, msgpack.dumps(3))
+        txn.put(b'@_layout', layout.encode('utf-8'))
+        links = [ (b'http://copia.ogbuji.net', '{a0}creator', ['Uche Ogbuji', {}]),
+                  (b'http://copia.ogbuji.net', '{a0}title', ['{a1}ham', {}]),
+                  (b'http://uche.ogbuji.net', '{a0}creator', ['Uche Ogbuji', {'@lang': 'en'}]) ]
+        if layout == NODE_LAYOUT:
+            for origin_b, rel, targetplus in links:
+                nodedata = txn.get(origin_b)
+                nodedata = {} if nodedata is None else msgpack.loads(nodedata, raw=False)
+                nodedata.setdefault(rel, []).append(targetplus)
+                txn.put(origin_b, msgpack.dumps(nodedata, use_bin_type=True))
+        else:
+            db = env.open_db(b'@_links', txn=txn)
+            for seq, (origin_b, rel, targetplus) in enumerate(links):
+                key = origin_b + b'\x00' + rel.encode('utf-8') + b'\x00' + seq.to_bytes(8, 'big')
+                txn.put(key, msgpack.dumps(targetplus, use_bin_type=True), db=db)
+            txn.put(b'@_seq', (3).to_bytes(8, 'big'))
+    env.close()
+
+    model = connection(dbname=str(tmp_path), reverse_indexes=True)
+    assert list(model.match()) == [
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji', {}),
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', I('http://example.org/ham'), {}),
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji', {'@lang': 'en'}),
+    ]
+    assert isinstance(next(model.match(target='http://example.org/ham'))[TARGET], I)
+    assert model.count(target='Uche Ogbuji') == 2
+    model.add('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', "Uche's home")
+    assert model.size() == 4
+    with model._db_env.begin() as txn:
+        assert txn.get(ABBREVIATIONS_KEY) is None
+
+
+def test_attribute_basics_1(tmp_path, rels_1, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout)
     for (subj, pred, obj, attrs) in rels_1:
         model.add(subj, pred, obj, attrs)
     assert model.size() == 5
@@ -89,8 +371,8 @@ def test_attribute_basics_1(tmp_path, rels_1):
     assert results[0][TARGET] == 'Uche\'s home'
 
 
-def test_handling_braces(tmp_path, rels_2):
-    model = newmodel(dbname=str(tmp_path))
+def test_handling_braces(tmp_path, rels_2, layout):
+    model = newmodel(dbname=str(tmp_path), layout=layout)
     for (subj, pred, obj, attrs) in rels_2:
         model.add(subj, pred, obj, attrs)
     assert model.size() == 3
@@ -6,11 +6,18 @@ py.test test/py/test_memory.py --tc=debug:y --nologcapture
 
 '''
 
+import gc
 import logging
+import pickle
+from collections import OrderedDict
+
+import pytest
 
 #from testconfig import config
 
 from versa.driver import memory
+from versa import I
+from versa.util import uniquify, fingerprint
 
 #If you do this you also need --nologcapture
 #Handle  --tc=debug:y option
@@ -64,9 +71,51 @@ def test_removal():
     assert list(model)[1][1][2] == 'lit2'
     assert model.size() == 2
 
-    model.remove(0)
+    #Indices of the remaining links are stable until compaction
+    model.remove(1)
     assert list(model)[0][1][2] == 'lit2'
     assert model.size() == 1
+    assert model[2][2] == 'lit2'
+    with pytest.raises(IndexError):
+        model[1]
+
+    model.compact()
+    assert list(model) == [(0, ('s1', 'p2', 'lit2', {}))]
+    assert list(model.match(rel='p2', include_ids=True)) == [(0, ('s1', 'p2', 'lit2', {}))]
+
+def test_removal_while_iterating(monkeypatch):
+    model = memory.connection(sorted_indexes=True)
+    model.add_many([ ('s1', 'p{0}'.format(i % 2), 'lit{0}'.format(i)) for i in range(10) ])
+    seen = []
+    for ix, link in model.match(origin='s1', include_ids=True):
+        assert link[2] == 'lit{0}'.format(ix)
+        seen.append(ix)
+        model.remove(ix + 1)
+    assert seen == [0, 2, 4, 6, 8]
+    assert [ link[2] for link in model.match(rel='p0') ] == ['lit0', 'lit2', 'lit4', 'lit6', 'lit8']
+    assert list(model.match(rel='p1')) == []
+
+    #Compaction kicks in once enough links are removed
+    monkeypatch.setattr(memory, 'COMPACT_MIN_REMOVED', 2)
+    model.remove(0)
+    assert model.size() == 4
+    assert [ ix for ix, link in model.match(rel='p0', include_ids=True) ] == [0, 1, 2, 3]
+
+
+def test_no_compaction_while_iterating():
+    model = memory.connection()
+    model.add_many([ ('s{0}'.format(i), 'p0', 'drop' if i % 3 else 'keep') for i in range(3000) ])
+    #Enough removals to cross COMPACT_MIN_REMOVED, but IDs stay valid till the iteration's done
+    for ix, link in model.match(include_ids=True):
+        if link[2] == 'drop':
+            model.remove(ix)
+    assert model.size() == 1000
+    assert model.count(target='drop') == 0
+    assert model._removed == 2000
+    #Then compacted on the next write
+    model.add('s3000', 'p0', 'keep')
+    assert model._removed == 0
+    assert [ ix for ix, link in model.match(origin='s3000', include_ids=True) ] == [1000]
 
 def test_index():
     model = memory.connection()
@@ -78,6 +127,118 @@ def test_index():
     assert model[r2][1] == 'p1'
     assert model[r3][2] == 'lit2'
 
+def test_indexed_match():
+    model = memory.connection()
+    model.add_many(RELS_1)
+    model.add('s1','p0','lit0',{},index=0)
+    results = list(model.match(origin='http://uche.ogbuji.net', rel='http://purl.org/dc/elements/1.1/title', include_ids=True))
+    assert [ix for ix, link in results] == [4, 5]
+    assert [link[2] for ix, link in results] == ["Uche's home", "Ulo Uche"]
+
+    results = list(model.match(target='Uche Ogbuji'))
+    assert [link[0] for link in results] == ['http://copia.ogbuji.net', 'http://uche.ogbuji.net']
+    assert list(model.match(origin='s1', rel='http://purl.org/dc/elements/1.1/title')) == []
+
+    model.remove([1, 2])
+    results = list(model.multimatch(origin={'s1', 'http://uche.ogbuji.net'}, rel={'p0', 'http://purl.org/dc/elements/1.1/creator'}, include_ids=True))
+    assert [(ix, link[0]) for ix, link in results] == [(0, 's1'), (3, 'http://uche.ogbuji.net')]
+
+def test_attr_index():
+    model = memory.connection(attr_index=True)
+    model.add_many(RELS_1)
+    model.add('s1', 'p0', 'lit0', {'@lang': ['en', 'ig']})
+    results = list(model.match(attrs={'@lang': 'en'}, include_ids=True))
+    assert [ix for ix, link in results] == [1, 3]
+    results = list(model.match(origin='http://uche.ogbuji.net', attrs={'@lang': 'en', '@context': 'http://uche.ogbuji.net#_metadata'}))
+    assert [link[2] for link in results] == ["Uche's home"]
+    assert list(model.match(rel='http://purl.org/dc/elements/1.1/creator', attrs={'@lang': 'en'})) == []
+    #Unhashable attribute values still match, just not via the index
+    assert [link[0] for link in model.match(attrs={'@lang': ['en', 'ig']})] == ['s1']
+
+    model.remove(3)
+    results = list(model.multimatch(origin={'http://copia.ogbuji.net', 'http://uche.ogbuji.net'}, attrs={'@lang': 'en'}, include_ids=True))
+    assert [ix for ix, link in results] == [1]
+    model.compact()
+    assert [link[2] for link in model.match(attrs={'@lang': 'ig'})] == ['Ulo Uche']
+    assert model.copy() == model
+
+def test_count_exists():
+    for model in (memory.connection(), memory.connection(attr_index=True)):
+        model.add_many(RELS_1)
+        assert model.count() == 5
+        assert model.count('http://uche.ogbuji.net') == 3
+        assert model.count(rel='http://purl.org/dc/elements/1.1/title', target='Ulo Uche') == 1
+        assert model.count(attrs={'@lang': 'en'}) == 2
+        assert model.count('SPAM') == 0
+        assert model.exists(target='Uche Ogbuji')
+        assert not model.exists('http://copia.ogbuji.net', attrs={'@lang': 'ig'})
+        model.remove(0)
+        assert model.count(target='Uche Ogbuji') == 1
+        assert model.count() == 4
+
+def test_sorted_indexes():
+    model = memory.connection(sorted_indexes=True)
+    model.add_many(RELS_1)
+    model.add('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji', {'@context': 'http://copia.ogbuji.net#_metadata'})
+    model.add('http://acme.example', 'http://purl.org/dc/elements/1.1/title', 'Acme', {})
+    model.add('http://acme.example', 'http://purl.org/dc/elements/1.1/date', 2020, {})
+
+    #Full scan is sorted by origin, then rel, then target
+    results = list(model.match())
+    assert [link[0] for link in results][:3] == ['http://acme.example'] * 2 + ['http://copia.ogbuji.net']
+    assert results[0][2] == 2020
+    assert [link[2] for link in results][-3:] == ['Uche Ogbuji', "Uche's home", 'Ulo Uche']
+
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/title', include_ids=True))
+    assert [ix for ix, link in results] == [6, 1, 3, 4]
+
+    results = list(model.match(origin='http://copia.ogbuji.net', target='Uche Ogbuji', include_ids=True))
+    assert [ix for ix, link in results] == [0, 5]
+    assert list(model.match(target=2020)) == [('http://acme.example', 'http://purl.org/dc/elements/1.1/date', 2020, {})]
+    assert list(model.match(origin='http://copia.ogbuji.net', rel='http://purl.org/dc/elements/1.1/title', target='Ulo Uche')) == []
+
+    model.add('http://acme.example', 'http://purl.org/dc/elements/1.1/title', 'Acme', {}, index=0)
+    uniquify(model)
+    assert model.size() == 7
+    results = list(model.match(origin='http://acme.example', rel='http://purl.org/dc/elements/1.1/title', include_ids=True))
+    assert results == [(0, ('http://acme.example', 'http://purl.org/dc/elements/1.1/title', 'Acme', {}))]
+
+    #Targets which compare equal are duplicates, whether or not the model is sorted
+    for sorted_indexes in (False, True):
+        model = memory.connection(sorted_indexes=sorted_indexes)
+        model.add_many([ ('s1', 'p0', t) for t in (1, True, 'x', 1.0, 1.5, 'x', 2) ])
+        uniquify(model)
+        assert [ link[2] for ix, link in model ] == [1, 'x', 1.5, 2]
+
+def test_readonly_attrs():
+    model = memory.connection()
+    model.add_many(RELS_1)
+    model.add('s1', 'p0', 'lit0')
+    link = next(model.match(origin='http://uche.ogbuji.net', attrs={'@lang': 'ig'}))
+    with pytest.raises(TypeError):
+        link[3]['@lang'] = 'en'
+    with pytest.raises(TypeError):
+        link[3].pop('@lang')
+    #Attributes are shared, not copied
+    assert link[3] is model[4][3]
+    assert model[5][3] is memory.EMPTY_ATTRS
+
+    attrs = link[3].copy()
+    attrs['@lang'] = 'en'
+    assert model[4][3]['@lang'] == 'ig'
+    assert pickle.loads(pickle.dumps(link)) == link
+
+    model = memory.connection(copy_attrs=True)
+    model.add_many(RELS_1)
+    link = next(model.match(origin='http://uche.ogbuji.net', attrs={'@lang': 'ig'}))
+    link[3]['@lang'] = 'en'
+    assert model[4][3]['@lang'] == 'ig'
+
+    #Links come with attributes of any other attr_cls
+    model = memory.connection(attr_cls=OrderedDict)
+    model.add_many(RELS_1)
+    assert type(next(model.match(attrs={'@lang': 'ig'}))[3]) is OrderedDict
+
 def test_copy():
     model = memory.connection()
     r1 = model.add('s1','p0','lit0',{})
@@ -90,6 +251,70 @@ def test_copy():
     model3 = model.copy(contents=False)
     assert model3.size() == 0
 
+def test_copy_on_write():
+    model = memory.connection(sorted_indexes=True)
+    model.add_many(RELS_1)
+    model2 = model.copy()
+    snap = model.snapshot()
+    model2.add('s1', 'p0', 'lit0')
+    model2.remove(0)
+    assert model.size() == snap.size() == 5
+    assert model2.size() == 5
+    assert list(model.match(origin='s1')) == []
+    assert len(list(model.match(target='Uche Ogbuji'))) == 2
+    assert len(list(model2.match(target='Uche Ogbuji'))) == 1
+
+    #Writes to the original don't disturb readers of the snapshot
+    results = snap.match(origin='http://uche.ogbuji.net')
+    next(results)
+    model.remove([2, 3, 4])
+    model.add('s2', 'p0', 'lit0')
+    assert len(list(results)) == 2
+    assert model.size() == 3
+    assert snap.size() == 5
+    assert list(snap.match(origin='s2')) == []
+    assert snap.fingerprint() == fingerprint(snap) != model.fingerprint()
+
+    with pytest.raises(TypeError):
+        snap.add('s3', 'p0', 'lit0')
+    with pytest.raises(TypeError):
+        snap.remove(0)
+
+    #Copies which are gone no longer share, so the model needn't unshare to write
+    rels = model._relationships
+    model2 = model.copy()
+    snap = model.snapshot()
+    model2.copy().add('s3', 'p0', 'lit0')
+    del model2, snap
+    gc.collect()
+    assert model._sharers[0] == 1
+    model.add('s3', 'p0', 'lit0')
+    assert model._relationships is rels
+
+
+def test_fingerprint():
+    model = memory.connection()
+    model.add_many(RELS_1)
+    model2 = memory.connection(sorted_indexes=True)
+    model2.add_many(reversed(RELS_1))
+    assert model.fingerprint() == model2.fingerprint() == fingerprint(model)
+    assert model == model2
+
+    #Kept up to date incrementally
+    model.add('s1', 'p0', I('http://example.org/'))
+    assert model != model2
+    model2.add('s1', 'p0', 'http://example.org/')
+    assert model.size() == model2.size()
+    assert model != model2
+    model2.remove(5)
+    model2.add('s1', 'p0', I('http://example.org/'))
+    assert model.fingerprint() == model2.fingerprint() == fingerprint(model2)
+    assert model == model2
+
+    #Attribute order doesn't matter
+    model.add('s2', 'p0', 'lit', {'a': '1', 'b': '2'})
+    model2.add('s2', 'p0', 'lit', {'b': '2', 'a': '1'})
+    assert model == model2
 
 RELS_1 = [
     ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://copia.ogbuji.net#_metadata"}),
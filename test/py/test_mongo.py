@@ -11,7 +11,7 @@ py.test test/py/test_memory.py --tc=debug:y --nologcapture
 import pytest
 #from testconfig import config
 
-from versa.driver.mongo import newmodel
+from versa.driver.mongo import newmodel, connection, _plan_stages
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
 ##If you do this you also need --nologcapture
@@ -33,6 +33,12 @@ def mongo_collection():
     return DEMOCOLL
 
 
+@pytest.fixture
+def mock_collection():
+    mongomock = pytest.importorskip('mongomock')
+    return mongomock.MongoClient().versademo.model1
+
+
 @pytest.fixture
 def rels_1():
     return [
@@ -75,5 +81,194 @@ def test_attribute_basics_1(mongo_collection, rels_1):
     assert len(results) == 1
 
 
+
+def test_count(mongo_collection, rels_1):
+    model = newmodel(collection=mongo_collection)
+    assert model.size() == 0
+    model.add_many(rels_1)
+    assert model.size() == 5
+
+    #Repair a lost count
+    mongo_collection.delete_one({'origin': '@_count'})
+    assert model.size() == 5
+    assert model.recount() == 5
+    model.add(*rels_1[0])
+    assert model.size() == 6
+
+
+def test_server_side_count(mock_collection, rels_1):
+    model = newmodel(collection=mock_collection)
+    model.add_many(rels_1)
+    model.add('http://example.org/spam', 'http://example.org/voc/rank', 3)
+    assert model.count() == 6
+    assert model.count(origin='http://uche.ogbuji.net') == 3
+    assert model.count(rel='http://purl.org/dc/elements/1.1/title') == 3
+    assert model.count(origin='http://uche.ogbuji.net', rel='http://purl.org/dc/elements/1.1/title') == 2
+    assert model.count(target='Uche Ogbuji') == 2
+    assert model.count(rel='http://purl.org/dc/elements/1.1/title', attrs={'@lang': 'en'}) == 2
+    assert model.count(attrs={'@lang': 'ig', '@context': 'http://uche.ogbuji.net#_metadata'}) == 1
+    assert model.count(rel='http://example.com/nope') == 0
+    assert model.count(target='Nope') == 0
+    #Only matched in Python
+    assert model.count(target=3) == 1
+
+    #Counted on the server, without fetching the links through match
+    def no_match(*args, **kwargs):
+        raise AssertionError('Links fetched')
+    model.match = no_match
+    assert model.count(target='Uche Ogbuji', attrs={'@context': 'http://copia.ogbuji.net#_metadata'}) == 1
+    assert model.count(origin='http://uche.ogbuji.net', target='http://example.org/nope') == 0
+
+
+def test_server_side_match(mock_collection, rels_1):
+    model = newmodel(collection=mock_collection)
+    model.add_many(rels_1)
+    model.add('http://example.org/spam', 'http://purl.org/dc/elements/1.1/creator', I('http://example.org/people/uche'), {'x': True})
+
+    #Only the origin documents concerned, & their matching entries, are fetched
+    query, pipeline = model._match_query(None, model._terms.codes['http://purl.org/dc/elements/1.1/title'], ['Copia'])
+    assert [ item['origin'] for item in mock_collection.find(query) ] == ['http://copia.ogbuji.net']
+    items = list(mock_collection.aggregate(pipeline))
+    assert [ rel_obj['instances'] for rel_obj in items[0]['rels'] ] == [[['Copia', rels_1[1][ATTRIBUTES]]]]
+
+    assert list(model.match(rel='http://purl.org/dc/elements/1.1/title', attrs={'@lang': 'en'})) == [rels_1[1], rels_1[3]]
+    assert list(model.match(target='Uche Ogbuji')) == [rels_1[0], rels_1[2]]
+    assert list(model.match('http://uche.ogbuji.net', target='Copia')) == []
+    results = list(model.match(target='http://example.org/people/uche', attrs={'x': True}))
+    assert [ link[ORIGIN] for link in results ] == ['http://example.org/spam']
+    assert isinstance(results[0][TARGET], I)
+    assert model.count(rel='http://purl.org/dc/elements/1.1/creator') == 3
+    assert list(model.match(attrs={'@lang': 'spam'})) == []
+
+
+def test_bulk_add_many(mock_collection, rels_1):
+    from pymongo.write_concern import WriteConcern
+    model = newmodel(collection=mock_collection)
+    #Batches of 2 split the links of http://copia.ogbuji.net & http://uche.ogbuji.net
+    model.add_many(rels_1[:1] + rels_1[2:] + rels_1[1:2], batch_size=2, ordered=False, write_concern=WriteConcern(w=1))
+    assert model.size() == 5
+    assert model.count('http://uche.ogbuji.net') == 3
+    assert mock_collection.count_documents({'origin': {'$nin': connection.META_ORIGINS}}) == 2
+    #One rel entry per rel & batch
+    item = mock_collection.find_one({'origin': 'http://uche.ogbuji.net'})
+    assert [ len(rel_obj['instances']) for rel_obj in item['rels'] ] == [1, 2]
+    assert [ link[TARGET] for link in model.match('http://copia.ogbuji.net') ] == ['Uche Ogbuji', 'Copia']
+    model.add('http://uche.ogbuji.net', 'http://example.org/rel', I('http://example.org/spam'))
+    assert model.size() == 6
+    assert model.count(target='http://example.org/spam') == 1
+
+
+def test_ensure_indexes(mock_collection, rels_1):
+    #Model from before the index fields
+    mock_collection.insert_many([
+        {'origin': '@_terms', 'terms': ['http://purl.org/dc/elements/1.1/title']},
+        {'origin': '@_count', 'count': 2},
+        {'origin': 'http://uche.ogbuji.net', 'rels': [{'rid': 0, 'instances': [[link[TARGET], link[ATTRIBUTES]] for link in rels_1[3:]]}]},
+    ])
+    model = connection(collection=mock_collection)
+    assert list(model.match(target='Ulo Uche', attrs={'@lang': 'ig'})) == rels_1[4:]
+
+    indexes = model.ensure_indexes(attrs=['@lang'])
+    assert indexes == ['origin_1', 'rels.rid_1', 'rels.targets_1', 'rels.attrs.@lang_1']
+    assert mock_collection.index_information()['origin_1']['unique']
+    rel_obj = mock_collection.find_one({'origin': 'http://uche.ogbuji.net'})['rels'][0]
+    assert rel_obj['targets'] == ["Uche's home", 'Ulo Uche']
+    assert rel_obj['attrs'] == [{'@lang': 'en'}, {'@lang': 'ig'}]
+    query, pipeline = model._match_query(None, 0, ['Ulo Uche'], {'@lang': 'ig', '@context': 'http://uche.ogbuji.net#_metadata'})
+    assert query['rels']['$elemMatch']['targets'] == {'$in': ['Ulo Uche']}
+    assert query['rels']['$elemMatch']['attrs'] == {'$elemMatch': {'@lang': 'ig'}}
+    assert list(model.match(target='Ulo Uche', attrs={'@lang': 'ig'})) == rels_1[4:]
+
+    #Kept on reopening & maintained
+    model = connection(collection=mock_collection)
+    model.add(*rels_1[1])
+    rel_obj = mock_collection.find_one({'origin': 'http://copia.ogbuji.net'})['rels'][0]
+    assert rel_obj['targets'] == ['Copia'] and rel_obj['attrs'] == [{'@lang': 'en'}]
+    assert list(model.match(attrs={'@lang': 'en'})) == [rels_1[3], rels_1[1]]
+    with pytest.raises(ValueError):
+        model.ensure_indexes(attrs=['a.b'])
+
+    plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'rels.targets_1'}}
+    assert [ stage['stage'] for stage in _plan_stages({'queryPlan': plan}) ] == ['FETCH', 'IXSCAN']
+
+
+def test_async_connection(mock_collection, rels_1):
+    import asyncio
+    mongomock_motor = pytest.importorskip('mongomock_motor')
+    from versa.driver import mongo_async
+    #Sharing the mock's store, so both drivers see the same collection
+    client = mongomock_motor.AsyncMongoMockClient(mock_mongo_client=mock_collection.database.client)
+    async_collection = client.versademo.model1
+
+    async def run():
+        model = await mongo_async.newmodel(collection=async_collection)
+        await model.add(*rels_1[0])
+        await model.add_many(rels_1[1:], batch_size=2)
+        assert await model.size() == 5
+        assert [ link async for link in model.match(origin='http://copia.ogbuji.net') ] == rels_1[:2]
+        assert [ link async for link in model.match(target='Ulo Uche', attrs={'@lang': 'ig'}) ] == rels_1[4:]
+        assert [ link async for link in model.match(rel='http://example.org/nope') ] == []
+        results = [ link async for link in model.multimatch(origin={'http://uche.ogbuji.net'},
+                        target={'Uche Ogbuji', 'Ulo Uche'}, include_ids=True) ]
+        assert [ link for index, link in results ] == [rels_1[2], rels_1[4]]
+        assert [ link async for link in model.multimatch(rel={'http://purl.org/dc/elements/1.1/creator', 'http://example.org/nope'}) ] == [rels_1[0], rels_1[2]]
+        return model
+
+    model = asyncio.run(run())
+    #Written through either driver, read through the other
+    sync_model = connection(collection=mock_collection)
+    assert list(sync_model.match()) == [rels_1[0], rels_1[1], rels_1[2], rels_1[3], rels_1[4]]
+    sync_model.add('http://example.org/book', 'http://example.org/voc/author', I('http://example.org/people/jane'))
+
+    async def reread():
+        assert await model.size() == 6
+        return [ link async for link in model.match(target='http://example.org/people/jane') ]
+    assert asyncio.run(reread()) == [('http://example.org/book', 'http://example.org/voc/author', I('http://example.org/people/jane'), {})]
+
+    #Models from before the IRI dictionary need upgrading by the synchronous driver
+    legacy = client.versademo.model2
+    mock_collection.database.model2.insert_one({'origin': '@_abbreviations', 'map': {}})
+    with pytest.raises(ValueError):
+        asyncio.run(mongo_async.newmodel(collection=legacy))
+
+
+class explain_stub(object):
+    '''
+    Collection whose cursors explain with a canned plan, an IXSCAN of the targets
+    index once it exists, otherwise a COLLSCAN, since mongomock has no query planner
+    '''
+    def __init__(self, coll):
+        self._coll = coll
+
+    def __getattr__(self, name):
+        return getattr(self._coll, name)
+
+    def find(self, *args, **kwargs):
+        cursor = self._coll.find(*args, **kwargs)
+        if 'rels.targets_1' in self._coll.index_information():
+            plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'rels.targets_1'}}
+        else:
+            plan = {'stage': 'COLLSCAN'}
+        cursor.explain = lambda: {'queryPlanner': {'winningPlan': {'queryPlan': plan}}}
+        return cursor
+
+
+def test_explain(mock_collection, rels_1):
+    model = connection(collection=explain_stub(mock_collection))
+    model.add_many(rels_1)
+    report = model.explain(target='Ulo Uche', attrs={'@lang': 'ig'})
+    assert report['indexes'] == [] and not report['covered']
+    assert report['plan'] == {'queryPlan': {'stage': 'COLLSCAN'}}
+
+    model.ensure_indexes()
+    report = model.explain(target='Ulo Uche', attrs={'@lang': 'ig'})
+    assert report['indexes'] == ['rels.targets_1'] and report['covered']
+    assert report['query']['rels']['$elemMatch']['targets'] == {'$in': ['Ulo Uche']}
+    assert [ stage['stage'] for stage in _plan_stages(report['plan']) ] == ['FETCH', 'IXSCAN']
+
+    #Rel not in the model, so nothing to query
+    assert model.explain(rel='http://example.com/nope') == {'query': None, 'indexes': [], 'covered': True, 'plan': None}
+
+
 if __name__ == '__main__':
     raise SystemExit("use pytest command line")
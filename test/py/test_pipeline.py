@@ -95,6 +95,23 @@ def asserter(out_m):
 
 BOOK_CASES.append(('inverted1', transforms, asserter))
 
+# Conditional on links in the output model
+transforms = {
+    'id': ignore(),
+    'title': link(rel=ifexists(haslink(origin(), VTYPE_REL, BOOK_TYPE, output=True), SCH+'name', SCH+'alternateName')),
+    'author': materialize(SCH+'Person', rel=SCH+'author', unique=[(SCH+'name', target())], links=[(SCH+'name', target())]),
+    'link': link(rel=SCH+'link'),
+    'cover': link(rel=ifexists(haslink(rel=SCH+'image', output=True), SCH+'thumbnailUrl', SCH+'cover')),
+}
+
+def asserter(out_m):
+    assert out_m.size() == 7, repr(out_m)
+    assert next(out_m.match(BOOK_ID, SCHEMA_NAME))[TARGET] == 'The Catcher in the Rye'
+    assert out_m.exists(BOOK_ID, SCH+'cover')
+    assert not out_m.exists(rel=SCH+'thumbnailUrl')
+
+BOOK_CASES.append(('conditional1', transforms, asserter))
+
 #    'author': link(rel=SCH+'author') materialize(SCH+'Person', unique=[(SCH+'name', run('target'))], links=[(SCH+'name', target()), (None, SCH+'wrote', origin())]),
 
 
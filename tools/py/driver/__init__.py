@@ -32,6 +32,27 @@ class connection_base(object):
         '''
         raise NotImplementedError
 
+    def count(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the number of links that match a pattern of components, as for match.
+        Drivers override this to count without building up the links
+
+        origin - (optional) origin of the relationship (similar to an RDF subject). If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        '''
+        return sum(1 for link in self.match(origin, rel, target, attrs))
+
+    def exists(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return True if any link matches a pattern of components, as for match,
+        stopping at the first one found. Args as for count
+        '''
+        for link in self.match(origin, rel, target, attrs):
+            return True
+        return False
+
     def add(self, origin, rel, target, attrs=None, rid=None):
         '''
         Add one relationship to the extent
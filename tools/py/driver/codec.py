@@ -0,0 +1,94 @@
+'''
+Codecs for the serialized node values of the key/value drivers (lmdb, diskcache)
+
+A codec is described by a spec, a small mapping which the drivers record in the
+model's metadata, so that every connection reads values back the same way, e.g.:
+
+{'name': 'zstd', 'level': 3, 'dict': b'...'}
+
+The zstd codec needs the zstandard package (pip install zstandard). It can use a
+dictionary trained from a sample of the model's values, which pays off for the
+many small, repetitive values typical of node data (same rels, same attribute
+names, same literal patterns).
+
+>>> from versa.driver import codec
+>>> c = codec.from_spec({'name': 'zstd', 'level': 3})
+>>> c.decode(c.encode(b'spam')) == b'spam'
+True
+'''
+
+try:
+    import zstandard
+except ImportError:
+    #Models using the zstd codec can't be opened
+    zstandard = None
+
+ZSTD = 'zstd'
+
+DEFAULT_LEVEL = 3
+
+#Target dictionary size (zstd's own default) & number of values sampled to train it
+DEFAULT_DICT_SIZE = 110 * 1024
+DEFAULT_SAMPLE_COUNT = 10000
+
+
+class plain_codec:
+    '''Values stored as is'''
+    spec = None
+
+    def encode(self, data):
+        return data
+
+    def decode(self, data):
+        return data
+
+
+class zstd_codec:
+    '''Values compressed with zstd, optionally with a trained dictionary'''
+    def __init__(self, level=DEFAULT_LEVEL, dict_data=None):
+        if zstandard is None:
+            raise ImportError('The zstd codec needs the zstandard package (pip install zstandard)')
+        zdict = zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=zdict)
+        self._decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+        self.spec = {'name': ZSTD, 'level': level, 'dict': dict_data}
+
+    def encode(self, data):
+        return self._compressor.compress(data)
+
+    def decode(self, data):
+        return self._decompressor.decompress(data)
+
+
+def from_spec(spec):
+    '''Return the codec for a spec, as recorded in model metadata. None is the plain codec'''
+    if spec is None:
+        return plain_codec()
+    if spec['name'] == ZSTD:
+        return zstd_codec(spec.get('level', DEFAULT_LEVEL), spec.get('dict'))
+    raise ValueError(f'Unknown codec: {spec["name"]}')
+
+
+def new(name, level=DEFAULT_LEVEL, samples=None, dict_size=DEFAULT_DICT_SIZE):
+    '''
+    Return a new codec
+
+    name - ZSTD, or None for the plain codec
+    level - compression level
+    samples - (optional) list of serialized values from which to train a dictionary.
+        If omitted, or too few for zstd to train from, no dictionary is used
+    dict_size - target size of the trained dictionary, in bytes
+    '''
+    if name is None:
+        return plain_codec()
+    if name != ZSTD:
+        raise ValueError(f'Unknown codec: {name}')
+    if zstandard is None:
+        raise ImportError('The zstd codec needs the zstandard package (pip install zstandard)')
+    dict_data = None
+    if samples:
+        try:
+            dict_data = zstandard.train_dictionary(dict_size, samples).as_bytes()
+        except zstandard.ZstdError:
+            pass
+    return zstd_codec(level, dict_data)
@@ -0,0 +1,375 @@
+#Columnar in-memory driver for Versa, a Web semi-structured metadata tool
+'''
+
+[
+    (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
+]
+
+The optional attributes are metadata bound to the statement itself
+
+Same API as versa.driver.memory, but rather than a Python tuple per link, origins,
+rels & targets are dictionary-encoded to integer IDs and kept in compact arrays,
+one per component. Read-only attribute mappings are likewise interned, so the many
+links with identical (e.g. empty) attributes share one copy. Links are only decoded
+back into tuples as they're yielded. Each interned attribute mapping is indexed
+by its (name, value) pairs, so matching on attrs is a test on the attribute ID column.
+
+If NumPy is available matching is a vectorized mask over the columns, otherwise
+a plain Python scan.
+
+>>> from versa.driver import columnar
+>>> m = columnar.connection()
+>>> m.add('http://example.org/spam', 'http://example.org/eggs', 'Ham', {})
+0
+>>> list(m.match(rel='http://example.org/eggs'))
+[('http://example.org/spam', 'http://example.org/eggs', 'Ham', {})]
+'''
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    #Fall back to plain Python scans over the columns
+    numpy = None
+
+from versa.driver import memory
+from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
+from versa import util
+
+#Type code for the ID columns, matching numpy.int64
+ID_TYPECODE = 'q'
+
+#Origin ID marking a removed link, until compaction
+TOMBSTONE = -1
+
+
+class connection(memory.connection):
+    def __init__(self, baseiri=None, attr_cls=dict, copy_attrs=False, compact_threshold=0.5):
+        '''
+        Initialize connection object
+
+        Args:
+            baseiri: IRI used by default to resolve relative IRIs
+            attr_cls: class of the relationship attributes in links yielded with
+                copy_attrs, and in the model's repr. Attributes are stored as read-only
+                frozenattrs mappings regardless. Any class other than dict, e.g.
+                OrderedDict, turns on copy_attrs, so that links come with it
+            copy_attrs: if True yield links with a mutable copy (of attr_cls) of their
+                attributes. By default yield the stored, read-only frozenattrs mapping
+            compact_threshold: proportion of removed links at which the columns are
+                compacted, as for versa.driver.memory, likewise not while iterators are running
+        '''
+        super().__init__(baseiri, attr_cls, copy_attrs=copy_attrs, compact_threshold=compact_threshold)
+        return
+
+    def copy(self, contents=True):
+        '''
+        Create a copy of this model, optionally without contents (i.e. just configuration)
+
+        The copy shares storage with this model until either of them changes, at
+        which point the one being changed takes its own copy (copy-on-write)
+        '''
+        cp = connection(self._baseiri, self._attr_cls, self._copy_attrs, self._compact_threshold)
+        if contents: self._share(cp)
+        return cp
+
+    _STORAGE = ('_terms', '_term_ids', '_term_variants', '_attr_table', '_attr_ids', '_attr_postings', '_origins', '_rels', '_targets', '_attrs', '_removed', '_fingerprint')
+
+    def _unshare(self):
+        '''Take a private copy of storage shared with other models'''
+        self._set_sharers([1])
+        #Columns & dictionaries are copied wholesale, with no need to re-encode
+        self._terms = self._terms.copy()
+        self._term_ids = self._term_ids.copy()
+        self._term_variants = { k: v.copy() for k, v in self._term_variants.items() }
+        self._attr_table = self._attr_table.copy()
+        self._attr_ids = self._attr_ids.copy()
+        self._attr_postings = { k: v.copy() for k, v in self._attr_postings.items() }
+        self._origins = array(ID_TYPECODE, self._origins)
+        self._rels = array(ID_TYPECODE, self._rels)
+        self._targets = array(ID_TYPECODE, self._targets)
+        self._attrs = array(ID_TYPECODE, self._attrs)
+        return
+
+    def create_space(self):
+        '''Set up a new table space for the first time'''
+        #Dictionary of all origin, rel & target values. Keyed by class as well as value
+        #so that e.g. an I and a str with the same characters decode faithfully
+        self._terms = []
+        self._term_ids = {}
+        #All the IDs for values which compare equal, e.g. such an I and str
+        self._term_variants = {}
+        #Interned attribute mappings
+        self._attr_table = []
+        self._attr_ids = {}
+        #IDs of the interned attribute mappings with each (name, value) pair. Under
+        #None, those which couldn't be interned, which must always be checked
+        self._attr_postings = {None: []}
+        self._origins = array(ID_TYPECODE)
+        self._rels = array(ID_TYPECODE)
+        self._targets = array(ID_TYPECODE)
+        self._attrs = array(ID_TYPECODE)
+        self._removed = 0
+        self._fingerprint = None
+        self._set_sharers([1])
+        self._id_counter = 1
+        return
+
+    def size(self):
+        '''Return the number of links in the model'''
+        return len(self._origins) - self._removed
+
+    @memory._tracked
+    def __iter__(self):
+        columns = self._columns()
+        origins = columns[1]
+        for index in range(len(origins)):
+            if origins[index] != TOMBSTONE:
+                yield index, self._decode(index, columns)
+
+    def _encode(self, value):
+        '''Return the integer ID for an origin, rel or target value, assigning one if need be'''
+        key = (value.__class__, value)
+        tid = self._term_ids.get(key)
+        if tid is None:
+            tid = len(self._terms)
+            self._terms.append(value)
+            self._term_ids[key] = tid
+            self._term_variants.setdefault(value, []).append(tid)
+        return tid
+
+    def _encode_attrs(self, attrs):
+        '''Return the integer ID for a (read-only) attribute mapping, interning it if possible'''
+        try:
+            key = tuple(attrs.items())
+            aid = self._attr_ids.get(key)
+        except TypeError:
+            #Unhashable attribute values, so just store this one as is
+            key = aid = None
+        if aid is None:
+            aid = len(self._attr_table)
+            self._attr_table.append(attrs)
+            if key is not None:
+                self._attr_ids[key] = aid
+                for item in key:
+                    self._attr_postings.setdefault(item, []).append(aid)
+            else:
+                self._attr_postings[None].append(aid)
+        return aid
+
+    def _columns(self):
+        '''
+        The term dictionary, the columns & the attribute table as they are now. Compaction
+        & unsharing replace the columns rather than changing them, and the dictionary &
+        table are only appended to, so iterators hold on to these, as memory's do to its list
+        '''
+        return (self._terms, self._origins, self._rels, self._targets, self._attrs, self._attr_table)
+
+    def _decode(self, index, columns=None):
+        '''Reconstitute the link tuple at the given position, of the given _columns() if provided'''
+        terms, origins, rels, targets, aids, attr_table = columns or self._columns()
+        attrs = attr_table[aids[index]]
+        if self._copy_attrs:
+            attrs = self._attr_cls(attrs)
+        return (terms[origins[index]], terms[rels[index]], terms[targets[index]], attrs)
+
+    def _positions(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the positions of links whose components are among the given
+        sets of values. An omitted (None or empty) set matches anything.
+        Also narrow by the IDs of the attribute mappings which might match attrs,
+        leaving the exact check to the caller.
+        '''
+        bound = []
+        for values, column in ((origin, self._origins), (rel, self._rels), (target, self._targets)):
+            if not values:
+                continue
+            ids = [ tid for v in values for tid in self._term_variants.get(v, ()) ]
+            #Value never seen, so nothing can match
+            if not ids:
+                return []
+            bound.append((column, ids))
+        #Removed links only have the tombstone ID in the origin column, so unless
+        #the origin is bound they have to be skipped
+        skip_removed = self._removed and not origin
+        if attrs:
+            aids = None
+            try:
+                for item in attrs.items():
+                    curr = set(self._attr_postings.get(item, ()))
+                    aids = curr if aids is None else (aids & curr)
+            except TypeError:
+                #Unhashable value, so scan the attribute mappings instead
+                aids = { aid for aid, xattrs in enumerate(self._attr_table) if all(k in xattrs and xattrs.get(k) == v for k, v in attrs.items()) }
+            aids = sorted(aids.union(self._attr_postings[None]))
+            if not aids:
+                return []
+            bound.append((self._attrs, aids))
+        if not bound:
+            if not skip_removed:
+                return range(len(self._origins))
+            return [ index for index, oid in enumerate(self._origins) if oid != TOMBSTONE ]
+
+        if numpy is not None:
+            mask = None
+            for column, ids in bound:
+                #Zero-copy view. Must not outlive this call, since arrays can't be
+                #resized while they're exporting their buffers
+                col = numpy.frombuffer(column, dtype=numpy.int64)
+                curr = (col == ids[0]) if len(ids) == 1 else numpy.isin(col, ids)
+                mask = curr if mask is None else (mask & curr)
+            if skip_removed:
+                col = numpy.frombuffer(self._origins, dtype=numpy.int64)
+                mask &= (col != TOMBSTONE)
+            del col
+            return numpy.flatnonzero(mask).tolist()
+
+        bound = [ (column, set(ids)) for column, ids in bound ]
+        origins = self._origins
+        return [ index for index in range(len(origins))
+                    if all(column[index] in ids for column, ids in bound) and not (skip_removed and origins[index] == TOMBSTONE) ]
+
+    @memory._tracked
+    def _filter(self, positions, columns, attrs, include_ids):
+        '''
+        Decode the links at the given positions of the given _columns(), yielding those whose
+        attributes match. Links removed meanwhile are skipped
+        '''
+        origins, aids, attr_table = columns[1], columns[4], columns[5]
+        for index in positions:
+            if origins[index] == TOMBSTONE:
+                continue
+            if attrs:
+                xattrs = attr_table[aids[index]]
+                if not all(k in xattrs and xattrs.get(k) == v for k, v in attrs.items()):
+                    continue
+            if include_ids:
+                yield index, self._decode(index, columns)
+            else:
+                yield self._decode(index, columns)
+        return
+
+    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Iterator over relationship IDs that match a pattern of components
+
+        origin - (optional) origin of the relationship (similar to an RDF subject). If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs with yield values
+        '''
+        #Positions are of the columns as they are now, so hold on to those
+        columns = self._columns()
+        positions = self._positions(origin and (origin,), rel and (rel,), target and (target,), attrs)
+        return self._filter(positions, columns, attrs, include_ids)
+
+    def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Iterator over relationship IDs that match a pattern of components
+
+        origin - (optional) origin of the relationship (similar to an RDF subject), or set of values. If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate), or set of values. If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object, or set of values. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs with yield values
+        '''
+        origin = origin if origin is None or isinstance(origin, set) else set([origin])
+        rel = rel if rel is None or isinstance(rel, set) else set([rel])
+        target = target if target is None or isinstance(target, set) else set([target])
+        columns = self._columns()
+        positions = self._positions(origin, rel, target, attrs)
+        return self._filter(positions, columns, attrs, include_ids)
+
+    def count(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the number of links that match a pattern of components, as for match,
+        without decoding them
+        '''
+        positions = self._positions(origin and (origin,), rel and (rel,), target and (target,), attrs)
+        if not attrs:
+            return len(positions)
+        table, aids = self._attr_table, self._attrs
+        return sum(1 for index in positions
+                    if all(k in table[aids[index]] and table[aids[index]].get(k) == v for k, v in attrs.items()))
+
+    def add(self, origin, rel, target, attrs=None, index=None):
+        '''
+        Add one relationship to the extent
+
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+        index - optional position for the relationship to be inserted
+        '''
+        self._writable()
+        if not origin:
+            raise ValueError('Relationship origin cannot be null')
+        if not rel:
+            raise ValueError('Relationship ID cannot be null')
+
+        attrs = memory.freeze_attrs(attrs)
+        row = (self._encode(origin), self._encode(rel), self._encode(target), self._encode_attrs(attrs))
+        if index is None:
+            #Any compaction put off while iterators were running
+            self._auto_compact()
+        columns = (self._origins, self._rels, self._targets, self._attrs)
+        if index is not None:
+            rid = index
+            for column, value in zip(columns, row):
+                column.insert(index, value)
+        else:
+            #Physical position, since removed links keep theirs until compaction
+            rid = len(self._origins)
+            for column, value in zip(columns, row):
+                column.append(value)
+        if self._fingerprint is not None:
+            self._fingerprint = (self._fingerprint + util.link_hash((origin, rel, target, attrs))) % util.FINGERPRINT_MODULUS
+        return rid
+
+    def remove(self, index):
+        '''
+        Delete one or more relationship, by index, from the extent
+
+        index - either a single index or a list of indices
+
+        The indices of the remaining links don't change until the model is compacted
+        '''
+        if hasattr(index, '__iter__'):
+            ind = set(index)
+        else:
+            ind = [index]
+
+        self._writable()
+        origins = self._origins
+        for i in ind:
+            if 0 <= i < len(origins) and origins[i] != TOMBSTONE:
+                if self._fingerprint is not None:
+                    self._fingerprint = (self._fingerprint - util.link_hash(self._decode(i))) % util.FINGERPRINT_MODULUS
+                origins[i] = TOMBSTONE
+                self._removed += 1
+
+        self._auto_compact()
+        return
+
+    def compact(self):
+        '''Rebuild the columns without the removed links, renumbering the rest'''
+        self._writable()
+        if self._removed:
+            keep = [ i for i, oid in enumerate(self._origins) if oid != TOMBSTONE ]
+            self._origins = array(ID_TYPECODE, (self._origins[i] for i in keep))
+            self._rels = array(ID_TYPECODE, (self._rels[i] for i in keep))
+            self._targets = array(ID_TYPECODE, (self._targets[i] for i in keep))
+            self._attrs = array(ID_TYPECODE, (self._attrs[i] for i in keep))
+            self._removed = 0
+        return
+
+    def __getitem__(self, i):
+        if i < 0: i += len(self._origins)
+        if not 0 <= i < len(self._origins):
+            raise IndexError(i)
+        if self._origins[i] == TOMBSTONE:
+            raise IndexError('Relationship {0} has been removed'.format(i))
+        return self._decode(i)
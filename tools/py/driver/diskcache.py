@@ -17,42 +17,110 @@ Value is list:
     ]}
 ]
 
+Rels & IRI targets are stored dictionary encoded, as integer codes, and
+[code, tail] pairs respectively (see iridict), so a node actually maps rel
+code to list of (target, attrs).
 
 '''
 
+import os
 import functools
+import contextlib
 #from itertools import groupby
 #from operator import itemgetter
 
 from diskcache import Index #pip install diskcache
-
-from amara3 import iri #for absolutize & matches_uri_syntax
+import msgpack
 
 from versa.driver import connection_base
+from versa.driver import codec as codecs
+from versa.driver.nodecache import node_cache
+from versa.driver.iridict import term_dictionary, hashable, expand_legacy
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
+#Metadata key for the number of links in the model, maintained by add
+COUNT_KEY = '@_count'
+
+#Metadata key recording that the reverse indexes are maintained
+INDEXES_KEY = '@_indexes'
+
+#Subdirectories of dbdir for the reverse indexes, from target to set of
+#(origin, rel), and from rel to set of origins
+TARGETS_INDEX = '@_targets'
+RELS_INDEX = '@_rels'
+
+#Default number of links add_many writes per transaction
+DEFAULT_BATCH_SIZE = 10000
+
+#Metadata key for the number of terms in the IRI dictionary (see iridict), each
+#stored under TERM_PREFIX & its code
+TERMS_KEY = '@_terms'
+TERM_PREFIX = '@_t:'
 
-def newmodel(dbdir, baseiri=None):
+#Metadata key for the IRI prefix abbreviation map of models from before the IRI
+#dictionary, which are upgraded when opened
+ABBREVIATIONS_KEY = '@_abbreviations'
+
+#Metadata key for the spec of the codec for node values, if not stored as is
+CODEC_KEY = '@_codec'
+
+
+def newmodel(dbdir, baseiri=None, reverse_indexes=False, codec=None, cache_size=0):
     '''
     Return a new, empty Versa model with DiskCache back end
     Warning: if there is DiskCache data already in dbdir, it will be erased.
     '''
-    model = connection(dbdir=dbdir, baseiri=baseiri, clear=True)
+    model = connection(dbdir=dbdir, baseiri=baseiri, clear=True, reverse_indexes=reverse_indexes, codec=codec,
+                       cache_size=cache_size)
     return model
 
 
+def _pack(node, codec):
+    '''Node as stored with a codec. Without compression it's stored as is'''
+    if codec.spec is None:
+        return node
+    return codec.encode(msgpack.dumps(node, use_bin_type=True))
+
+
+def _unpack(data, codec):
+    if codec.spec is None:
+        return data
+    #Nodes are keyed by rel code
+    return msgpack.loads(codec.decode(data), raw=False, strict_map_key=False)
+
+
 class connection(connection_base):
-    def __init__(self, dbdir=None, baseiri=None, clear=False):
+    def __init__(self, dbdir=None, baseiri=None, clear=False, reverse_indexes=None, codec=None, cache_size=0):
         '''
         Versa connection object built from DiskCache collection object
+
+        reverse_indexes - if True maintain indexes from target to origin & rel and
+            from rel to origin, so that matches by target or rel without origin only
+            read the nodes concerned. If the model doesn't have them yet they're
+            built from its links. Once a model has them they're always maintained.
+            An index entry is rewritten whenever links are added to it, but only once
+            per add_many batch or batch(), so add links in bulk with those
+        codec - codec for the node values of a new model, e.g. codec.ZSTD, or None to store them
+            as is. An existing model keeps its codec, which recompress() changes
+        cache_size - number of decoded nodes to keep in an LRU cache
+            for matches by origin, e.g. nodecache.DEFAULT_CACHE_SIZE. 0 for no cache. Only writes
+            through this connection invalidate cached nodes, so don't enable it if the model is
+            being changed elsewhere
         '''
         self._dbdir = dbdir
         self._db = Index(dbdir)
         if clear: self._db.clear()
-        self._ensure_abbreviations()
+        self._terms = term_dictionary()
+        #Nodes of links added within batch(), not yet in the reverse indexes
+        self._pending_index = None
+        legacy_abbrevs = self._ensure_terms()
+        self._codec = self._ensure_codec(codec)
+        self._node_cache = node_cache(cache_size) if cache_size else None
+        if legacy_abbrevs is not None:
+            reverse_indexes = self._upgrade(legacy_abbrevs) or reverse_indexes
+        self._ensure_reverse_indexes(reverse_indexes)
         #self.create_model()
         self._baseiri = baseiri
-        self._abbr_index = 0
         return
 
     def copy(self, contents=True):
@@ -67,36 +135,38 @@ class connection(connection_base):
         raise NotImplementedError
 
     def size(self):
-        '''Return the number of links in the model'''
+        '''Return the number of links in the model, from the maintained count'''
+        count = self._db.get(COUNT_KEY)
+        if count is None:
+            #Model from before the count was kept
+            return self.recount()
+        return count
+
+    def recount(self):
+        '''
+        Count the links in the model by scanning all the nodes, and store the
+        result as the count used by size(), e.g. to repair it
+        '''
         count = 0
-        for origin in self._db:
-            if origin.startswith('@'):
-                continue
-            for rel, targetplus in self._db[origin].items():
-                count += len(targetplus)
+        with self._db.transact():
+            for origin in self._db:
+                if origin.startswith('@'):
+                    continue
+                for rel, targetplus in self._get_node(origin).items():
+                    count += len(targetplus)
+            self._db[COUNT_KEY] = count
         return count
-        #return  self._db_coll.count() - connection.META_ITEM_COUNT
+
+    def _add_to_count(self, delta):
+        '''Adjust the stored link count. Call within a transaction'''
+        count = self._db.get(COUNT_KEY)
+        if count is not None:
+            #Otherwise the next size() call recounts
+            self._db[COUNT_KEY] = count + delta
+        return
 
     def __iter__(self):
-        abbrevs = self._abbreviations()
-        cursor = self._db_coll.find()
-        index = 0
-        for origin in self._db:
-            if origin.startswith('@'):
-                continue
-            for rel, targetplus in self._db[origin].items():
-                try:
-                    rel = rel.format(**abbrevs)
-                except (KeyError, ValueError):
-                    pass
-                count += len(targetplus)
-                for target, attribs in targetplus:
-                    try:
-                        target = target.format(**abbrevs)
-                    except (KeyError, ValueError):
-                        pass
-                    yield index, (origin, rel, target, attribs)
-                    index += 1
+        yield from self.match(include_ids=True)
 
     # FIXME: Statement indices don't work sensibly without some inefficient additions. Use e.g. match for delete instead
     def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
@@ -109,31 +179,36 @@ class connection(connection_base):
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
         include_ids - If true include statement IDs with yield values
         '''
-        abbrevs = self._abbreviations()
+        if origin is not None and self._node_cache is not None:
+            yield from self._match_cached(origin, rel, target, attrs, include_ids)
+            return
+        terms = self._terms
+        self._refresh_terms()
+        stored_rel = terms.encode_rel(rel) if rel else None
+        if rel and stored_rel is None:
+            #Not in the dictionary, so no such rel
+            return
+        #Compared as stored, so only the links yielded are decoded
+        forms = terms.target_forms(target) if target else None
         index = 0
         if origin is None:
-            extent = self._db
+            if self._targets is not None and (rel or target):
+                #Just the nodes with the rel or target
+                extent = self._indexed_origins(rel, target)
+            else:
+                extent = self._db
         else:
             extent = [origin]
 
         for origin in extent:
             if origin.startswith('@'):
                 continue
-            for xrel, xtargetplus in self._db.get(origin, {}).items():
-                try:
-                    xrel = xrel.format(**abbrevs)
-                except (KeyError, ValueError):
-                    pass
-                if rel and rel != xrel:
+            for xrel, xtargetplus in self._get_node(origin, {}).items():
+                if rel and stored_rel != xrel:
                     continue
                 for xtarget, xattrs in xtargetplus:
                     index += 1
-                    # FIXME: only expand target abbrevs if of resource type?
-                    try:
-                        xtarget = xtarget.format(**abbrevs)
-                    except (KeyError, ValueError):
-                        pass
-                    if target and target != xtarget:
+                    if target and xtarget not in forms:
                         continue
                     matches = True
                     if attrs:
@@ -141,13 +216,107 @@ class connection(connection_base):
                             if k not in xattrs or xattrs.get(k) != v:
                                 matches = False
                     if matches:
+                        link = (origin, terms.decode_rel(xrel), terms.decode_target(xtarget), xattrs)
                         if include_ids:
-                            yield index, (origin, xrel, xtarget, xattrs)
+                            yield index, link
                         else:
-                            yield origin, xrel, xtarget, xattrs
+                            yield link
 
         return
 
+    def _match_cached(self, origin, rel, target, attrs, include_ids):
+        '''As match for a given origin, from the decoded node in the cache'''
+        if origin.startswith('@'):
+            return
+        node = self._node_cache.get(origin)
+        if node is None:
+            terms = self._terms
+            self._refresh_terms()
+            node = { terms.decode_rel(xrel): [ (terms.decode_target(xtarget), xattrs) for xtarget, xattrs in xtargetplus ]
+                        for xrel, xtargetplus in self._get_node(origin, {}).items() }
+            self._node_cache.put(origin, node)
+        index = 0
+        for xrel, xtargetplus in node.items():
+            if rel and rel != xrel:
+                continue
+            for xtarget, xattrs in xtargetplus:
+                index += 1
+                if target and target != xtarget:
+                    continue
+                if attrs and any( k not in xattrs or xattrs.get(k) != v for k, v in attrs.items() ):
+                    continue
+                #Copy, so the cached attributes can't be changed
+                if include_ids:
+                    yield index, (origin, xrel, xtarget, dict(xattrs))
+                else:
+                    yield origin, xrel, xtarget, dict(xattrs)
+        return
+
+    def cache_info(self):
+        '''Return the node cache's hit & miss counters, with its current & maximum size, or None if not enabled'''
+        return None if self._node_cache is None else self._node_cache.info()
+
+    def _indexed_origins(self, rel=None, target=None):
+        '''
+        Return the origins, in order, of the links with the given rel and/or
+        target, according to the reverse indexes
+        '''
+        #Including any links added so far within batch()
+        self._flush_index()
+        stored_rel = self._terms.encode_rel(rel) if rel else None
+        if rel and stored_rel is None:
+            #Not in the dictionary, so no such rel
+            return []
+        if target:
+            return sorted({ xorigin for form in self._terms.target_forms(target)
+                                    for xorigin, xrel in self._targets.get(hashable(form), ())
+                                    if not rel or xrel == stored_rel })
+        return sorted(self._rels.get(stored_rel, ()))
+
+    def _index_links(self, nodes):
+        '''
+        Add links, grouped by origin, to the reverse indexes. Call within a transaction.
+        The new entries are first grouped by index key, so each key is read & written
+        once per call, however many links share its target or rel
+
+        nodes - mapping from origin to mapping from rel code to list of (target, attrs), as stored
+        '''
+        targets, rels = {}, {}
+        for origin, node in nodes.items():
+            for rel, targetplus in node.items():
+                for target, attrs in targetplus:
+                    targets.setdefault(hashable(target), set()).add((origin, rel))
+                rels.setdefault(rel, set()).add(origin)
+        #Innermost transactions, so the indexes are committed first and might only
+        #ever hold extra candidates, which match checks against the nodes
+        with self._targets.transact(), self._rels.transact():
+            for index, entries in ((self._targets, targets), (self._rels, rels)):
+                for key, added in entries.items():
+                    current = index.get(key, set())
+                    if not added <= current:
+                        index[key] = current | added
+        return
+
+    def _flush_index(self):
+        '''Write the reverse index entries held back within batch(), if any'''
+        if self._pending_index:
+            self._index_links(self._pending_index)
+            self._pending_index = {}
+        return
+
+    def count(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the number of links that match a pattern of components, as for match.
+        With just the origin bound, links are counted without decoding them
+        '''
+        if origin and not (rel or target or attrs):
+            if origin.startswith('@'):
+                return 0
+            return sum( len(targetplus) for targetplus in self._get_node(origin, {}).values() )
+        if not (origin or rel or target or attrs):
+            return self.size()
+        return super().count(origin, rel, target, attrs)
+
     def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
         Iterator over relationship IDs that match a pattern of components, with multiple options provided for each component
@@ -197,18 +366,10 @@ class connection(connection_base):
 
         attrs = attrs or {}
 
-        origin_obj = self._db.get(origin)
-        rel = self._abbreviate(rel)
-        target = self._abbreviate(target)
-        
-        if origin_obj is None:
-            self._db[origin] = {rel: [(target, attrs)]}
-        else:
-            origin_obj.setdefault(rel, []).append((target, attrs))
-            self._db[origin] = origin_obj
+        self._add_batch([(origin, rel, target, attrs)])
         return
 
-    def add_many(self, rels):
+    def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE):
         '''
         Add a list of relationships to the extent
 
@@ -221,7 +382,12 @@ class connection(connection_base):
         rel - type IRI of the relationship (similar to an RDF predicate)
         target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+
+        batch_size - number of links to write per transaction. Within each batch the
+            links are grouped by origin, so each node is read & written once. If a batch
+            fails, earlier ones stay committed (unless within batch())
         '''
+        batch = []
         for curr_rel in rels:
             attrs = {}
             if len(curr_rel) == 3:
@@ -230,7 +396,82 @@ class connection(connection_base):
                 origin, rel, target, attrs = curr_rel
             else:
                 raise ValueError
-            self.add(origin, rel, target, attrs)
+            if not origin:
+                raise ValueError('Relationship origin cannot be null')
+            if not rel:
+                raise ValueError('Relationship ID cannot be null')
+            batch.append((origin, rel, target, attrs or {}))
+            if len(batch) >= batch_size:
+                self._add_batch(batch)
+                batch = []
+        if batch:
+            self._add_batch(batch)
+        return
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Context manager to make all the writes within it one transaction, committed
+        on leaving it, or rolled back if it's left by an exception, e.g.:
+
+        with model.batch():
+            for link in links:
+                model.add(*link)
+
+        Other connections, including in other processes, wait on the model until then.
+        Reverse index entries are written once, as the batch is committed, rather than
+        for each add
+        '''
+        nested = self._pending_index is not None
+        if not nested and self._targets is not None:
+            self._pending_index = {}
+        try:
+            with self._db.transact():
+                yield self
+                if not nested:
+                    self._flush_index()
+        except BaseException:
+            #Rolled back, so drop any terms added to the in-process dictionary, which weren't stored
+            self._terms.truncate(self._db.get(TERMS_KEY, 0))
+            #Nodes read into the cache within the batch might have had links which weren't stored either
+            if self._node_cache is not None:
+                self._node_cache.invalidate()
+            raise
+        finally:
+            if not nested:
+                self._pending_index = None
+        return
+
+    def _add_batch(self, links):
+        '''Add links, grouped by origin, in one transaction, with the count & any new terms'''
+        try:
+            with self._db.transact():
+                nodes = {}
+                for origin, rel, target, attrs in links:
+                    rel = self._terms.encode_rel(rel, self._add_term)
+                    target = self._terms.encode_target(target, self._add_term)
+                    nodes.setdefault(origin, {}).setdefault(rel, []).append((target, attrs))
+                for origin, added in nodes.items():
+                    node = self._get_node(origin, {})
+                    for rel, targetplus in added.items():
+                        node.setdefault(rel, []).extend(targetplus)
+                    self._put_node(origin, node)
+                if self._node_cache is not None:
+                    self._node_cache.invalidate(nodes)
+                if self._pending_index is not None:
+                    #Within batch(), so indexed on commit
+                    for origin, added in nodes.items():
+                        pending = self._pending_index.setdefault(origin, {})
+                        for rel, targetplus in added.items():
+                            pending.setdefault(rel, []).extend(targetplus)
+                elif self._targets is not None:
+                    self._index_links(nodes)
+                self._add_to_count(len(links))
+        except BaseException:
+            #Rolled back, so drop any terms just added to the in-process dictionary, which weren't
+            #stored. Not the rest, which a match under way may yet decode
+            self._terms.truncate(self._db.get(TERMS_KEY, 0))
+            raise
         return
 
     #FIXME: Replace with a match_to_remove method
@@ -255,38 +496,142 @@ class connection(connection_base):
     def __eq__(self, other):
         return repr(other) == repr(self)
 
-    def _abbreviations(self):
-        abbrev_obj = self._db['@_abbreviations']
-        return abbrev_obj
-        
-    def _abbreviate(self, rid):
+    def _get_node(self, origin, default=None):
+        '''Return the node for an origin, mapping rel to list of (target, attrs), as stored'''
+        data = self._db.get(origin)
+        return default if data is None else _unpack(data, self._codec)
+
+    def _put_node(self, origin, node):
+        self._db[origin] = _pack(node, self._codec)
+        return
+
+    def recompress(self, codec=codecs.ZSTD, level=codecs.DEFAULT_LEVEL, train=True,
+                    dict_size=codecs.DEFAULT_DICT_SIZE, sample_count=codecs.DEFAULT_SAMPLE_COUNT):
         '''
-        Abbreviate a relationship or resource ID target for efficient storage
-        in the DB. Works only with a prefix/suffix split of hierarchical HTTP-like IRIs,
-        e.g. 'http://example.org/spam/eggs' becomes something like '{a23}eggs'
-        and afterward there will be an entry in the prefix map from 'a23' to 'http://example.org/spam/'
-        The map can then easily be used with str.format
+        Rewrite all the node values with a new codec, recorded in the model's metadata.
+        This is one transaction over the whole model, so run it while no other process
+        has the model open
+
+        codec - codec.ZSTD, or None to store values as is
+        level - compression level
+        train - if True train a compression dictionary from a sample of the values
+        dict_size - target size of the trained dictionary, in bytes
+        sample_count - number of values to sample, evenly through the model
         '''
-        if not isinstance(rid, str) or '/' not in rid or not iri.matches_uri_syntax(rid):
-            return rid
-        head, tail = rid.rsplit('/', 1)
-        head += '/'
-        pmap = self._db['@_abbreviations']
-        assert pmap is not None
-        #FIXME: probably called too often to do this every time
-        inv_pmap = {v: k for k, v in pmap.items()}
-        if head in inv_pmap:
-            prefix = inv_pmap[head]
-        else:
-            prefix = f'a{self._abbr_index}'
-            pmap[prefix] = head
-            self._abbr_index += 1
-            self._db['@_abbreviations'] = pmap
-        post_rid = '{' + prefix + '}' + tail.replace('{', '{{').replace('}', '}}')
-        return post_rid
-        
-    def _ensure_abbreviations(self):
-        if '@_abbreviations' not in self._db:
-            self._db['@_abbreviations'] = {}
+        with self._db.transact():
+            origins = [ origin for origin in self._db if not origin.startswith('@') ]
+            samples = None
+            if codec and train:
+                step = max(len(origins) // sample_count, 1)
+                samples = [ msgpack.dumps(self._get_node(origin), use_bin_type=True) for origin in origins[::step] ]
+            new_codec = codecs.new(codec, level, samples, dict_size)
+            for origin in origins:
+                self._db[origin] = _pack(self._get_node(origin), new_codec)
+            if new_codec.spec is None:
+                self._db.pop(CODEC_KEY, None)
+            else:
+                self._db[CODEC_KEY] = new_codec.spec
+        self._codec = new_codec
+        if self._node_cache is not None:
+            self._node_cache.invalidate()
+        return
+
+    def _refresh_terms(self):
+        '''Load any terms stored since the dictionary was last loaded, e.g. by another process'''
+        count = self._db.get(TERMS_KEY, 0)
+        known = len(self._terms.terms)
+        if count > known:
+            self._terms.extend([ self._db[f'{TERM_PREFIX}{code}'] for code in range(known, count) ])
+        return
+
+    def _add_term(self, term):
+        '''Add a new term to the IRI dictionary & store it, returning its code. Call within a transaction'''
+        #Pick up any terms added elsewhere, so as not to reuse their codes
+        self._refresh_terms()
+        code = self._terms.codes.get(term)
+        if code is None:
+            code = self._terms.append(term)
+            self._db[f'{TERM_PREFIX}{code}'] = term
+            self._db[TERMS_KEY] = len(self._terms.terms)
+        return code
+
+    def _ensure_terms(self):
+        '''
+        Load the IRI dictionary, starting one for a new model. For a model from before
+        the dictionary, return its abbreviation map, for upgrading
+        '''
+        if TERMS_KEY not in self._db:
+            if ABBREVIATIONS_KEY in self._db:
+                return self._db[ABBREVIATIONS_KEY]
+            with self._db.transact():
+                self._db[TERMS_KEY] = 0
+                #New model, so start the count too
+                self._db[COUNT_KEY] = 0
+        self._refresh_terms()
+        return None
+
+    def _upgrade(self, abbrevs):
+        '''
+        Rewrite the nodes of a model from before the IRI dictionary, with rels & IRI
+        targets encoded, rather than abbreviated. Targets which were abbreviated
+        become I objects, being IRIs by their syntax. Return True if the model had
+        reverse indexes, which are then rebuilt
+        '''
+        terms = self._terms
+        try:
+            with self._db.transact():
+                self._db[TERMS_KEY] = 0
+                for origin in [ origin for origin in self._db if not origin.startswith('@') ]:
+                    node = {}
+                    for xrel, xtargetplus in self._get_node(origin).items():
+                        rel = terms.encode_rel(str(expand_legacy(xrel, abbrevs)), self._add_term)
+                        node.setdefault(rel, []).extend( (terms.encode_target(expand_legacy(xtarget, abbrevs), self._add_term), xattrs)
+                                                            for xtarget, xattrs in xtargetplus )
+                    self._put_node(origin, node)
+                reindex = self._db.pop(INDEXES_KEY, None) is not None
+                del self._db[ABBREVIATIONS_KEY]
+        except BaseException:
+            terms.clear()
+            raise
+        return reindex
+
+    def _ensure_codec(self, codec):
+        '''Return the model's codec for node values, recording the requested one for a new model'''
+        stored = self._db.get(CODEC_KEY)
+        if stored is not None:
+            stored = codecs.from_spec(stored)
+            if codec and codec != stored.spec['name']:
+                raise ValueError(f'Model values use the {stored.spec["name"]} codec, not {codec}. Use recompress() to change it')
+            return stored
+        if codec and self._db.get(COUNT_KEY) == 0:
+            #New model
+            new_codec = codecs.new(codec)
+            self._db[CODEC_KEY] = new_codec.spec
+            return new_codec
+        if codec:
+            raise ValueError(f'Model values are stored as is, not with the {codec} codec. Use recompress() to change it')
+        return codecs.plain_codec()
+
+    def _ensure_reverse_indexes(self, requested):
+        '''Set up the reverse indexes if the model has them, or if requested, building them if need be'''
+        if INDEXES_KEY not in self._db and not requested:
+            self._targets = self._rels = None
+            return
+        self._targets = Index(os.path.join(self._dbdir, TARGETS_INDEX))
+        self._rels = Index(os.path.join(self._dbdir, RELS_INDEX))
+        if INDEXES_KEY not in self._db:
+            with self._db.transact():
+                #Replace anything left from before the model was cleared
+                self._targets.clear()
+                self._rels.clear()
+                nodes = {}
+                for origin in self._db:
+                    if not origin.startswith('@'):
+                        nodes[origin] = self._get_node(origin)
+                        if len(nodes) >= DEFAULT_BATCH_SIZE:
+                            self._index_links(nodes)
+                            nodes = {}
+                self._index_links(nodes)
+                self._db[INDEXES_KEY] = True
         return
         
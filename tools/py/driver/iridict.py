@@ -0,0 +1,145 @@
+'''
+Dictionary encoding of IRIs for the key/value drivers (lmdb, diskcache, mongo)
+
+Each model has a list of terms, only ever appended to, so a term's integer code
+is its position. Rels are stored as the code of the full rel IRI. Targets which
+are IRI references, i.e. I objects, are stored as [code of the IRI head, tail],
+e.g. I('http://example.org/spam/eggs') as [3, 'eggs'] if term 3 is
+'http://example.org/spam/'. Any other target is a literal, stored as is, so a
+literal never needs escaping and is never mistaken for an IRI, however it looks.
+
+Decoding is a list lookup, and matching can compare values as stored, with
+patterns encoded once up front.
+
+>>> from versa import I
+>>> from versa.driver.iridict import term_dictionary
+>>> d = term_dictionary()
+>>> d.encode_rel('http://example.org/rel', add=d.append)
+0
+>>> d.encode_target(I('http://example.org/spam/eggs'), add=d.append)
+[1, 'eggs']
+>>> d.encode_target('{braces}')
+'{braces}'
+>>> d.decode_target([1, 'eggs'])
+I(http://example.org/spam/eggs)
+'''
+
+import re
+
+from versa import I
+
+#Values abbreviated by earlier versions of the drivers, e.g. '{a23}eggs'
+LEGACY_ABBREVIATION = re.compile(r'\{(a\d+)\}(.*)', re.S)
+
+
+def _iri(value):
+    #Checked when first stored, so skip I's syntax check
+    return str.__new__(I, value)
+
+
+def hashable(value):
+    '''Stored value in a form usable in sets & as dict keys, e.g. for sets of targets'''
+    return tuple(value) if isinstance(value, list) else value
+
+
+class term_dictionary(object):
+    '''
+    In-process copy of a model's term list, with the inverse mapping from term to
+    code. Drivers keep it in step with what's stored
+    '''
+    def __init__(self, terms=()):
+        self.terms = []
+        self.codes = {}
+        self.extend(terms)
+
+    def extend(self, terms):
+        '''Append terms, e.g. as loaded from the stored list'''
+        for term in terms:
+            self.codes[term] = len(self.terms)
+            self.terms.append(term)
+        return
+
+    def append(self, term):
+        '''Append a term, returning its code'''
+        self.extend([term])
+        return self.codes[term]
+
+    def clear(self):
+        self.terms, self.codes = [], {}
+
+    def truncate(self, count):
+        '''Drop the terms from code count on, e.g. those added by a write which was rolled back'''
+        for term in self.terms[count:]:
+            del self.codes[term]
+        del self.terms[count:]
+        return
+
+    def encode_rel(self, rel, add=None):
+        '''
+        Return the code for a rel, or None if it's not in the dictionary
+
+        add - (optional) function to call with a missing term, which adds it to the
+            dictionary (and the model) & returns its code
+        '''
+        code = self.codes.get(rel)
+        if code is None and add is not None:
+            code = add(rel)
+        return code
+
+    def encode_target(self, target, add=None):
+        '''
+        Return a target as stored, [code, tail] for an I, otherwise the literal itself.
+        None if the IRI head is not in the dictionary
+
+        add - (optional) as for encode_rel
+        '''
+        if not isinstance(target, I):
+            return target
+        head, sep, tail = target.rpartition('/')
+        head += sep
+        code = self.codes.get(head)
+        if code is None:
+            if add is None:
+                return None
+            code = add(head)
+        return [code, tail]
+
+    def target_forms(self, target):
+        '''
+        Return the stored forms which a target in a pattern matches. As elsewhere in
+        Versa, a string matches an I with the same value, and vice versa
+        '''
+        forms = [str(target)] if isinstance(target, I) else [target]
+        if isinstance(target, str):
+            encoded = self.encode_target(_iri(target))
+            if encoded is not None:
+                forms.append(encoded)
+        return forms
+
+    def decode_rel(self, code):
+        '''Return the rel for a code. Raises IndexError if it's not (yet) in the dictionary'''
+        return self.terms[code]
+
+    def decode_target(self, value):
+        '''Return a target from its stored form. Raises IndexError if its code isn't (yet) in the dictionary'''
+        if isinstance(value, (list, tuple)):
+            return _iri(self.terms[value[0]] + value[1])
+        return value
+
+
+def expand_legacy(value, abbrevs, escaped=True):
+    '''
+    Expand a value abbreviated by an earlier version of a driver, in the '{a23}tail' form,
+    to an I. Any other value is returned as is
+
+    abbrevs - the model's map from abbreviation (e.g. 'a23') to IRI head
+    escaped - True if braces in the tail were doubled
+    '''
+    if isinstance(value, str):
+        match = LEGACY_ABBREVIATION.fullmatch(value)
+        if match and match.group(1) in abbrevs:
+            tail = match.group(2)
+            if escaped:
+                tail = tail.replace('{{', '{').replace('}}', '}')
+            return _iri(abbrevs[match.group(1)] + tail)
+    return value
@@ -17,6 +17,18 @@ Value is list:
     ]}
 ]
 
+That's the default, 'node' layout. In the alternative 'link' layout each link is
+a separate entry in the @_links sub-database, keyed by origin, rel code &
+a sequence number (NUL separated), with value [target, {attrname1: attrval1}].
+Adding a link is then a single put, & rel-bound matches seek straight to the
+origin & rel, rather than rewriting or decoding the origin's whole node, so it
+suits origins with very many links. The layout is chosen on creation & recorded
+in the model.
+
+Rels & IRI targets are stored dictionary encoded, as integer codes, and
+[code, tail] pairs respectively (see iridict), so a node value actually maps
+rel code to list of [target, attrs].
+
 Re use of use_bin_type=True & raw=False it's as given in the msgpack docs:
 
 >>> import msgpack
@@ -27,45 +39,212 @@ Re use of use_bin_type=True & raw=False it's as given in the msgpack docs:
 
 '''
 
+import os
+import hashlib
 import functools
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 #from itertools import groupby
 #from operator import itemgetter
 
 import lmdb
 import msgpack
 
-from amara3 import iri #for absolutize & matches_uri_syntax
-
 from versa.driver import connection_base
+from versa.driver import codec as codecs
+from versa.driver.nodecache import node_cache
+from versa.driver.iridict import term_dictionary, hashable, expand_legacy
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
 #1GB
 DEFAULT_MAP_SIZE = 1024 * 1024 * 1024
 
+#Default ceiling for growing the map when it fills up (1TB), & the growth factor
+MAX_MAP_SIZE = 1024 * 1024 * 1024 * 1024
+MAP_GROWTH = 2
+
+#Metadata key for the number of links in the model, maintained by add
+COUNT_KEY = b'@_count'
+
+#Default number of links add_many writes per transaction
+DEFAULT_BATCH_SIZE = 10000
+
+#Metadata key for the number of terms in the IRI dictionary (see iridict), each
+#stored under TERM_PREFIX & its 4 byte code
+TERMS_KEY = b'@_terms'
+TERM_PREFIX = b'@_t:'
+
+#Metadata key for the IRI prefix abbreviation map of models from before the IRI
+#dictionary, which are upgraded when opened
+ABBREVIATIONS_KEY = b'@_abbreviations'
+
+#Storage layouts, one node per origin or one entry per link
+NODE_LAYOUT = 'node'
+LINK_LAYOUT = 'link'
+
+#Metadata key for the storage layout
+LAYOUT_KEY = b'@_layout'
+
+#Metadata key for the next link sequence number, in the link layout
+SEQUENCE_KEY = b'@_seq'
+
+#Named sub-database for the link layout. Names of sub-databases are keys in
+#the main database, so they start with @ to be skipped like other metadata
+LINKS_DB = b'@_links'
+
+#Named sub-databases for the optional reverse indexes, from target to origin &
+#rel, and from rel to origin. Both are dupsort, with one value per origin (& rel)
+TARGETS_DB = b'@_targets'
+RELS_DB = b'@_rels'
+
+#Metadata key recording that the reverse indexes are maintained
+INDEXES_KEY = b'@_indexes'
+
+#Metadata key for the spec of the codec for node values, if not stored as is
+CODEC_KEY = b'@_codec'
+
+SUB_DBS = (LINKS_DB, TARGETS_DB, RELS_DB)
+MAX_DBS = 8
+
+
+def _code_bytes(code):
+    return code.to_bytes(4, 'big')
+
+
+class stored_terms(term_dictionary):
+    '''
+    In-process copy of a model's IRI dictionary. Terms are only ever appended, so
+    it's brought up to date, e.g. with terms added by another process, by loading
+    those past its length, according to the stored count
+    '''
+    def refresh(self, txn):
+        '''Load any terms stored since the dictionary was last loaded. Return True if there were some'''
+        count = txn.get(TERMS_KEY)
+        count = 0 if count is None else msgpack.loads(count)
+        if count <= len(self.terms):
+            return False
+        self.extend([ txn.get(TERM_PREFIX + _code_bytes(code)).decode('utf-8')
+                        for code in range(len(self.terms), count) ])
+        return True
+
+    def add(self, term, txn):
+        '''Add a new term & store it, within a write transaction. Return its code'''
+        #Pick up any terms added elsewhere, so as not to reuse their codes
+        self.refresh(txn)
+        code = self.codes.get(term)
+        if code is None:
+            code = self.append(term)
+            txn.put(TERM_PREFIX + _code_bytes(code), term.encode('utf-8'))
+            txn.put(TERMS_KEY, msgpack.dumps(len(self.terms)))
+        return code
+
+    def rollback(self, env):
+        '''
+        Drop the terms past those stored, i.e. added by a write transaction which was aborted.
+        Only uncommitted codes go, none of which any reader can have seen, so matches under
+        way on other connections sharing the dictionary can still decode all they find
+        '''
+        with env.begin() as txn:
+            count = txn.get(TERMS_KEY)
+        self.truncate(0 if count is None else msgpack.loads(count))
+        return
+
 
-def newmodel(dbname, baseiri=None, map_size=DEFAULT_MAP_SIZE):
+#IRI dictionaries shared by all connections in this process, by environment path
+_term_dictionaries = {}
+
+
+def newmodel(dbname, baseiri=None, map_size=DEFAULT_MAP_SIZE, layout=NODE_LAYOUT, reverse_indexes=False,
+            max_map_size=MAX_MAP_SIZE, codec=None, cache_size=0):
     '''
     Return a new, empty Versa model with lmdb back end
     Warning: if there is data already in this file, it will be erased.
     '''
     # XXX Mandate mapsize?
-    model = connection(dbname=dbname, baseiri=baseiri, clear=True, map_size=map_size)
+    model = connection(dbname=dbname, baseiri=baseiri, clear=True, map_size=map_size, layout=layout,
+                       reverse_indexes=reverse_indexes, max_map_size=max_map_size, codec=codec,
+                       cache_size=cache_size)
     return model
 
 
+def _split_link_key(key):
+    '''Return the origin (UTF-8 encoded) & the rel code from a link layout key'''
+    origin_b, rest = key.split(b'\x00', 1)
+    #The 4 byte rel code is followed by a NUL & the 8 byte sequence number
+    return origin_b, int.from_bytes(rest[:4], 'big')
+
+
+def _index_key(value, max_size):
+    '''
+    Key for a stored (encoded) target or rel in the reverse indexes. Too long
+    values are hashed, prefixed with a byte msgpack never uses
+    '''
+    key = msgpack.dumps(value, use_bin_type=True)
+    if len(key) > max_size:
+        key = b'\xc1' + hashlib.sha256(key).digest()
+    return key
+
+
+def _scan_partition(dbname, key_range, func, rel, target, attrs):
+    '''Worker for parallel_scan'''
+    model = connection(dbname=dbname, readonly=True)
+    try:
+        links = model.match(rel=rel, target=target, attrs=attrs, key_range=key_range)
+        return list(links) if func is None else func(links)
+    finally:
+        model._db_env.close()
+
+
 class connection(connection_base):
-    def __init__(self, dbname=None, baseiri=None, map_size=DEFAULT_MAP_SIZE, clear=False):
+    def __init__(self, dbname=None, baseiri=None, map_size=DEFAULT_MAP_SIZE, clear=False, layout=None, reverse_indexes=None,
+                readonly=False, max_map_size=MAX_MAP_SIZE, codec=None, cache_size=0):
         '''
-        Versa connection object built from DiskCache collection object
+        Versa connection object built from LMDB environment
+
+        layout - storage layout for a new model, NODE_LAYOUT (the default) or LINK_LAYOUT.
+            An existing model keeps the layout it was created with
+        reverse_indexes - if True maintain indexes from target to origin & rel and
+            from rel to origin, so that matches by target or rel without origin only
+            read the nodes concerned, rather than scanning the whole model. If the
+            model doesn't have them yet they're built from its links. Once a model
+            has them they're always maintained
+        readonly - open the environment read-only, e.g. in the worker processes of a
+            parallel scan. The model must already exist
+        map_size - initial size of the memory map, i.e. the most the model can hold until it's grown
+        max_map_size - ceiling for growing the map by MAP_GROWTH times whenever adding links fills it.
+            If the map can't grow any further, the add fails with lmdb.MapFullError
+        codec - codec for the node values of a new model, e.g. codec.ZSTD, or None to store them
+            as is. An existing model keeps its codec, which recompress() changes
+        cache_size - number of decoded nodes to keep in an LRU cache
+            for matches by origin, e.g. nodecache.DEFAULT_CACHE_SIZE. 0 for no cache. Only writes
+            through this connection invalidate cached nodes, so don't enable it if the model is
+            being changed elsewhere
         '''
+        if readonly and clear:
+            raise ValueError('Cannot clear a model opened read-only')
         self._dbname = dbname
-        self._db_env = lmdb.open(dbname, map_size=map_size)
-        #if clear: self._db.clear()
-        with self._db_env.begin(write=True) as txn:
-            self._ensure_abbreviations(txn)
+        self._readonly = readonly
+        self._max_map_size = max_map_size
+        self._node_cache = node_cache(cache_size) if cache_size else None
+        self._db_env = lmdb.open(dbname, map_size=map_size, max_dbs=MAX_DBS, readonly=readonly)
+        with self._db_env.begin(write=not readonly) as txn:
+            if clear:
+                for name in SUB_DBS:
+                    txn.drop(self._db_env.open_db(name, txn=txn), delete=True)
+                txn.drop(self._db_env.open_db(), delete=False)
+                _term_dictionaries.pop(os.path.abspath(dbname), None)
+            self._layout = self._ensure_layout(txn, layout)
+            self._links_db = self._open_db(txn, LINKS_DB) if self._layout == LINK_LAYOUT else None
+            self._terms = _term_dictionaries.setdefault(os.path.abspath(dbname), stored_terms())
+            legacy_abbrevs = self._ensure_terms(txn)
+            self._codec = self._ensure_codec(txn, codec)
+            self._max_key_size = self._db_env.max_key_size()
+            if legacy_abbrevs is not None:
+                reverse_indexes = self._upgrade(txn, legacy_abbrevs) or reverse_indexes
+            self._reverse_indexes = self._ensure_reverse_indexes(txn, reverse_indexes)
         #self.create_model()
         self._baseiri = baseiri
-        self._abbr_index = 0
         return
 
     def copy(self, contents=True):
@@ -80,41 +259,128 @@ class connection(connection_base):
         raise NotImplementedError
 
     def size(self):
-        '''Return the number of links in the model'''
-        count = 0
+        '''Return the number of links in the model, from the maintained count'''
         with self._db_env.begin() as txn:
-            for origin_b, nodedata in txn.cursor():
-                if origin_b.startswith(b'@'):
-                    continue
-                nodedata = msgpack.loads(nodedata, raw=False)
+            count = txn.get(COUNT_KEY)
+        if count is None:
+            #Model from before the count was kept
+            return self.recount()
+        return msgpack.loads(count)
+
+    def recount(self):
+        '''
+        Count the links in the model by scanning all the nodes, and store the
+        result as the count used by size(), e.g. to repair it
+        '''
+        count = 0
+        with self._db_env.begin(write=True) as txn:
+            for origin_b, nodedata in self._nodes(txn):
                 for rel, targetplus in nodedata.items():
                     count += len(targetplus)
+            txn.put(COUNT_KEY, msgpack.dumps(count))
         return count
-        #return  self._db_coll.count() - connection.META_ITEM_COUNT
+
+    def _add_to_count(self, txn, delta):
+        '''Adjust the stored link count, within the given write transaction'''
+        count = txn.get(COUNT_KEY)
+        if count is not None:
+            #Otherwise the next size() call recounts
+            txn.put(COUNT_KEY, msgpack.dumps(msgpack.loads(count) + delta))
+        return
 
     def __iter__(self):
-        abbrevs = self._abbreviations()
-        cursor = self._db_coll.find()
-        index = 0
-        for origin in self._db:
-            if origin.startswith('@'):
+        yield from self.match(include_ids=True)
+
+    def _indexed_origins(self, txn, rel=None, target=None):
+        '''
+        Return the origins (UTF-8 encoded, in order) of the links with the given
+        target and/or rel, as stored (encoded), according to the reverse indexes
+        '''
+        origins = set()
+        if target is not None:
+            cursor = txn.cursor(db=self._targets_db)
+            if cursor.set_key(_index_key(target, self._max_key_size)):
+                for value in cursor.iternext_dup():
+                    origin_b, rel_b = value.split(b'\x00', 1)
+                    if rel is None or int.from_bytes(rel_b, 'big') == rel:
+                        origins.add(origin_b)
+        else:
+            cursor = txn.cursor(db=self._rels_db)
+            if cursor.set_key(_index_key(rel, self._max_key_size)):
+                origins.update(cursor.iternext_dup())
+        return sorted(origins)
+
+    def _index_links(self, txn, nodes):
+        '''
+        Add links, grouped by origin, to the reverse indexes
+
+        nodes - mapping from origin (UTF-8 encoded) to list of (rel, target, attrs), as stored
+        '''
+        target_items, rel_items = set(), set()
+        for origin_b, links in nodes.items():
+            if b'\x00' in origin_b:
+                raise ValueError('Relationship origin cannot contain NUL with reverse indexes')
+            for rel, target, attrs in links:
+                target_items.add((_index_key(target, self._max_key_size), origin_b + b'\x00' + _code_bytes(rel)))
+                rel_items.add((_index_key(rel, self._max_key_size), origin_b))
+        #Links already indexed, e.g. to another target of the same rel, are skipped
+        txn.cursor(db=self._targets_db).putmulti(sorted(target_items))
+        txn.cursor(db=self._rels_db).putmulti(sorted(rel_items))
+        return
+
+    def _nodes(self, txn, origin_b=None, rel=None, key_range=None):
+        '''
+        Iterate over (origin, nodedata) for all the nodes, or just the one with the
+        given origin, UTF-8 encoded. nodedata maps each rel code to a list of [target, attrs],
+        with targets as stored (encoded). If a rel code is given nodes might be limited
+        to its links, e.g. so that the link layout can seek straight to them.
+
+        key_range - (start, end) of origins, UTF-8 encoded, to limit a scan of all
+            the nodes to, as from partitions(). None for an open end
+        '''
+        start, end = key_range or (None, None)
+        if self._layout == NODE_LAYOUT:
+            if origin_b is None:
+                extent = txn.cursor()
+                if start is not None and not extent.set_range(start):
+                    return
+            else:
+                extent = [(origin_b, txn.get(origin_b))]
+            for origin_b, nodedata in extent:
+                if end is not None and origin_b >= end:
+                    break
+                if origin_b.startswith(b'@') or nodedata is None:
+                    continue
+                yield origin_b, self._unpack(nodedata)
+            return
+
+        cursor = txn.cursor(db=self._links_db)
+        prefix = b''
+        if origin_b is not None:
+            prefix = origin_b + b'\x00'
+            if rel is not None:
+                prefix += _code_bytes(rel) + b'\x00'
+        if not cursor.set_range(prefix if start is None else max(prefix, start)):
+            return
+        curr_origin, nodedata = None, None
+        for key, value in cursor:
+            #NUL separator sorts first, so a whole origin falls on one side of end
+            if not key.startswith(prefix) or (end is not None and key >= end):
+                break
+            korigin, krel = _split_link_key(key)
+            if rel is not None and krel != rel:
                 continue
-            for rel, targetplus in self._db[origin].items():
-                try:
-                    rel = rel.format(**abbrevs)
-                except (KeyError, ValueError):
-                    pass
-                count += len(targetplus)
-                for target, attribs in targetplus:
-                    try:
-                        target = target.format(**abbrevs)
-                    except (KeyError, ValueError):
-                        pass
-                    yield index, (origin, rel, target, attribs)
-                    index += 1
+            if korigin != curr_origin:
+                if curr_origin is not None:
+                    yield curr_origin, nodedata
+                curr_origin, nodedata = korigin, {}
+            nodedata.setdefault(krel, []).append(self._unpack(value))
+        if curr_origin is not None:
+            yield curr_origin, nodedata
+        return
 
     # FIXME: Statement indices don't work sensibly without some inefficient additions. Use e.g. match for delete instead
-    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False, key_range=None):
         '''
         Iterator over relationship IDs that match a pattern of components
 
@@ -123,36 +389,41 @@ class connection(connection_base):
         target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
         include_ids - If true include statement IDs with yield values
+        key_range - (optional) (start, end) of origins, UTF-8 encoded, as from partitions(). If omitted origin isn't limited to a range
         '''
         index = 0
         with self._db_env.begin() as txn:
-            abbrevs = self._abbreviations(txn)
-            if origin is None:
-                extent = txn.cursor()
+            terms = self._terms
+            #Up to date for this transaction, so any code read from it can be decoded
+            terms.refresh(txn)
+            stored_rel = terms.encode_rel(rel) if rel else None
+            if rel and stored_rel is None:
+                #Not in the dictionary, so no such rel
+                return
+            #Compared as stored, so only the links yielded are decoded
+            forms = terms.target_forms(target) if target else None
+            if origin is not None and self._node_cache is not None and key_range is None:
+                yield from self._match_cached(txn, [origin], rel and {rel}, target and {target}, attrs, include_ids)
+                return
+            if origin is None and self._reverse_indexes and (rel or target) and key_range is None:
+                #Just the nodes with the rel or target
+                origins = set()
+                for form in (forms or [None]):
+                    origins.update(self._indexed_origins(txn, stored_rel, form))
+                extent = ( node for origin_b in sorted(origins)
+                                    for node in self._nodes(txn, origin_b, stored_rel) )
             else:
-                origin_b = origin.encode('utf-8')
-                extent = [(origin_b, txn.get(origin_b))]
+                origin_b = None if origin is None else origin.encode('utf-8')
+                extent = self._nodes(txn, origin_b, stored_rel, key_range)
 
             for origin_b, nodedata in extent:
-                if origin_b.startswith(b'@') or nodedata is None:
-                    continue
                 xorigin = origin_b.decode('utf-8')
-                nodedata = msgpack.loads(nodedata, raw=False)
                 for xrel, xtargetplus in nodedata.items():
-                    try:
-                        xrel = xrel.format(**abbrevs)
-                    except (KeyError, ValueError):
-                        pass
-                    if rel and rel != xrel:
+                    if rel and stored_rel != xrel:
                         continue
                     for xtarget, xattrs in xtargetplus:
                         index += 1
-                        # FIXME: only expand target abbrevs if of resource type?
-                        try:
-                            xtarget = xtarget.format(**abbrevs)
-                        except (KeyError, ValueError):
-                            pass
-                        if target and target != xtarget:
+                        if target and xtarget not in forms:
                             continue
                         matches = True
                         if attrs:
@@ -160,13 +431,117 @@ class connection(connection_base):
                                 if k not in xattrs or xattrs.get(k) != v:
                                     matches = False
                         if matches:
+                            link = (xorigin, terms.decode_rel(xrel), terms.decode_target(xtarget), xattrs)
                             if include_ids:
-                                yield index, (xorigin, xrel, xtarget, xattrs)
+                                yield index, link
                             else:
-                                yield xorigin, xrel, xtarget, xattrs
+                                yield link
 
         return
 
+    def _match_cached(self, txn, origins, rels, targets, attrs, include_ids):
+        '''
+        Iterator over the links from the given origins that match sets of rels & targets
+        (None for any) and attrs, from the decoded nodes in the cache
+        '''
+        index = 0
+        self._terms.refresh(txn)
+        for xorigin in origins:
+            node = self._node_cache.get(xorigin)
+            if node is None:
+                node = {}
+                for origin_b, nodedata in self._nodes(txn, xorigin.encode('utf-8')):
+                    for xrel, xtargetplus in nodedata.items():
+                        node[self._terms.decode_rel(xrel)] = [ (self._terms.decode_target(xtarget), xattrs)
+                                                                for xtarget, xattrs in xtargetplus ]
+                self._node_cache.put(xorigin, node)
+            for xrel, xtargetplus in node.items():
+                if rels and xrel not in rels:
+                    continue
+                for xtarget, xattrs in xtargetplus:
+                    index += 1
+                    if targets and xtarget not in targets:
+                        continue
+                    if attrs and any( k not in xattrs or xattrs.get(k) != v for k, v in attrs.items() ):
+                        continue
+                    #Copy, so the cached attributes can't be changed
+                    if include_ids:
+                        yield index, (xorigin, xrel, xtarget, dict(xattrs))
+                    else:
+                        yield xorigin, xrel, xtarget, dict(xattrs)
+        return
+
+    def cache_info(self):
+        '''Return the node cache's hit & miss counters, with its current & maximum size, or None if not enabled'''
+        return None if self._node_cache is None else self._node_cache.info()
+
+    def partitions(self, count):
+        '''
+        Split the model into up to count contiguous ranges of origins, each with about
+        the same number of entries, for parallel scans. Split points are sampled by
+        stepping through the keys, without reading values
+
+        Returns a list of (start, end) pairs of UTF-8 encoded origins, with None for an open end
+        '''
+        bounds = []
+        with self._db_env.begin() as txn:
+            if self._layout == NODE_LAYOUT:
+                db, entries = None, self._db_env.stat()['entries']
+            else:
+                db, entries = self._links_db, txn.stat(self._links_db)['entries']
+            step = entries // count
+            if step and count > 1:
+                cursor = txn.cursor(db=db)
+                for i, key in enumerate(cursor.iternext(keys=True, values=False)):
+                    if not i or i % step:
+                        continue
+                    origin_b = key if db is None else _split_link_key(key)[0]
+                    if not bounds or origin_b > bounds[-1]:
+                        bounds.append(origin_b)
+                        if len(bounds) == count - 1:
+                            break
+        edges = [None] + bounds + [None]
+        return list(zip(edges, edges[1:]))
+
+    def parallel_scan(self, func=None, partitions=None, rel=None, target=None, attrs=None, max_workers=None, mp_context=None):
+        '''
+        Match links partition by partition across worker processes, each of which
+        opens the environment read-only, e.g. to spread the decoding of a full model
+        export or analysis over the cores
+
+        func - (optional) picklable function, e.g. module level, called in the worker with an
+            iterator over the matching links of a partition, returning a picklable result.
+            If omitted the result is the list of matching links
+        partitions - (optional) list of key ranges, as from partitions(), or number of them.
+            If omitted one per worker
+        rel, target, attrs - (optional) pattern to match, as for match
+        max_workers, mp_context - (optional) passed on to ProcessPoolExecutor. The default
+            context is spawn, since LMDB environments mustn't be used across fork()
+
+        Returns the list of results, one for each partition, in order
+        '''
+        max_workers = max_workers or os.cpu_count() or 1
+        if partitions is None or isinstance(partitions, int):
+            partitions = self.partitions(partitions or max_workers)
+        mp_context = mp_context or multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            futures = [ executor.submit(_scan_partition, self._dbname, key_range, func, rel, target, attrs)
+                            for key_range in partitions ]
+            return [ f.result() for f in futures ]
+
+    def count(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the number of links that match a pattern of components, as for match.
+        With just the origin bound, links are counted without decoding them
+        '''
+        if origin and not (rel or target or attrs):
+            with self._db_env.begin() as txn:
+                return sum( len(targetplus) for origin_b, nodedata in self._nodes(txn, origin.encode('utf-8'))
+                                                for targetplus in nodedata.values() )
+        if not (origin or rel or target or attrs):
+            return self.size()
+        return super().count(origin, rel, target, attrs)
+
     def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
         Iterator over relationship IDs that match a pattern of components, with multiple options provided for each component
@@ -177,27 +552,59 @@ class connection(connection_base):
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
         include_ids - If true include statement IDs with yield values
         '''
-        raise NotImplementedError
         origin = origin if origin is None or isinstance(origin, set) else set([origin])
         rel = rel if rel is None or isinstance(rel, set) else set([rel])
         target = target if target is None or isinstance(target, set) else set([target])
-        for index, curr_rel in enumerate(self._relationships):
-            matches = True
-            if origin and curr_rel[ORIGIN] not in origin:
-                matches = False
-            if rel and curr_rel[RELATIONSHIP] not in rel:
-                matches = False
-            if target and curr_rel[TARGET] not in target:
-                matches = False
-            if attrs:
-                for k, v in attrs.items():
-                    if k not in curr_rel[ATTRIBUTES] or curr_rel[ATTRIBUTES].get(k) != v:
-                        matches = False
-            if matches:
-                if include_ids:
-                    yield index, (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
-                else:
-                    yield (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+        index = 0
+        with self._db_env.begin() as txn:
+            if origin and self._node_cache is not None:
+                yield from self._match_cached(txn, sorted(origin), rel, target, attrs, include_ids)
+                return
+            terms = self._terms
+            terms.refresh(txn)
+            stored_rels = rel and set( code for code in map(terms.encode_rel, rel) if code is not None )
+            if rel and not stored_rels:
+                return
+            #Compared as stored, in hashable form
+            forms = target and set( hashable(form) for value in target for form in terms.target_forms(value) )
+            #With just one rel the link layout can seek straight to its links
+            stored_rel = next(iter(stored_rels)) if rel and len(stored_rels) == 1 else None
+            if origin:
+                origins = sorted( o.encode('utf-8') for o in origin )
+            elif self._reverse_indexes and (rel or target):
+                origins = set()
+                for stored in (forms or stored_rels):
+                    origins.update(self._indexed_origins(txn, target=stored) if target
+                                    else self._indexed_origins(txn, rel=stored))
+                origins = sorted(origins)
+            else:
+                origins = None
+            if origins is None:
+                extent = self._nodes(txn, rel=stored_rel)
+            else:
+                #Seeks in key order, each node read & decoded once
+                extent = ( node for origin_b in origins for node in self._nodes(txn, origin_b, stored_rel) )
+
+            for origin_b, nodedata in extent:
+                xorigin = origin_b.decode('utf-8')
+                for xrel, xtargetplus in nodedata.items():
+                    if rel and xrel not in stored_rels:
+                        continue
+                    for xtarget, xattrs in xtargetplus:
+                        index += 1
+                        if target and hashable(xtarget) not in forms:
+                            continue
+                        matches = True
+                        if attrs:
+                            for k, v in attrs.items():
+                                if k not in xattrs or xattrs.get(k) != v:
+                                    matches = False
+                        if matches:
+                            link = (xorigin, terms.decode_rel(xrel), terms.decode_target(xtarget), xattrs)
+                            if include_ids:
+                                yield index, link
+                            else:
+                                yield link
         return
 
     def add(self, origin, rel, target, attrs=None):
@@ -215,20 +622,10 @@ class connection(connection_base):
             raise ValueError('Relationship ID cannot be null')
 
         attrs = attrs or {}
-
-        with self._db_env.begin(write=True) as txn:
-            rel = self._abbreviate(rel, txn)
-            target = self._abbreviate(target, txn)
-            nodedata = txn.get(origin.encode('utf-8'))
-            if nodedata is None:
-                nodedata = {rel: [[target, attrs]]}
-            else:
-                nodedata = msgpack.loads(nodedata, raw=False)
-                nodedata.setdefault(rel, []).append([target, attrs])
-            txn.put(origin.encode('utf-8'), msgpack.dumps(nodedata, use_bin_type=True))
+        self._add_batch([(origin, rel, target, attrs)])
         return
 
-    def add_many(self, rels):
+    def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE, append=False):
         '''
         Add a list of relationships to the extent
 
@@ -241,7 +638,16 @@ class connection(connection_base):
         rel - type IRI of the relationship (similar to an RDF predicate)
         target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+
+        batch_size - number of links to write per transaction. Within each batch the
+            links are grouped by origin, so each node is read & written once. If a batch
+            fails, earlier ones stay committed
+        append - if True, the links are sorted by origin (as UTF-8 bytes) and all the
+            origins sort after those already in the model, so the nodes can be appended
+            to the database without searching it. Ignored in the link layout, which
+            never has to read existing links to add more
         '''
+        batch = []
         for curr_rel in rels:
             attrs = {}
             if len(curr_rel) == 3:
@@ -250,7 +656,201 @@ class connection(connection_base):
                 origin, rel, target, attrs = curr_rel
             else:
                 raise ValueError
-            self.add(origin, rel, target, attrs)
+            if not origin:
+                raise ValueError('Relationship origin cannot be null')
+            if not rel:
+                raise ValueError('Relationship ID cannot be null')
+            batch.append((origin, rel, target, attrs or {}))
+            if len(batch) >= batch_size:
+                self._add_batch(batch, append)
+                batch = []
+        if batch:
+            self._add_batch(batch, append)
+        return
+
+    def _add_batch(self, links, append=False):
+        '''Add links in one write transaction, retried if the map had to grow'''
+        while True:
+            try:
+                with self._db_env.begin(write=True) as txn:
+                    add_term = functools.partial(self._terms.add, txn=txn)
+                    nodes = {}
+                    for origin, rel, target, attrs in links:
+                        rel = self._terms.encode_rel(rel, add_term)
+                        target = self._terms.encode_target(target, add_term)
+                        nodes.setdefault(origin.encode('utf-8'), []).append((rel, target, attrs))
+                    if self._layout == NODE_LAYOUT:
+                        self._put_nodes(txn, nodes, append)
+                    else:
+                        self._put_links(txn, nodes)
+                    if self._reverse_indexes:
+                        self._index_links(txn, nodes)
+                    self._add_to_count(txn, len(links))
+                if self._node_cache is not None:
+                    self._node_cache.invalidate( link[ORIGIN] for link in links )
+                return
+            except lmdb.MapFullError:
+                self._terms.rollback(self._db_env)
+                if not self._grow_map():
+                    raise
+            except lmdb.MapResizedError:
+                #Grown by another process, so adopt its size
+                self._db_env.set_mapsize(0)
+                self._terms.rollback(self._db_env)
+            except BaseException:
+                #Aborted, so any terms just added to the in-process dictionary weren't stored
+                self._terms.rollback(self._db_env)
+                raise
+
+    def _grow_map(self):
+        '''Grow the map by MAP_GROWTH times, up to the ceiling. Return False if already there'''
+        map_size = self._db_env.info()['map_size']
+        if map_size >= self._max_map_size:
+            return False
+        self._db_env.set_mapsize(min(map_size * MAP_GROWTH, self._max_map_size))
+        return True
+
+    def stats(self):
+        '''
+        Return storage statistics for capacity planning, as a dict of:
+
+        map_size - current size of the memory map, in bytes
+        max_map_size - ceiling to which the map can grow
+        page_size - in bytes
+        used_size - in bytes, to the last page written, i.e. the size of the data file
+        data_pages - pages holding the model's data, including metadata & indexes
+        free_pages - pages freed by earlier writes and available for reuse, an estimate
+            which includes the pages of LMDB's own free list
+        entries - number of keys in the main database, i.e. nodes & metadata in the node layout
+        '''
+        info = self._db_env.info()
+        stat = self._db_env.stat()
+        page_size = stat['psize']
+        used_pages = info['last_pgno'] + 1
+        with self._db_env.begin() as txn:
+            dbstats = [stat] + [ txn.stat(db) for db in (self._links_db, self._targets_db, self._rels_db)
+                                                if db is not None ]
+        data_pages = sum( s['branch_pages'] + s['leaf_pages'] + s['overflow_pages'] for s in dbstats )
+        return {
+            'map_size': info['map_size'],
+            'max_map_size': self._max_map_size,
+            'page_size': page_size,
+            'used_size': used_pages * page_size,
+            'data_pages': data_pages,
+            #Less the 2 meta pages
+            'free_pages': max(used_pages - 2 - data_pages, 0),
+            'entries': stat['entries'],
+        }
+
+    def _pack(self, value):
+        '''Serialize a node value, or link value in the link layout, with the model's codec'''
+        return self._codec.encode(msgpack.dumps(value, use_bin_type=True))
+
+    def _unpack(self, data):
+        #Node values are keyed by rel code
+        return msgpack.loads(self._codec.decode(data), raw=False, strict_map_key=False)
+
+    def _values(self, txn):
+        '''Cursor & iterator over (key, value) for the stored node values, or link values in the link layout'''
+        if self._layout == NODE_LAYOUT:
+            cursor = txn.cursor()
+            return cursor, ( (key, value) for key, value in cursor if not key.startswith(b'@') )
+        cursor = txn.cursor(db=self._links_db)
+        return cursor, iter(cursor)
+
+    def recompress(self, codec=codecs.ZSTD, level=codecs.DEFAULT_LEVEL, train=True,
+                    dict_size=codecs.DEFAULT_DICT_SIZE, sample_count=codecs.DEFAULT_SAMPLE_COUNT):
+        '''
+        Rewrite all the node values (link values in the link layout) with a new codec,
+        recorded in the model's metadata. This is one write transaction over the
+        whole model, so run it while no other process has the model open
+
+        codec - codec.ZSTD, or None to store values as is
+        level - compression level
+        train - if True train a compression dictionary from a sample of the values
+        dict_size - target size of the trained dictionary, in bytes
+        sample_count - number of values to sample, evenly through the model
+        '''
+        while True:
+            try:
+                with self._db_env.begin(write=True) as txn:
+                    samples = None
+                    if codec and train:
+                        entries = self._db_env.stat()['entries'] if self._layout == NODE_LAYOUT else txn.stat(self._links_db)['entries']
+                        step = max(entries // sample_count, 1)
+                        cursor, values = self._values(txn)
+                        samples = [ self._codec.decode(value) for i, (key, value) in enumerate(values) if not i % step ]
+                    new_codec = codecs.new(codec, level, samples, dict_size)
+                    #LMDB only merges pages on delete, so rather than overwrite values in place,
+                    #delete & put them back a batch at a time, for pages as full as a fresh load
+                    db = None if self._layout == NODE_LAYOUT else self._links_db
+                    start = b''
+                    while True:
+                        cursor, values = self._values(txn)
+                        if start and not cursor.set_range(start):
+                            break
+                        batch = [ (key, new_codec.encode(self._codec.decode(value)))
+                                    for key, value in itertools.islice(values, DEFAULT_BATCH_SIZE) ]
+                        if not batch:
+                            break
+                        for key, value in batch:
+                            txn.delete(key, db=db)
+                        txn.cursor(db=db).putmulti(batch)
+                        start = batch[-1][0] + b'\x00'
+                    if new_codec.spec is None:
+                        txn.delete(CODEC_KEY)
+                    else:
+                        txn.put(CODEC_KEY, msgpack.dumps(new_codec.spec, use_bin_type=True))
+                break
+            except lmdb.MapFullError:
+                if not self._grow_map():
+                    raise
+        self._codec = new_codec
+        if self._node_cache is not None:
+            self._node_cache.invalidate()
+        return
+
+    def _put_nodes(self, txn, nodes, append=False):
+        '''
+        Merge links, grouped by origin, into the nodes of the node layout, each read & written once
+
+        nodes - mapping from origin (UTF-8 encoded) to list of (rel, target, attrs), as stored
+        '''
+        items = []
+        for i, origin_b in enumerate(sorted(nodes)):
+            #When appending, only the first origin can already be present, carried over from the last batch
+            nodedata = txn.get(origin_b) if (i == 0 or not append) else None
+            nodedata = {} if nodedata is None else self._unpack(nodedata)
+            for rel, target, attrs in nodes[origin_b]:
+                nodedata.setdefault(rel, []).append([target, attrs])
+            items.append((origin_b, self._pack(nodedata)))
+        if append and items and txn.get(items[0][0]) is not None:
+            #Replace the carried over node, then append the rest
+            txn.put(*items.pop(0))
+        consumed, added = txn.cursor().putmulti(items, append=append)
+        if added != len(items):
+            raise ValueError('Links for append must be sorted by origin, after those in the model')
+        return
+
+    def _put_links(self, txn, nodes):
+        '''
+        Add links, grouped by origin, as separate entries in the link layout
+
+        nodes - mapping from origin (UTF-8 encoded) to list of (rel, target, attrs), as stored
+        '''
+        seq = txn.get(SEQUENCE_KEY)
+        seq = 0 if seq is None else int.from_bytes(seq, 'big')
+        items = []
+        for origin_b, links in nodes.items():
+            if b'\x00' in origin_b:
+                raise ValueError('Relationship origin cannot contain NUL in the link layout')
+            for rel, target, attrs in links:
+                key = origin_b + b'\x00' + _code_bytes(rel) + b'\x00' + seq.to_bytes(8, 'big')
+                items.append((key, self._pack([target, attrs])))
+                seq += 1
+        items.sort()
+        txn.cursor(db=self._links_db).putmulti(items)
+        txn.put(SEQUENCE_KEY, seq.to_bytes(8, 'big'))
         return
 
     #FIXME: Replace with a match_to_remove method
@@ -275,41 +875,154 @@ class connection(connection_base):
     def __eq__(self, other):
         return repr(other) == repr(self)
 
-    def _abbreviations(self, txn):
-        prefix_map = txn.get(b'@_abbreviations')
-        prefix_map = msgpack.loads(prefix_map, raw=False)
-        return prefix_map
-        
-    def _abbreviate(self, rid, txn):
-        '''
-        Abbreviate a relationship or resource ID target for efficient storage
-        in the DB. Works only with a prefix/suffix split of hierarchical HTTP-like IRIs,
-        e.g. 'http://example.org/spam/eggs' becomes something like '{a23}eggs'
-        and afterward there will be an entry in the prefix map from 'a23' to 'http://example.org/spam/'
-        The map can then easily be used with str.format
-        '''
-        if not isinstance(rid, str) or '/' not in rid or not iri.matches_uri_syntax(rid):
-            return rid
-        head, tail = rid.rsplit('/', 1)
-        head += '/'
-        prefix_map = txn.get(b'@_abbreviations')
-        assert prefix_map is not None
-        prefix_map = msgpack.loads(prefix_map, raw=False)
-        #FIXME: probably called too often to do this every time
-        inv_prefix_map = {v: k for k, v in prefix_map.items()}
-        if head in inv_prefix_map:
-            prefix = inv_prefix_map[head]
+    def _ensure_layout(self, txn, layout):
+        '''Return the model's storage layout, recording the requested one for a new model'''
+        stored = txn.get(LAYOUT_KEY)
+        if stored is not None:
+            stored = stored.decode('utf-8')
+        elif txn.get(ABBREVIATIONS_KEY) is not None:
+            #Existing model from before the layout was recorded
+            stored = NODE_LAYOUT
+        if stored is not None:
+            if layout and layout != stored:
+                raise ValueError(f'Model was created with the {stored} layout, not {layout}')
+            layout = stored
         else:
-            prefix = f'a{self._abbr_index}'
-            prefix_map[prefix] = head
-            self._abbr_index += 1
-            txn.put(b'@_abbreviations', msgpack.dumps(prefix_map, use_bin_type=True))
-        post_rid = '{' + prefix + '}' + tail.replace('{', '{{').replace('}', '}}')
-        return post_rid
-        
-    def _ensure_abbreviations(self, txn):
-        txn.put(b'@_abbreviations', msgpack.dumps({}))
-        return
+            layout = layout or NODE_LAYOUT
+            if layout not in (NODE_LAYOUT, LINK_LAYOUT):
+                raise ValueError(f'Unknown storage layout: {layout}')
+        if not self._readonly:
+            txn.put(LAYOUT_KEY, layout.encode('utf-8'))
+        return layout
+
+    def _ensure_codec(self, txn, codec):
+        '''Return the model's codec for node values, recording the requested one for a new model'''
+        stored = txn.get(CODEC_KEY)
+        if stored is not None:
+            stored = codecs.from_spec(msgpack.loads(stored, raw=False))
+            if codec and codec != stored.spec['name']:
+                raise ValueError(f'Model values use the {stored.spec["name"]} codec, not {codec}. Use recompress() to change it')
+            return stored
+        count = txn.get(COUNT_KEY)
+        if codec and not self._readonly and count is not None and msgpack.loads(count) == 0:
+            #New model
+            new_codec = codecs.new(codec)
+            txn.put(CODEC_KEY, msgpack.dumps(new_codec.spec, use_bin_type=True))
+            return new_codec
+        if codec:
+            raise ValueError(f'Model values are stored as is, not with the {codec} codec. Use recompress() to change it')
+        return codecs.plain_codec()
+
+    def _open_db(self, txn, name, **kwargs):
+        '''Open a named sub-database, created if need be unless the model is read-only'''
+        if self._readonly:
+            #A handle opened in a read transaction is lost when it ends, so use one of its own
+            return self._db_env.open_db(name, create=False, **kwargs)
+        return self._db_env.open_db(name, txn=txn, **kwargs)
+
+    def _ensure_reverse_indexes(self, txn, requested):
+        '''Set up the reverse indexes if the model has them, or if requested, building them if need be'''
+        if txn.get(INDEXES_KEY) is None and not requested:
+            self._targets_db = self._rels_db = None
+            return False
+        if txn.get(INDEXES_KEY) is None and self._readonly:
+            raise ValueError('Cannot build reverse indexes in a model opened read-only')
+        self._targets_db = self._open_db(txn, TARGETS_DB, dupsort=True)
+        self._rels_db = self._open_db(txn, RELS_DB, dupsort=True)
+        if txn.get(INDEXES_KEY) is None:
+            for origin_b, nodedata in self._nodes(txn):
+                self._index_links(txn, { origin_b: [ (rel, target, attrs) for rel, targetplus in nodedata.items()
+                                                                           for target, attrs in targetplus ] })
+            txn.put(INDEXES_KEY, b'1')
+        return True
+
+    def _ensure_terms(self, txn):
+        '''
+        Load the IRI dictionary, starting one for a new model. For a model from before
+        the dictionary, return its abbreviation map, for upgrading
+        '''
+        if txn.get(TERMS_KEY) is None:
+            legacy_abbrevs = txn.get(ABBREVIATIONS_KEY)
+            if legacy_abbrevs is not None:
+                if self._readonly:
+                    raise ValueError('Model is from an earlier version & must be opened writable once, to upgrade it')
+                return msgpack.loads(legacy_abbrevs, raw=False)
+            if not self._readonly:
+                txn.put(TERMS_KEY, msgpack.dumps(0))
+                #New model, so start the count too
+                txn.put(COUNT_KEY, msgpack.dumps(0))
+        self._terms.refresh(txn)
+        return None
+
+    def _upgrade(self, txn, abbrevs):
+        '''
+        Rewrite the links of a model from before the IRI dictionary, with rels & IRI
+        targets encoded, rather than abbreviated. Targets which were abbreviated
+        become I objects, being IRIs by their syntax. Return True if the model had
+        reverse indexes, which are then rebuilt
+        '''
+        terms = self._terms
+        add_term = functools.partial(terms.add, txn=txn)
+
+        def encode(xrel, xtarget):
+            return (terms.encode_rel(str(expand_legacy(xrel, abbrevs)), add_term),
+                    terms.encode_target(expand_legacy(xtarget, abbrevs), add_term))
+
+        try:
+            terms.clear()
+            txn.put(TERMS_KEY, msgpack.dumps(0))
+            if self._layout == NODE_LAYOUT:
+                start = b''
+                while True:
+                    cursor, values = self._values(txn)
+                    if start and not cursor.set_range(start):
+                        break
+                    batch = list(itertools.islice(values, DEFAULT_BATCH_SIZE))
+                    if not batch:
+                        break
+                    for key, value in batch:
+                        nodedata = {}
+                        for xrel, xtargetplus in self._unpack(value).items():
+                            for xtarget, xattrs in xtargetplus:
+                                rel, target = encode(xrel, xtarget)
+                                nodedata.setdefault(rel, []).append([target, xattrs])
+                        txn.put(key, self._pack(nodedata))
+                    start = batch[-1][0] + b'\x00'
+            else:
+                #Keys change with the rels, so rewrite an origin's links at a time
+                cursor = txn.cursor(db=self._links_db)
+                start = b''
+                while cursor.set_range(start):
+                    origin_b = cursor.key().split(b'\x00', 1)[0]
+                    prefix = origin_b + b'\x00'
+                    old = []
+                    for key, value in cursor:
+                        if not key.startswith(prefix):
+                            break
+                        old.append((key, value))
+                    items = []
+                    for key, value in old:
+                        txn.delete(key, db=self._links_db)
+                        #The rel is followed by a NUL & the 8 byte sequence number
+                        xrel, seq = key[len(prefix):-9], key[-8:]
+                        xtarget, xattrs = self._unpack(value)
+                        rel, target = encode(xrel.decode('utf-8'), xtarget)
+                        items.append((prefix + _code_bytes(rel) + b'\x00' + seq, self._pack([target, xattrs])))
+                    items.sort()
+                    txn.cursor(db=self._links_db).putmulti(items)
+                    cursor = txn.cursor(db=self._links_db)
+                    #Past all the keys of this origin
+                    start = origin_b + b'\x01'
+            reindex = txn.get(INDEXES_KEY) is not None
+            if reindex:
+                for name in (TARGETS_DB, RELS_DB):
+                    txn.drop(self._db_env.open_db(name, txn=txn), delete=False)
+                txn.delete(INDEXES_KEY)
+            txn.delete(ABBREVIATIONS_KEY)
+        except BaseException:
+            terms.clear()
+            raise
+        return reindex
 
     def __del__(self):
         #self._db_env.close()
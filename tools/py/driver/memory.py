@@ -12,62 +12,363 @@ The optional attributes are metadata bound to the statement itself
 #Note: for PyPy support port to pg8000 <http://pybrary.net/pg8000/>
 #Reportedly PyPy/pg8000 is faster than CPython/psycopg2
 
+import bisect
 import logging
 import functools
+import itertools
+import weakref
 #from itertools import groupby
 #from operator import itemgetter
 from amara3 import iri #for absolutize & matches_uri_syntax
 
 from versa.driver import connection_base
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
+from versa import util
+
+#Fewest removed links for which compaction is triggered automatically
+COMPACT_MIN_REMOVED = 1024
+
+
+def _sortkey(value):
+    '''
+    Key for ordering a component value in the sorted indexes. Strings (including I)
+    order as themselves, and other values are grouped by type after a NUL prefix.
+    Range scans still check each candidate link against the actual values.
+    '''
+    if isinstance(value, str):
+        return value
+    return '\x00{0}\x00{1!r}'.format(value.__class__.__name__, value)
+
+
+def _tracked(method):
+    '''
+    Decorator for generator methods which yield link IDs. While any are running the
+    model counts them as open, and doesn't compact automatically, which would renumber
+    the links under them
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._iterators += 1
+        try:
+            yield from method(self, *args, **kwargs)
+        finally:
+            self._iterators -= 1
+    return wrapper
+
+
+class _maxkey(object):
+    '''Sorts after any index key, to find the upper bound of range scans'''
+    def __lt__(self, other): return False
+    def __gt__(self, other): return True
+
+_MAXKEY = _maxkey()
+
+
+class frozenattrs(dict):
+    '''
+    Read-only mapping of relationship attributes. The memory driver stores
+    attributes this way, so it can hand them out without copying.
+    copy() returns a regular, mutable dict.
+    '''
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Relationship attributes from the model are read-only. Use copy() to get a mutable version')
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (frozenattrs, (dict(self),))
+
+#Shared by all links without attributes
+EMPTY_ATTRS = frozenattrs()
+
+
+def freeze_attrs(attrs):
+    '''Return a read-only version of a relationship attribute mapping, sharing it if it already is'''
+    if not attrs:
+        return EMPTY_ATTRS
+    return attrs if isinstance(attrs, frozenattrs) else frozenattrs(attrs)
+
+
+def _release_share(holder):
+    '''Finalizer of a model, which no longer counts among the sharers of its storage'''
+    holder[0][0] -= 1
 
 
 class connection(connection_base):
-    def __init__(self, baseiri=None, attr_cls=dict):
+    def __init__(self, baseiri=None, attr_cls=dict, sorted_indexes=False, copy_attrs=False, compact_threshold=0.5, attr_index=False):
         '''
         Initialize connection object
             
         Args:
             baseiri: IRI used by default to resolve relative IRIs
-            attr_cls: class used to hold relationship attributes. By default use dict
+            attr_cls: class of the relationship attributes in links yielded with
+                copy_attrs, and in the model's repr. Attributes are stored as read-only
+                frozenattrs mappings regardless. Any class other than dict, e.g.
+                OrderedDict, turns on copy_attrs, so that links come with it
+            sorted_indexes: if True also maintain sorted permutation indexes
+                (origin-rel-target, rel-target-origin & target-origin-rel), so that
+                match yields links in order of the index that fits the bound components,
+                e.g. all links sorted by origin if none are bound
+            copy_attrs: if True yield links with a mutable copy (of attr_cls) of their
+                attributes. By default yield the stored, read-only frozenattrs mapping
+            compact_threshold: removed links are only marked (tombstoned), so that the
+                indices of the rest stay stable. Once at least this proportion of link
+                slots (and at least COMPACT_MIN_REMOVED) are tombstones, remove()
+                compacts the model, renumbering the links. Not while any match or
+                iteration over the model is still running though, since it would
+                renumber the IDs they yield, in which case the next remove() or add()
+                after they're done compacts it. If None only compact when compact()
+                is called.
+            attr_index: if True also maintain an index from each (attribute name, value)
+                pair to the links which have it, so that matching on attrs needn't check
+                every link otherwise matched. Attribute values which aren't hashable
+                aren't indexed, and patterns using them are checked link by link
         '''
         self._attr_cls = attr_cls
+        self._copy_attrs = copy_attrs or attr_cls is not dict
+        self._compact_threshold = compact_threshold
+        self.sorted_indexes = sorted_indexes
+        self.attr_index = attr_index
+        self._readonly = False
+        # Number of iterators over the model still running (see _tracked)
+        self._iterators = 0
         self.create_space()
         self._baseiri = baseiri
         self._id_counter = 1
         return
 
     def copy(self, contents=True):
-        '''Create a copy of this model, optionally without contents (i.e. just configuration)'''
-        cp = connection(self._baseiri, self._attr_cls)
-        if contents: cp.add_many(self._relationships)
+        '''
+        Create a copy of this model, optionally without contents (i.e. just configuration)
+
+        The copy shares storage with this model until either of them changes, at
+        which point the one being changed takes its own copy (copy-on-write)
+        '''
+        cp = connection(self._baseiri, self._attr_cls, self.sorted_indexes, self._copy_attrs, self._compact_threshold, self.attr_index)
+        if contents: self._share(cp)
 
         return cp
 
+    def snapshot(self):
+        '''
+        Return a read-only view of the model as it is now, in O(1). Later
+        changes to this model don't affect readers of the snapshot.
+        '''
+        snap = self.copy(contents=False)
+        self._share(snap)
+        snap._readonly = True
+        return snap
+
+    # Attributes holding the model contents, which copies can share
+    _STORAGE = ('_relationships', '_removed', '_fingerprint', '_origin_index', '_rel_index', '_target_index', '_attr_postings', '_spo', '_pos', '_osp')
+
+    def _share(self, other):
+        '''Have another model share this one's storage, copy-on-write'''
+        for name in self._STORAGE:
+            setattr(other, name, getattr(self, name))
+        self._sharers[0] += 1
+        other._set_sharers(self._sharers)
+        return
+
+    def _set_sharers(self, sharers):
+        '''
+        Count this model among the sharers of storage, rather than of any it shared before.
+        Once it's garbage collected it no longer counts, so e.g. after a copy which is
+        gone the original needn't unshare to write
+        '''
+        holder = getattr(self, '_sharers_holder', None)
+        if holder is None:
+            holder = self._sharers_holder = [sharers]
+            weakref.finalize(self, _release_share, holder)
+        elif holder[0] is not sharers:
+            holder[0][0] -= 1
+            holder[0] = sharers
+        self._sharers = sharers
+        return
+
+    def _unshare(self):
+        '''Take a private copy of storage shared with other models'''
+        self._set_sharers([1])
+        self._relationships = self._relationships.copy()
+        self._origin_index = { k: v.copy() for k, v in self._origin_index.items() }
+        self._rel_index = { k: v.copy() for k, v in self._rel_index.items() }
+        self._target_index = { k: v.copy() for k, v in self._target_index.items() }
+        self._attr_postings = { k: v.copy() for k, v in self._attr_postings.items() }
+        self._spo, self._pos, self._osp = self._spo.copy(), self._pos.copy(), self._osp.copy()
+        return
+
+    def _writable(self):
+        '''Prepare to change the model, which mustn't be a snapshot, unsharing its storage if need be'''
+        if self._readonly:
+            raise TypeError('Model snapshots are read-only')
+        if self._sharers[0] > 1:
+            self._unshare()
+        return
+
     def create_space(self):
         '''Set up a new table space for the first time'''
+        # Links by position. Removed links are left as None (tombstones) until compaction
         self._relationships = []
+        self._removed = 0
+        # util.fingerprint of the model. Computed on demand, then kept up to date
+        self._fingerprint = None
+        # Hash indexes from each component value to its posting list, the
+        # positions of the links with that value, in ascending order. Each posting
+        # list is a dict with None values, so removal is in place, in O(1)
+        self._origin_index = {}
+        self._rel_index = {}
+        self._target_index = {}
+        # Posting lists by (attribute name, value), if attr_index is set
+        self._attr_postings = {}
+        # Sorted permutation indexes, lists of (key1, key2, key3, position)
+        self._spo = []
+        self._pos = []
+        self._osp = []
+        # If not None, sorted index entries awaiting a bulk merge
+        self._sorted_pending = None
+        # Number of models sharing the storage above, copy-on-write. Shared among them
+        self._set_sharers([1])
         self._id_counter = 1
         return
 
     def drop_space(self):
         '''Dismantle an existing table space'''
-        create_space(self)
+        self.create_space()
+        return
+
+    def _index_link(self, index, link):
+        '''Add the link at the given position to the component indexes'''
+        self._origin_index.setdefault(link[ORIGIN], {})[index] = None
+        self._rel_index.setdefault(link[RELATIONSHIP], {})[index] = None
+        self._target_index.setdefault(link[TARGET], {})[index] = None
+        if self.attr_index:
+            for item in link[ATTRIBUTES].items():
+                try:
+                    self._attr_postings.setdefault(item, {})[index] = None
+                except TypeError:
+                    #Unhashable value, so not indexed
+                    pass
+        if self.sorted_indexes:
+            o, r, t = _sortkey(link[ORIGIN]), _sortkey(link[RELATIONSHIP]), _sortkey(link[TARGET])
+            if self._sorted_pending is not None:
+                self._sorted_pending.append((o, r, t, index))
+            else:
+                bisect.insort(self._spo, (o, r, t, index))
+                bisect.insort(self._pos, (r, t, o, index))
+                bisect.insort(self._osp, (t, o, r, index))
+        return
+
+    def _merge_sorted(self, entries):
+        '''Add a batch of origin-rel-target index entries to the sorted indexes, sorting once'''
+        self._spo.extend(entries)
+        self._pos.extend((r, t, o, index) for (o, r, t, index) in entries)
+        self._osp.extend((t, o, r, index) for (o, r, t, index) in entries)
+        for perm in (self._spo, self._pos, self._osp):
+            perm.sort()
+        return
+
+    def _reindex(self):
+        '''Rebuild the component indexes, e.g. after link positions have shifted'''
+        self._origin_index = {}
+        self._rel_index = {}
+        self._target_index = {}
+        self._attr_postings = {}
+        self._spo, self._pos, self._osp = [], [], []
+        self._sorted_pending = []
+        for index, link in enumerate(self._relationships):
+            if link is not None:
+                self._index_link(index, link)
+        pending, self._sorted_pending = self._sorted_pending, None
+        if self.sorted_indexes:
+            self._merge_sorted(pending)
         return
 
+    def _postings(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the posting lists of link positions for the bound components,
+        each of which is a set of values, plus those for the attributes if
+        attr_index is set, smallest first. Returns None if nothing is bound
+        (i.e. a full scan is needed).
+        '''
+        postings = []
+        for values, component_index in ((origin, self._origin_index), (rel, self._rel_index), (target, self._target_index)):
+            if not values:
+                continue
+            if len(values) == 1:
+                posting = component_index.get(next(iter(values)), {})
+            else:
+                #A link has only one value per component, so these are disjoint
+                posting = dict.fromkeys(sorted(itertools.chain.from_iterable(component_index.get(v, ()) for v in values)))
+            postings.append(posting)
+        if attrs and self.attr_index:
+            for item in attrs.items():
+                try:
+                    postings.append(self._attr_postings.get(item, {}))
+                except TypeError:
+                    #Unhashable value, so it's left to the caller's check
+                    pass
+        if not postings:
+            return None
+        postings.sort(key=len)
+        return postings
+
+    def _candidates(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the positions of links in all the posting lists for the bound
+        components (see _postings), or None if no component is bound. The caller
+        still checks each candidate link.
+        '''
+        postings = self._postings(origin, rel, target, attrs)
+        if postings is None:
+            return None
+        #Intersect, starting from the smallest posting list
+        smallest, rest = postings[0], postings[1:]
+        #Copied, since the posting lists can change while the caller iterates
+        return [ index for index in smallest if all(index in posting for posting in rest) ]
+
+    def _range(self, origin=None, rel=None, target=None):
+        '''
+        Return link positions in the order of the sorted index whose prefix
+        fits the bound components, via a binary search range scan
+        '''
+        if origin and target and not rel:
+            perm, prefix = self._osp, (target, origin)
+        elif origin:
+            perm, prefix = self._spo, (origin, rel, target)
+        elif rel:
+            perm, prefix = self._pos, (rel, target)
+        elif target:
+            perm, prefix = self._osp, (target,)
+        else:
+            perm, prefix = self._spo, ()
+        #Only the leading bound components form the prefix
+        prefix = tuple(_sortkey(v) for v in itertools.takewhile(bool, prefix))
+        lo = bisect.bisect_left(perm, prefix)
+        hi = bisect.bisect_left(perm, prefix + (_MAXKEY,), lo)
+        return [ entry[3] for entry in perm[lo:hi] ]
+
     def query(self, expr):
         '''Execute a Versa query'''
         raise NotImplementedError
 
     def size(self):
         '''Return the number of links in the model'''
-        return len(self._relationships)
+        return len(self._relationships) - self._removed
 
+    @_tracked
     def __iter__(self):
-        for index, rel in enumerate(self._relationships): yield index, (rel[0], rel[1], rel[2], rel[3].copy())
-
-    #FIXME: For performance make each link an iterator, so that slice/copy isn't necessary?
+        for index, rel in enumerate(self._relationships):
+            if rel is None:
+                continue
+            if self._copy_attrs:
+                rel = (rel[0], rel[1], rel[2], self._attr_cls(rel[3]))
+            #Otherwise links are tuples & their attributes read-only, so no copy is needed
+            yield index, rel
 
+    @_tracked
     def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
         Iterator over relationship IDs that match a pattern of components
@@ -78,8 +379,18 @@ class connection(connection_base):
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
         include_ids - If true include statement IDs with yield values
         '''
+        rels = self._relationships
+        if self.sorted_indexes:
+            candidates = self._range(origin, rel, target)
+        else:
+            candidates = self._candidates(origin and (origin,), rel and (rel,), target and (target,), attrs)
+        if candidates is None:
+            candidates = range(len(rels))
         #Can't use items or we risk client side RuntimeError: dictionary changed size during iteration
-        for index, curr_rel in enumerate(self._relationships):
+        for index in candidates:
+            curr_rel = rels[index]
+            if curr_rel is None:
+                continue
             matches = True
             if origin and origin != curr_rel[ORIGIN]:
                 matches = False
@@ -95,13 +406,16 @@ class connection(connection_base):
                     if k not in curr_rel[ATTRIBUTES] or curr_rel[ATTRIBUTES].get(k) != v:
                         matches = False
             if matches:
+                if self._copy_attrs:
+                    curr_rel = (curr_rel[0], curr_rel[1], curr_rel[2], self._attr_cls(curr_rel[3]))
                 if include_ids:
-                    yield index, (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                    yield index, curr_rel
                 else:
-                    yield (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                    yield curr_rel
         return
 
 
+    @_tracked
     def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
         Iterator over relationship IDs that match a pattern of components
@@ -115,8 +429,15 @@ class connection(connection_base):
         origin = origin if origin is None or isinstance(origin, set) else set([origin])
         rel = rel if rel is None or isinstance(rel, set) else set([rel])
         target = target if target is None or isinstance(target, set) else set([target])
+        rels = self._relationships
+        candidates = self._candidates(origin, rel, target, attrs)
+        if candidates is None:
+            candidates = range(len(rels))
         #Can't use items or we risk client side RuntimeError: dictionary changed size during iteration
-        for index, curr_rel in enumerate(self._relationships):
+        for index in candidates:
+            curr_rel = rels[index]
+            if curr_rel is None:
+                continue
             matches = True
             if origin and curr_rel[ORIGIN] not in origin:
                 matches = False
@@ -129,13 +450,37 @@ class connection(connection_base):
                     if k not in curr_rel[ATTRIBUTES] or curr_rel[ATTRIBUTES].get(k) != v:
                         matches = False
             if matches:
+                if self._copy_attrs:
+                    curr_rel = (curr_rel[0], curr_rel[1], curr_rel[2], self._attr_cls(curr_rel[3]))
                 if include_ids:
-                    yield index, (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                    yield index, curr_rel
                 else:
-                    yield (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                    yield curr_rel
         return
 
 
+    def count(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the number of links that match a pattern of components, as for match.
+        Unless some of attrs aren't indexed, this comes straight from the posting
+        lists, without looking at the links themselves.
+        '''
+        exact = not attrs or self.attr_index
+        if exact and attrs:
+            try:
+                hash(tuple(attrs.items()))
+            except TypeError:
+                exact = False
+        if not exact:
+            return sum(1 for link in self.match(origin, rel, target, attrs))
+        postings = self._postings(origin and (origin,), rel and (rel,), target and (target,), attrs)
+        if postings is None:
+            return self.size()
+        smallest, rest = postings[0], postings[1:]
+        if not rest:
+            return len(smallest)
+        return sum(1 for index in smallest if all(index in posting for posting in rest))
+
     def add(self, origin, rel, target, attrs=None, index=None):
         '''
         Add one relationship to the extent
@@ -148,25 +493,33 @@ class connection(connection_base):
         '''
         #FIXME: return an ID (IRI) for the resulting relationship?
 
+        self._writable()
         if not origin: 
             raise ValueError('Relationship origin cannot be null')
         if not rel: 
             raise ValueError('Relationship ID cannot be null')
 
-        # convert attribute class to the expected type
-        if type(attrs) != type(self._attr_cls):
-            attrs = self._attr_cls(attrs or {})
+        # Stored read-only, so that links can be handed out without copying
+        attrs = freeze_attrs(attrs)
 
         #No, could be an I instance, fails assertion
         #assert isinstance(origin, str) and isinstance(origin, str) and isinstance(origin, str) and isinstance(origin, dict), (origin, rel, target, attrs)
 
         item = (origin, rel, target, attrs)
+        if index is None and self._sorted_pending is None:
+            #Any compaction put off while iterators were running. Not midway through add_many's bulk indexing
+            self._auto_compact()
         if index is not None:
             rid = index
             self._relationships.insert(index, item)
+            #Positions of all subsequent links have shifted
+            self._reindex()
         else:
-            rid = self.size()
+            rid = len(self._relationships)
             self._relationships.append(item)
+            self._index_link(rid, item)
+        if self._fingerprint is not None:
+            self._fingerprint = (self._fingerprint + util.link_hash(item)) % util.FINGERPRINT_MODULUS
         return rid
 
     def add_many(self, rels):
@@ -185,6 +538,20 @@ class connection(connection_base):
 
         you can omit the dictionary of attributes if there are none, as long as you are not specifying a statement ID
         '''
+        self._writable()
+        if not self.sorted_indexes:
+            self._add_many(rels)
+            return
+        #Build up the sorted indexes in bulk at the end, rather than link by link
+        self._sorted_pending = []
+        try:
+            self._add_many(rels)
+        finally:
+            pending, self._sorted_pending = self._sorted_pending, None
+            self._merge_sorted(pending)
+        return
+
+    def _add_many(self, rels):
         for curr_rel in rels:
             attrs = self._attr_cls()
             if len(curr_rel) == 2: # handle __iter__ output for copy()
@@ -204,14 +571,69 @@ class connection(connection_base):
         Delete one or more relationship, by index, from the extent
 
         index - either a single index or a list of indices
+
+        The indices of the remaining links don't change until the model is compacted
         '''
+        self._writable()
         if hasattr(index, '__iter__'):
             ind = set(index)
         else:
             ind = [index]
 
-        # Rebuild relationships, excluding the provided indices
-        self._relationships = [r for i, r in enumerate(self._relationships) if i not in ind]
+        rels = self._relationships
+        for i in ind:
+            if 0 <= i < len(rels) and rels[i] is not None:
+                self._unindex_link(i, rels[i])
+                if self._fingerprint is not None:
+                    self._fingerprint = (self._fingerprint - util.link_hash(rels[i])) % util.FINGERPRINT_MODULUS
+                # Mark rather than delete, so the indices of other links are stable
+                rels[i] = None
+                self._removed += 1
+
+        self._auto_compact()
+        return
+
+    def _auto_compact(self):
+        '''Compact the model if enough links have been removed (see compact_threshold), unless iterators over it are running'''
+        if self._compact_threshold is None or not self._removed or self._iterators:
+            return
+        if self._removed >= max(COMPACT_MIN_REMOVED, self._compact_threshold * (self.size() + self._removed)):
+            self.compact()
+        return
+
+    def _unindex_link(self, index, link):
+        '''Remove the link at the given position from the indexes, in place'''
+        for value, component_index in ((link[ORIGIN], self._origin_index), (link[RELATIONSHIP], self._rel_index), (link[TARGET], self._target_index)):
+            posting = component_index[value]
+            del posting[index]
+            if not posting:
+                del component_index[value]
+        if self.attr_index:
+            for item in link[ATTRIBUTES].items():
+                try:
+                    posting = self._attr_postings[item]
+                except (KeyError, TypeError):
+                    continue
+                del posting[index]
+                if not posting:
+                    del self._attr_postings[item]
+        if self.sorted_indexes:
+            o, r, t = _sortkey(link[ORIGIN]), _sortkey(link[RELATIONSHIP]), _sortkey(link[TARGET])
+            for perm, entry in ((self._spo, (o, r, t, index)), (self._pos, (r, t, o, index)), (self._osp, (t, o, r, index))):
+                del perm[bisect.bisect_left(perm, entry)]
+        return
+
+    def compact(self):
+        '''
+        Drop the tombstones left by removed links, renumbering the rest. Iterators
+        already running carry on over the pre-compaction links & indices.
+        '''
+        self._writable()
+        if self._removed:
+            self._relationships = [r for r in self._relationships if r is not None]
+            self._removed = 0
+            self._reindex()
+        return
 
 
     def add_iri_prefix(self, prefix):
@@ -224,12 +646,14 @@ class connection(connection_base):
 
     def close(self):
         '''Set up a new table space for the first time'''
-        self._relationships = []
+        self.create_space()
         return
 
     def __getitem__(self, i):
          r = self._relationships[i]
-         return (r[0], r[1], r[2], r[3].copy())
+         if r is None:
+             raise IndexError('Relationship {0} has been removed'.format(i))
+         return (r[0], r[1], r[2], self._attr_cls(r[3])) if self._copy_attrs else r
 
     def __repr__(self):
         '''
@@ -247,16 +671,31 @@ class connection(connection_base):
 
         # rebuilding _relationships with sorted attributes
         rels = []
-        for v in sorted(self._relationships, key=rel_repr):
+        for v in sorted((link for index, link in self), key=rel_repr):
 
             # Mark type of target as a pseudo attribute. Doesn't mutate
             # original Versa statement
             if isinstance(v[2], I):
-                v[3]['@target-type'] = '@iri-ref'
+                attrs = self._attr_cls(v[3])
+                attrs['@target-type'] = '@iri-ref'
+                v = (v[0], v[1], v[2], attrs)
 
             rels.append(v)
 
         return json.dumps(rels, indent=4, cls=OrderedJsonEncoder)
 
+    def fingerprint(self):
+        '''
+        Return an order-independent fingerprint of the model's contents, as computed by
+        versa.util.fingerprint. The first call hashes every link; the result is then
+        kept up to date as links are added & removed
+        '''
+        if self._fingerprint is None:
+            self._fingerprint = util.fingerprint(self)
+        return self._fingerprint
+
     def __eq__(self, other):
+        # Fast path, rather than building & comparing the full canonical repr
+        if isinstance(other, connection):
+            return self.size() == other.size() and self.fingerprint() == other.fingerprint()
         return repr(other) == repr(self)
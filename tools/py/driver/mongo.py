@@ -7,6 +7,13 @@
 
 The optional attributes are metadata bound to the statement itself
 
+Each origin has a document {'origin': origin, 'rels': [{'rid': rel, 'instances': [[target, attrs]]}]}.
+Rels & IRI targets are stored dictionary encoded, as integer codes, and
+[code, tail] pairs respectively (see iridict), with the terms in the @_terms document.
+Each rel entry also has the index fields 'targets', the list of its targets, and, if any
+attributes are indexed (see ensure_indexes), 'attrs', the list of their values for each
+instance, since the [target, attrs] pairs themselves can't be indexed by either
+
 
 Example of use, assuming a DB named 'versademo' already exists with an empty collection named model1
 
@@ -38,20 +45,192 @@ import functools
 #from itertools import groupby
 #from operator import itemgetter
 
-from amara3 import iri #for absolutize & matches_uri_syntax
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 
 from versa.driver import connection_base
+from versa.driver.iridict import term_dictionary, expand_legacy, hashable
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
 
+#Origin of the document with the IRI dictionary's list of terms
+TERMS_ORIGIN = '@_terms'
+
+#Origin of the document recording that every rel entry has the index fields, with the
+#names of the indexed attributes
+INDEXES_ORIGIN = '@_indexes'
+
+#Origin of the IRI prefix abbreviation map of models from before the IRI
+#dictionary, which are upgraded when opened
+ABBREVIATIONS_ORIGIN = '@_abbreviations'
+
+#Default number of links add_many sends per bulk_write
+DEFAULT_BATCH_SIZE = 10000
+
+#For $slice, to fetch the rest of the list
+MAX_SLICE = 2 ** 31 - 1
+
+
+def _server_attrs(attrs):
+    '''
+    The attributes of a pattern which can be matched on the server, with plain names & string
+    values, since it compares other types differently from Python, e.g. True & 1
+    '''
+    return { k: v for k, v in (attrs or {}).items()
+                if isinstance(k, str) and k and '.' not in k and not k.startswith('$') and isinstance(v, str) }
+
+
+def _plan_stages(plan):
+    '''Iterate over the stages of a query plan, as from explain()'''
+    #Newer servers wrap the classic plan
+    plan = plan.get('queryPlan', plan)
+    yield plan
+    for child in ([plan['inputStage']] if 'inputStage' in plan else []) + plan.get('inputStages', []):
+        yield from _plan_stages(child)
+
+
+class document_layout(object):
+    '''
+    Encoding of links as origin documents, shared by connection & the asyncio
+    connection of mongo_async, so a collection can be used through either. Subclasses
+    set _terms, the in-process IRI dictionary, & _index_attrs, and do the I/O
+    '''
+    #Meta items, e.g. the IRI dictionary, so as not to be included in size()
+    META_ITEM_COUNT = 3
+    #Origins of the meta items
+    META_ORIGINS = (TERMS_ORIGIN, '@_count', INDEXES_ORIGIN)
+
+    def _link_pattern(self, rel=None, target=None):
+        '''
+        Return the rel code & the set of stored forms of the target(s) of a match pattern, each
+        None if unbound, or None if a rel isn't in the dictionary, so nothing can match.
+        The rel & target may each be a set of values, as for multimatch, in which case a set
+        of rel codes is returned
+        '''
+        terms = self._terms
+        if isinstance(rel, set):
+            stored_rel = { code for code in map(terms.encode_rel, rel) if code is not None }
+        else:
+            stored_rel = terms.encode_rel(rel) if rel else None
+        if rel and stored_rel in (None, set()):
+            return None
+        forms = None
+        if target:
+            forms = { hashable(form) for value in (target if isinstance(target, set) else [target])
+                                        for form in terms.target_forms(value) }
+        return stored_rel, forms
+
+    def _match_query(self, origin, stored_rel=None, forms=None, attrs=None):
+        '''
+        Return the query for the origin documents with links which might match a pattern, as
+        stored, and the aggregation pipeline which also projects just the rel entries & instances
+        which might match, or None if there's nothing to filter them by. String targets & attributes
+        (see _server_attrs) are matched on the server, anything else only by match itself,
+        which checks every link returned in any case
+
+        forms - stored forms of the target, as from _link_pattern
+        '''
+        if forms:
+            #As BSON arrays
+            forms = [ list(form) if isinstance(form, tuple) else form for form in forms ]
+        query = {'origin': origin} if origin is not None else {'origin': {'$nin': self.META_ORIGINS}}
+        attrs = _server_attrs(attrs)
+        indexed = self._index_attrs is not None
+        rel_query = {}
+        #Each instance is [target, attrs]
+        instance_query, instance_conds = {}, []
+        if forms:
+            if indexed:
+                rel_query['targets'] = {'$in': forms}
+            else:
+                instance_query['$or'] = [ {'0': form} for form in forms ]
+            instance_conds.append({'$in': [{'$arrayElemAt': ['$$i', 0]}, {'$literal': forms}]})
+        if attrs:
+            indexed_attrs = { k: v for k, v in attrs.items() if indexed and k in self._index_attrs }
+            if indexed_attrs:
+                rel_query['attrs'] = {'$elemMatch': indexed_attrs}
+            instance_query.update( (f'1.{k}', v) for k, v in attrs.items() if k not in indexed_attrs )
+            instance_conds.append({'$let': {
+                'vars': {'a': {'$arrayElemAt': ['$$i', 1]}},
+                'in': {'$and': [ {'$eq': [f'$$a.{k}', {'$literal': v}]} for k, v in attrs.items() ]}
+            }})
+        if stored_rel is not None:
+            rel_query['rid'] = stored_rel
+        if instance_query:
+            rel_query['instances'] = {'$elemMatch': instance_query}
+        if not rel_query:
+            return query, None
+        query['rels'] = {'$elemMatch': rel_query}
+
+        rels = '$rels'
+        if stored_rel is not None:
+            rels = {'$filter': {'input': rels, 'as': 'r', 'cond': {'$eq': ['$$r.rid', stored_rel]}}}
+        instances = '$$r.instances'
+        if instance_conds:
+            instances = {'$filter': {'input': instances, 'as': 'i', 'cond': {'$and': instance_conds}}}
+        projection = {'origin': 1, 'rels': {'$map': {'input': rels, 'as': 'r', 'in': {'rid': '$$r.rid', 'instances': instances}}}}
+        return query, [{'$match': query}, {'$project': projection}]
+
+    def _item_links(self, item, stored_rels=None, forms=None, attrs=None):
+        '''
+        Iterate over the links of an origin document as fetched, decoded, with None for each
+        which doesn't match a pattern, so that callers can still count them for statement IDs.
+        Only the links which match are decoded
+
+        stored_rels - (optional) set of rel codes, as from _link_pattern
+        forms - (optional) set of stored forms of the target(s), as from _link_pattern
+        '''
+        terms = self._terms
+        xorigin = item['origin']
+        for xrel_obj in item['rels']:
+            xrelid = xrel_obj['rid']
+            if stored_rels is not None and xrelid not in stored_rels:
+                continue
+            for xtarget, xattrs in xrel_obj['instances']:
+                if forms is not None and hashable(xtarget) not in forms:
+                    yield None
+                elif attrs and any( k not in xattrs or xattrs.get(k) != v for k, v in attrs.items() ):
+                    yield None
+                else:
+                    yield (xorigin, terms.decode_rel(xrelid), terms.decode_target(xtarget), xattrs)
+        return
+
+    def _group_links(self, links, add=None):
+        '''
+        Encode links with the IRI dictionary, grouped by origin then rel code, as
+        {origin: {rel: [[target, attrs]]}}
+
+        add - function to call with a missing term, as for term_dictionary.encode_rel
+        '''
+        nodes = {}
+        for origin, rel, target, attrs in links:
+            rel = self._terms.encode_rel(rel, add)
+            target = self._terms.encode_target(target, add)
+            nodes.setdefault(origin, {}).setdefault(rel, []).append([target, attrs])
+        return nodes
+
+    def _batch_requests(self, nodes, count):
+        '''Write requests for a bulk_write of grouped links, an upsert per origin & the count update'''
+        requests = [ UpdateOne({'origin': origin},
+                               {'$push': {'rels': {'$each': [ self._rel_entry(rel, instances)
+                                                                for rel, instances in node.items() ]}}},
+                               upsert=True)
+                        for origin, node in nodes.items() ]
+        #No upsert. Without a count document the next size() call recounts
+        requests.append(UpdateOne({'origin': '@_count'}, {'$inc': {'count': count}}))
+        return requests
+
+    def _rel_entry(self, rel, instances):
+        '''Rel entry of an origin document, with the index fields'''
+        rel_obj = {'rid': rel, 'instances': instances, 'targets': [ target for target, attrs in instances ]}
+        if self._index_attrs:
+            rel_obj['attrs'] = [ { k: attrs[k] for k in self._index_attrs if k in attrs } for target, attrs in instances ]
+        return rel_obj
+
+
 def newmodel(collection=None, baseiri=None):
     return connection(collection=collection, baseiri=baseiri)
 
-class connection(connection_base):
-    #Meta items, e.g. the abbreviations map, so as not to be included in size()
-    META_ITEM_COUNT = 1
-
+class connection(document_layout, connection_base):
     def __init__(self, collection=None, baseiri=None):
         '''
         Versa connection object built from MongoDB collection object
@@ -65,10 +244,12 @@ class connection(connection_base):
         #author_wd = lllists.author_wikidata  #Collection
         #item_authors = lllists.item_authors  #Collection
         
-        self._ensure_abbreviations()
+        self._terms = term_dictionary()
+        #Names of the indexed attributes, or None if not all rel entries have the index fields
+        self._index_attrs = None
+        self._ensure_terms()
         #self.create_model()
         self._baseiri = baseiri
-        self._abbr_index = 0
         return
 
     def copy(self, contents=True):
@@ -94,29 +275,28 @@ class connection(connection_base):
         raise NotImplementedError
 
     def size(self):
-        '''Return the number of links in the model'''
+        '''Return the number of links in the model, from the maintained count'''
+        count_obj = self._db_coll.find_one({'origin': '@_count'})
+        if count_obj is None:
+            #Model from before the count was kept
+            return self.recount()
+        return count_obj['count']
+
+    def recount(self):
+        '''
+        Count the links in the model by scanning all the origin documents, and
+        store the result as the count used by size(), e.g. to repair it
+        '''
         count = 0
-        cursor = self._db_coll.find()
+        cursor = self._db_coll.find({'origin': {'$nin': connection.META_ORIGINS}}, {'rels.instances': 1})
         for item in cursor:
-            if item['origin'] == '@_abbreviations':
-                continue
-            count += len(item['rels'])
+            for rel_obj in item['rels']:
+                count += len(rel_obj['instances'])
+        self._db_coll.replace_one({'origin': '@_count'}, {'origin': '@_count', 'count': count}, upsert=True)
         return count
-        #return  self._db_coll.count() - connection.META_ITEM_COUNT
 
     def __iter__(self):
-        abbrevs = self._abbreviations()
-        cursor = self._db_coll.find()
-        index = 0
-        for item in cursor:
-            if item['origin'] == '@_abbreviations':
-                continue
-            origin = item['origin']
-            for rel in item['rels']:
-                relid = rel['rid']
-                for target, attribs in rel['instances']:
-                    yield index, (origin, relid.format(**abbrevs), target.format(**abbrevs), attribs)
-                    index += 1
+        yield from self.match(include_ids=True)
 
     def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
@@ -127,46 +307,77 @@ class connection(connection_base):
         target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
         include_ids - If true include statement IDs with yield values
+
+        The rel, string targets & attributes are matched on the server, so only the origin
+        documents concerned, and only their rel entries & instances which match, are fetched.
+        Statement IDs then count just those
         '''
-        abbrevs = self._abbreviations()
+        self._refresh_terms()
+        pattern = self._link_pattern(rel, target)
+        if pattern is None:
+            #Not in the dictionary, so no such rel
+            return
+        stored_rel, forms = pattern
         index = 0
-        if origin is None:
-            cursor = self._db_coll.find()
-        else:
-            cursor = self._db_coll.find({'origin': origin})
-            
+        query, pipeline = self._match_query(origin, stored_rel, forms if isinstance(target, str) else None, attrs)
+        cursor = self._db_coll.find(query) if pipeline is None else self._db_coll.aggregate(pipeline)
+
         for item in cursor:
-            if item['origin'] == '@_abbreviations':
+            if item['origin'] in connection.META_ORIGINS:
                 continue
-            if origin != item['origin']:
-                continue
-            for xrel_obj in item['rels']:
-                xrelid = xrel_obj['rid'].format(**abbrevs)
-                if rel and rel != xrelid:
+            for link in self._item_links(item, None if stored_rel is None else {stored_rel}, forms, attrs):
+                index += 1
+                if link is None:
                     continue
-                for xtarget, xattrs in xrel_obj['instances']:
-                    index += 1
-                    xtarget = xtarget.format(**abbrevs)
-                    if target and target != xtarget:
-                        continue
-                    matches = True
-                    if attrs:
-                        for k, v in attrs.items():
-                            if k not in xattrs or xattrs.get(k) != v:
-                                matches = False
-                    if matches:
-                        if include_ids:
-                            yield index, (origin, xrelid, xtarget, xattrs)
-                        else:
-                            yield origin, xrelid, xtarget, xattrs
-
-                    #if matches:
-                    #    if include_ids:
-                    #        yield index, (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
-                    #    else:
-                    #        yield (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                if include_ids:
+                    yield index, link
+                else:
+                    yield link
         return
 
+    def count(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the number of links that match a pattern of components, as for match.
+        With just the origin bound, only that origin's rels are fetched. Patterns which
+        can be matched wholly on the server (see _match_query) are counted there, by
+        summing the sizes of the instance lists match would fetch. Only others, e.g. with
+        numeric targets, are counted by fetching the links
+        '''
+        if not (origin or rel or target or attrs):
+            return self.size()
+        if origin and not (rel or target or attrs):
+            item = self._db_coll.find_one({'origin': origin}, {'rels.instances': 1})
+            if item is None or origin in connection.META_ORIGINS:
+                return 0
+            return sum( len(rel_obj['instances']) for rel_obj in item['rels'] )
+        if (not target or isinstance(target, str)) and _server_attrs(attrs) == (attrs or {}):
+            self._refresh_terms()
+            pattern = self._link_pattern(rel, target)
+            if pattern is None:
+                return 0
+            stored_rel, forms = pattern
+            query, pipeline = self._match_query(origin, stored_rel, forms, attrs)
+            pipeline += [
+                {'$unwind': '$rels'},
+                {'$group': {'_id': None, 'n': {'$sum': {'$size': '$rels.instances'}}}},
+            ]
+            result = list(self._db_coll.aggregate(pipeline))
+            return result[0]['n'] if result else 0
+        return super().count(origin, rel, target, attrs)
+
+    def exists(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return True if any link matches a pattern of components, as for match.
+        With nothing bound or just the origin, use count_documents on the server
+        '''
+        if not (rel or target or attrs):
+            if origin in connection.META_ORIGINS:
+                return False
+            #Every origin document has at least one link, unlike the meta items
+            query = {'origin': origin} if origin else {'origin': {'$nin': connection.META_ORIGINS}}
+            return self._db_coll.count_documents(query, limit=1) > 0
+        return super().exists(origin, rel, target, attrs)
+
     def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
         Iterator over relationship IDs that match a pattern of components, with multiple options provided for each component
@@ -215,26 +426,10 @@ class connection(connection_base):
             raise ValueError('Relationship ID cannot be null')
 
         attrs = attrs or {}
-
-        origin_item = self._db_coll.find_one({'origin': origin})
-        rel = self._abbreviate(rel)
-        target = self._abbreviate(target)
-        rel_info = {'rid': rel, 'instances': [[target, attrs]]}
-        if origin_item is None:
-            self._db_coll.insert_one(
-                {
-                    'origin': origin,
-                    'rels': [rel_info],
-                }
-            )
-        else:
-            origin_item['rels'].append(rel_info)
-            self._db_coll.replace_one(
-                {'origin': origin}, origin_item
-            )
+        self._add_batch(self._db_coll, [(origin, rel, target, attrs)])
         return
 
-    def add_many(self, rels):
+    def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE, ordered=True, write_concern=None):
         '''
         Add a list of relationships to the extent
 
@@ -247,7 +442,17 @@ class connection(connection_base):
         rel - type IRI of the relationship (similar to an RDF predicate)
         target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+
+        batch_size - number of links to send per bulk_write. Within each batch the links are
+            grouped by origin, with one upsert per origin, which pushes all its new rel entries
+        ordered - passed on to bulk_write. If False the server may apply the upserts in any order,
+            and carries on past any which fail, in which case the count is off until recount().
+            Either way, earlier batches stay written
+        write_concern - (optional) pymongo.write_concern.WriteConcern for the writes, e.g.
+            WriteConcern(w=0) for fastest loading, unacknowledged. If omitted the collection's own
         '''
+        coll = self._db_coll if write_concern is None else self._db_coll.with_options(write_concern=write_concern)
+        batch = []
         for curr_rel in rels:
             attrs = {}
             if len(curr_rel) == 3:
@@ -256,9 +461,89 @@ class connection(connection_base):
                 origin, rel, target, attrs = curr_rel
             else:
                 raise ValueError
-            self.add(origin, rel, target, attrs)
+            if not origin:
+                raise ValueError('Relationship origin cannot be null')
+            if not rel:
+                raise ValueError('Relationship ID cannot be null')
+            batch.append((origin, rel, target, attrs or {}))
+            if len(batch) >= batch_size:
+                self._add_batch(coll, batch, ordered)
+                batch = []
+        if batch:
+            self._add_batch(coll, batch, ordered)
         return
 
+    def _add_batch(self, coll, links, ordered=True):
+        '''
+        Add links in one bulk_write, with an upsert per origin & the count update. Rels &
+        targets are encoded with the in-process IRI dictionary, so only new terms need
+        a round trip of their own
+        '''
+        nodes = self._group_links(links, self._add_term)
+        coll.bulk_write(self._batch_requests(nodes, len(links)), ordered=ordered)
+        return
+
+    def ensure_indexes(self, attrs=()):
+        '''
+        Create the indexes match uses, unique on origin, and multikey on the rel codes & on the
+        targets of the rel entries, plus one on each indexed attribute. If the model has origin
+        documents from before the index fields, or from before an attribute was indexed, they're
+        rewritten first, so run it while no other process is writing to the model, & reopen any
+        other connections afterward
+
+        attrs - (optional) names of attributes to index, in addition to any already indexed
+        Returns the names of the indexes
+        '''
+        for k in attrs:
+            if not _server_attrs({k: ''}):
+                raise ValueError(f'Attribute {k!r} cannot be indexed')
+        index_attrs = list(self._index_attrs or [])
+        index_attrs += [ k for k in attrs if k not in index_attrs ]
+        if index_attrs != self._index_attrs:
+            self._index_attrs = index_attrs
+            requests = []
+            for item in self._db_coll.find({'origin': {'$nin': connection.META_ORIGINS}}, {'rels': 1}):
+                rels = [ self._rel_entry(rel_obj['rid'], rel_obj['instances']) for rel_obj in item['rels'] ]
+                requests.append(UpdateOne({'_id': item['_id']}, {'$set': {'rels': rels}}))
+                if len(requests) >= DEFAULT_BATCH_SIZE:
+                    self._db_coll.bulk_write(requests)
+                    requests = []
+            if requests:
+                self._db_coll.bulk_write(requests)
+            self._db_coll.replace_one({'origin': INDEXES_ORIGIN}, {'origin': INDEXES_ORIGIN, 'attrs': index_attrs}, upsert=True)
+        indexes = [
+            self._db_coll.create_index('origin', unique=True),
+            self._db_coll.create_index('rels.rid'),
+            self._db_coll.create_index('rels.targets'),
+        ]
+        indexes.extend( self._db_coll.create_index(f'rels.attrs.{k}') for k in index_attrs )
+        return indexes
+
+    def explain(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Report how the server selects the origin documents for a match pattern, as a dict of:
+
+        query - the query, or None if the rel isn't in the model, so nothing is queried
+        indexes - names of the indexes used
+        covered - True if the query is served by indexes, without a collection scan
+        plan - the server's winning plan
+        '''
+        self._refresh_terms()
+        pattern = self._link_pattern(rel, target)
+        if pattern is None:
+            return {'query': None, 'indexes': [], 'covered': True, 'plan': None}
+        stored_rel, forms = pattern
+        forms = forms if isinstance(target, str) else None
+        query, pipeline = self._match_query(origin, stored_rel, forms, attrs)
+        plan = self._db_coll.find(query).explain()['queryPlanner']['winningPlan']
+        stages = list(_plan_stages(plan))
+        return {
+            'query': query,
+            'indexes': sorted({ stage['indexName'] for stage in stages if stage.get('stage') == 'IXSCAN' }),
+            'covered': not any( stage.get('stage') == 'COLLSCAN' for stage in stages ),
+            'plan': plan,
+        }
+
     #FIXME: Replace with a match_to_remove method
     def remove(self, index):
         '''
@@ -292,42 +577,55 @@ class connection(connection_base):
     def __eq__(self, other):
         return repr(other) == repr(self)
 
-    def _abbreviations(self):
-        abbrev_obj = self._db_coll.find_one({'origin': '@_abbreviations'})
-        return abbrev_obj['map']
-        
-    def _abbreviate(self, rid):
-        '''
-        Abbreviate a relationship or resource ID target for efficient storage
-        in the DB. Works only with a prefix/suffix split of hierarchical HTTP-like IRIs,
-        e.g. 'http://example.org/spam/eggs' becomes something like '{a23}eggs'
-        and afterward there will be an entry in the prefix map from 'a23' to 'http://example.org/spam/'
-        The map can then easily be used with str.format
-        '''
-        if not isinstance(rid, str) or not iri.matches_uri_syntax(rid): return rid
-        head, tail = rid.rsplit('/', 1)
-        head += '/'
-        abbrev_obj = self._db_coll.find_one({'origin': '@_abbreviations'})
-        assert abbrev_obj is not None
-        pmap = abbrev_obj['map']
-        #FIXME: probably called too often to do this every time
-        inv_pmap = {v: k for k, v in pmap.items()}
-        if head in inv_pmap:
-            prefix = inv_pmap[head]
-        else:
-            prefix = f'a{self._abbr_index}'
-            pmap[prefix] = head
-            self._abbr_index += 1
-            self._db_coll.replace_one(
-                {'origin': '@_abbreviations'},
-                {'origin': '@_abbreviations', 'map': pmap}
-            )
-        post_rid = '{' + prefix + '}' + tail
-        return post_rid
-        
-    def _ensure_abbreviations(self):
-        abbrev_obj = self._db_coll.find_one({'origin': '@_abbreviations'})
-        if abbrev_obj is None:
-            self._db_coll.insert_one({'origin': '@_abbreviations', 'map': {}})
+    def _refresh_terms(self):
+        '''Load any terms stored since the dictionary was last loaded, e.g. by another process'''
+        known = len(self._terms.terms)
+        terms_obj = self._db_coll.find_one({'origin': TERMS_ORIGIN}, {'terms': {'$slice': [known, MAX_SLICE]}})
+        if terms_obj is not None:
+            self._terms.extend(terms_obj['terms'])
+        return
+
+    def _add_term(self, term):
+        '''Add a new term to the IRI dictionary & store it, returning its code'''
+        self._refresh_terms()
+        if term not in self._terms.codes:
+            #Appended atomically, unless meanwhile added elsewhere, so codes are never reused
+            self._db_coll.update_one({'origin': TERMS_ORIGIN, 'terms': {'$ne': term}}, {'$push': {'terms': term}})
+            self._refresh_terms()
+        return self._terms.codes[term]
+
+    def _ensure_terms(self):
+        '''Load the IRI dictionary, starting one for a new model, or upgrading a model from before it'''
+        if self._db_coll.find_one({'origin': TERMS_ORIGIN}, {'_id': 1}) is None:
+            abbrev_obj = self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN})
+            self._db_coll.insert_one({'origin': TERMS_ORIGIN, 'terms': []})
+            if abbrev_obj is not None:
+                self._upgrade(abbrev_obj['map'])
+            else:
+                #New model, so start the count too
+                self._db_coll.insert_one({'origin': '@_count', 'count': 0})
+            #Either way every rel entry now has the index fields
+            self._db_coll.insert_one({'origin': INDEXES_ORIGIN, 'attrs': []})
+        self._refresh_terms()
+        indexes_obj = self._db_coll.find_one({'origin': INDEXES_ORIGIN})
+        if indexes_obj is not None:
+            self._index_attrs = indexes_obj['attrs']
+        return
+
+    def _upgrade(self, abbrevs):
+        '''
+        Rewrite the origin documents of a model from before the IRI dictionary, with
+        rels & IRI targets encoded, rather than abbreviated. Targets which were abbreviated
+        become I objects, being IRIs by their syntax. Braces weren't escaped by this driver
+        '''
+        terms = self._terms
+        cursor = self._db_coll.find({'origin': {'$nin': connection.META_ORIGINS + (ABBREVIATIONS_ORIGIN,)}})
+        for item in cursor:
+            item['rels'] = [ self._rel_entry(
+                                terms.encode_rel(str(expand_legacy(rel_obj['rid'], abbrevs, escaped=False)), self._add_term),
+                                [ [terms.encode_target(expand_legacy(target, abbrevs, escaped=False), self._add_term), attrs]
+                                    for target, attrs in rel_obj['instances'] ])
+                                for rel_obj in item['rels'] ]
+            self._db_coll.replace_one({'_id': item['_id']}, item)
+        self._db_coll.delete_one({'origin': ABBREVIATIONS_ORIGIN})
         return
-        
@@ -0,0 +1,239 @@
+#Asyncio MongoDB driver for Versa, a Web semi-structured metadata tool
+'''
+Variant of the MongoDB driver for asyncio programs, on a motor collection
+(pip install motor), so that reads & writes don't block the event loop.
+
+The documents, IRI dictionary & link count are as for versa.driver.mongo (see
+document_layout), so the same collection can be used through either driver, even at
+the same time. Models from before the IRI dictionary need opening once with
+versa.driver.mongo, which upgrades them.
+
+Example of use:
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from versa.driver import mongo_async
+
+async def ingest(links):
+    coll = AsyncIOMotorClient('mongodb://localhost').versademo.model1
+    model = await mongo_async.newmodel(collection=coll)
+    await model.add_many(links)
+    async for link in model.match(rel='http://example.org/voc/author'):
+        print(link)
+'''
+
+from versa.driver.iridict import term_dictionary
+from versa.driver.mongo import document_layout, TERMS_ORIGIN, INDEXES_ORIGIN, ABBREVIATIONS_ORIGIN, \
+    DEFAULT_BATCH_SIZE, MAX_SLICE
+
+
+async def newmodel(collection=None, baseiri=None):
+    '''
+    Return a connection to the model in a motor collection, loading its IRI dictionary,
+    & setting it up first if the collection is new
+    '''
+    model = connection(collection=collection, baseiri=baseiri)
+    await model._ensure_terms()
+    return model
+
+
+class connection(document_layout):
+    def __init__(self, collection=None, baseiri=None):
+        '''
+        Versa connection object built from motor collection object. Use newmodel,
+        which also loads the IRI dictionary
+        '''
+        if collection is None:
+            raise NotImplementedError('For now construct only from collection object')
+        self._db_coll = collection
+        self._terms = term_dictionary()
+        #Names of the indexed attributes, or None if not all rel entries have the index fields
+        self._index_attrs = None
+        self._baseiri = baseiri
+        return
+
+    async def size(self):
+        '''Return the number of links in the model, from the maintained count'''
+        count_obj = await self._db_coll.find_one({'origin': '@_count'})
+        if count_obj is None:
+            return await self.recount()
+        return count_obj['count']
+
+    async def recount(self):
+        '''
+        Count the links in the model by scanning all the origin documents, and
+        store the result as the count used by size(), e.g. to repair it
+        '''
+        count = 0
+        cursor = self._db_coll.find({'origin': {'$nin': self.META_ORIGINS}}, {'rels.instances': 1})
+        async for item in cursor:
+            for rel_obj in item['rels']:
+                count += len(rel_obj['instances'])
+        await self._db_coll.replace_one({'origin': '@_count'}, {'origin': '@_count', 'count': count}, upsert=True)
+        return count
+
+    async def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Asynchronous iterator over relationships that match a pattern of components, as for
+        versa.driver.mongo.connection.match, with the same statement IDs
+
+        origin - (optional) origin of the relationship (similar to an RDF subject). If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs with yield values
+        '''
+        await self._refresh_terms()
+        pattern = self._link_pattern(rel, target)
+        if pattern is None:
+            #Not in the dictionary, so no such rel
+            return
+        stored_rel, forms = pattern
+        query, pipeline = self._match_query(origin, stored_rel, forms if isinstance(target, str) else None, attrs)
+        cursor = self._db_coll.find(query) if pipeline is None else self._db_coll.aggregate(pipeline)
+        index = 0
+        async for item in cursor:
+            if item['origin'] in self.META_ORIGINS:
+                continue
+            for link in self._item_links(item, None if stored_rel is None else {stored_rel}, forms, attrs):
+                index += 1
+                if link is None:
+                    continue
+                if include_ids:
+                    yield index, link
+                else:
+                    yield link
+
+    async def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Asynchronous iterator over relationships that match a pattern of components, with multiple options provided for each component
+
+        origin - (optional) origin of the relationship (similar to an RDF subject), or set of values. If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate), or set of values. If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object, or set of values. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs with yield values, which count all the links of each rel fetched
+
+        Origins & rels are matched on the server, targets & attributes only here
+        '''
+        origin = origin if origin is None or isinstance(origin, set) else set([origin])
+        rel = rel if rel is None or isinstance(rel, set) else set([rel])
+        target = target if target is None or isinstance(target, set) else set([target])
+        await self._refresh_terms()
+        pattern = self._link_pattern(rel, target)
+        if pattern is None:
+            return
+        stored_rels, forms = pattern
+        query = {'origin': {'$in': list(origin)} if origin else {'$nin': self.META_ORIGINS}}
+        if stored_rels:
+            query['rels.rid'] = {'$in': list(stored_rels)}
+        index = 0
+        async for item in self._db_coll.find(query):
+            if item['origin'] in self.META_ORIGINS:
+                continue
+            for link in self._item_links(item, stored_rels or None, forms, attrs):
+                index += 1
+                if link is None:
+                    continue
+                if include_ids:
+                    yield index, link
+                else:
+                    yield link
+
+    async def add(self, origin, rel, target, attrs=None):
+        '''
+        Add one relationship to the model
+
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+        '''
+        if not origin:
+            raise ValueError('Relationship origin cannot be null')
+        if not rel:
+            raise ValueError('Relationship ID cannot be null')
+        await self._add_batch(self._db_coll, [(origin, rel, target, attrs or {})])
+        return
+
+    async def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE, ordered=True, write_concern=None):
+        '''
+        Add a list of relationships to the extent, as for versa.driver.mongo.connection.add_many
+
+        rels - a list of 0 or more relationship tuples, e.g.:
+        [
+            (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
+        ]
+
+        batch_size - number of links to send per bulk_write
+        ordered - passed on to bulk_write
+        write_concern - (optional) pymongo.write_concern.WriteConcern for the writes. If omitted the collection's own
+        '''
+        coll = self._db_coll if write_concern is None else self._db_coll.with_options(write_concern=write_concern)
+        batch = []
+        for curr_rel in rels:
+            attrs = {}
+            if len(curr_rel) == 3:
+                origin, rel, target = curr_rel
+            elif len(curr_rel) == 4:
+                origin, rel, target, attrs = curr_rel
+            else:
+                raise ValueError
+            if not origin:
+                raise ValueError('Relationship origin cannot be null')
+            if not rel:
+                raise ValueError('Relationship ID cannot be null')
+            batch.append((origin, rel, target, attrs or {}))
+            if len(batch) >= batch_size:
+                await self._add_batch(coll, batch, ordered)
+                batch = []
+        if batch:
+            await self._add_batch(coll, batch, ordered)
+        return
+
+    async def _add_batch(self, coll, links, ordered=True):
+        '''
+        Add links in one bulk_write, as for versa.driver.mongo. Any new terms are stored
+        first, since encoding can't wait on each one as it's met
+        '''
+        new_terms = []
+        def note(term):
+            new_terms.append(term)
+            #Placeholder code, since this first encoding is discarded
+            return -1
+        self._group_links(links, note)
+        for term in dict.fromkeys(new_terms):
+            await self._add_term(term)
+        nodes = self._group_links(links)
+        await coll.bulk_write(self._batch_requests(nodes, len(links)), ordered=ordered)
+        return
+
+    async def _refresh_terms(self):
+        '''Load any terms stored since the dictionary was last loaded, e.g. by another process'''
+        known = len(self._terms.terms)
+        terms_obj = await self._db_coll.find_one({'origin': TERMS_ORIGIN}, {'terms': {'$slice': [known, MAX_SLICE]}})
+        if terms_obj is not None:
+            self._terms.extend(terms_obj['terms'])
+        return
+
+    async def _add_term(self, term):
+        '''Add a new term to the IRI dictionary & store it, returning its code'''
+        await self._refresh_terms()
+        if term not in self._terms.codes:
+            #Appended atomically, unless meanwhile added elsewhere, so codes are never reused
+            await self._db_coll.update_one({'origin': TERMS_ORIGIN, 'terms': {'$ne': term}}, {'$push': {'terms': term}})
+            await self._refresh_terms()
+        return self._terms.codes[term]
+
+    async def _ensure_terms(self):
+        '''Load the IRI dictionary, starting one for a new model'''
+        if await self._db_coll.find_one({'origin': TERMS_ORIGIN}, {'_id': 1}) is None:
+            if await self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN}, {'_id': 1}) is not None:
+                raise ValueError('Model is from before the IRI dictionary. Open it once with versa.driver.mongo to upgrade it')
+            await self._db_coll.insert_one({'origin': TERMS_ORIGIN, 'terms': []})
+            await self._db_coll.insert_one({'origin': '@_count', 'count': 0})
+            await self._db_coll.insert_one({'origin': INDEXES_ORIGIN, 'attrs': []})
+        await self._refresh_terms()
+        indexes_obj = await self._db_coll.find_one({'origin': INDEXES_ORIGIN})
+        if indexes_obj is not None:
+            self._index_attrs = indexes_obj['attrs']
+        return
@@ -0,0 +1,59 @@
+'''
+Bounded LRU cache of decoded nodes for the key/value drivers (lmdb, diskcache)
+
+Keyed by origin, each entry is the node with abbreviations expanded, mapping
+rel to list of (target, attrs). Drivers invalidate an origin's entry when they
+write to it. Writes by other connections or processes aren't seen, so only
+enable the cache where the model isn't being changed elsewhere.
+
+>>> from versa.driver.nodecache import node_cache
+>>> c = node_cache(2)
+>>> c.put('http://example.org/spam', {'http://example.org/eggs': [('ham', {})]})
+>>> c.get('http://example.org/spam')
+{'http://example.org/eggs': [('ham', {})]}
+>>> c.info()
+{'hits': 1, 'misses': 0, 'size': 1, 'maxsize': 2}
+'''
+
+from collections import OrderedDict
+
+#Default number of nodes kept, when the cache is enabled
+DEFAULT_CACHE_SIZE = 1024
+
+
+class node_cache(object):
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._nodes = OrderedDict()
+
+    def get(self, origin):
+        '''Return the cached node for an origin, or None'''
+        node = self._nodes.get(origin)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._nodes.move_to_end(origin)
+        return node
+
+    def put(self, origin, node):
+        self._nodes[origin] = node
+        self._nodes.move_to_end(origin)
+        if len(self._nodes) > self.maxsize:
+            self._nodes.popitem(last=False)
+        return
+
+    def invalidate(self, origins=None):
+        '''Drop the entries for the given origins, or all of them'''
+        if origins is None:
+            self._nodes.clear()
+        else:
+            for origin in origins:
+                self._nodes.pop(origin, None)
+        return
+
+    def info(self):
+        '''Return the hit & miss counters, with the current & maximum size'''
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._nodes), 'maxsize': self.maxsize}
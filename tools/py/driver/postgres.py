@@ -76,39 +76,69 @@ class connection(connection_base):
         '''
         #FIXME: Implement include_ids
         cur = self._conn.cursor()
-        conditions = ""
-        and_placeholder = ""
         tables = "relationship"
+        conditions, params = self._conditions(origin, rel, target, attrs)
+        #querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM {0} WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
+        #SELECT relationship.rawid, attribute.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE relationship.origin = 'http://uche.ogbuji.net' AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@context' AND subattr.value = 'http://uche.ogbuji.net#_metadata') AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@lang' AND subattr.value = 'ig') ORDER BY relationship.rawid;
+        querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
+        #self._logger.debug(x.format(url))
+        self._logger.debug(cur.mogrify(querystr, params))
+        cur.execute(querystr, params)
+        #Use groupby to batch up the returning statements acording to rawid then rol up the attributes
+        #return ( (s, p, o, dict([(n,v) for n,v in xxx])) for s, p, o in yyy)
+        #cur.fetchone()
+        #cur.close()
+        return self._process_db_rows_iter(cur)
+
+    def _conditions(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the SQL condition for a pattern of components, as for match, and its parameters.
+        The condition is just TRUE if nothing is bound
+        '''
+        conditions = []
         params = []
         if origin:
-            conditions += "relationship.origin = %s"
+            conditions.append("relationship.origin = %s")
             params.append(origin)
-            and_placeholder = " AND "
         if target:
-            conditions += and_placeholder + "relationship.target = %s"
+            conditions.append("relationship.target = %s")
             params.append(target)
-            and_placeholder = " AND "
         if rel:
-            conditions += and_placeholder + "relationship.rel = %s"
+            conditions.append("relationship.rel = %s")
             params.append(rel)
-            and_placeholder = " AND "
         if attrs:
-            tables = "relationship, attribute"
             for a_name, a_val in attrs.items():
-                conditions += and_placeholder + "EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = %s AND subattr.value = %s)"
+                conditions.append("EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = %s AND subattr.value = %s)")
                 params.extend((a_name, a_val))
-                and_placeholder = " AND "
-        #querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM {0} WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
-        #SELECT relationship.rawid, attribute.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE relationship.origin = 'http://uche.ogbuji.net' AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@context' AND subattr.value = 'http://uche.ogbuji.net#_metadata') AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@lang' AND subattr.value = 'ig') ORDER BY relationship.rawid;
-        querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
-        #self._logger.debug(x.format(url))
+        return " AND ".join(conditions) or "TRUE", params
+
+    def count(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return the number of links that match a pattern of components, as for match, via SELECT COUNT
+        '''
+        cur = self._conn.cursor()
+        conditions, params = self._conditions(origin, rel, target, attrs)
+        querystr = "SELECT COUNT(*) FROM relationship WHERE {0};".format(conditions)
         self._logger.debug(cur.mogrify(querystr, params))
         cur.execute(querystr, params)
-        #Use groupby to batch up the returning statements acording to rawid then rol up the attributes
-        #return ( (s, p, o, dict([(n,v) for n,v in xxx])) for s, p, o in yyy)
-        #cur.fetchone()
-        #cur.close()
-        return self._process_db_rows_iter(cur)
+        result = cur.fetchone()
+        cur.close()
+        self._conn.rollback() #Finish with the transaction
+        return result[0]
+
+    def exists(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Return True if any link matches a pattern of components, as for match, via SELECT EXISTS
+        '''
+        cur = self._conn.cursor()
+        conditions, params = self._conditions(origin, rel, target, attrs)
+        querystr = "SELECT EXISTS (SELECT 1 FROM relationship WHERE {0});".format(conditions)
+        self._logger.debug(cur.mogrify(querystr, params))
+        cur.execute(querystr, params)
+        result = cur.fetchone()
+        cur.close()
+        self._conn.rollback() #Finish with the transaction
+        return result[0]
 
     def _process_db_rows_iter(self, cursor):
         '''
@@ -70,28 +70,8 @@ ORDER BY relationship.rawid;""".format(tables, conditions)
 
         '''
         cur = self._conn.cursor()
-        conditions = u""
-        and_placeholder = u""
         tables = u"relationship"
-        params = []
-        if subj:
-            conditions += u"relationship.subj = ?"
-            params.append(subj)
-            and_placeholder = u" AND "
-        if obj:
-            conditions += and_placeholder + u"relationship.obj = ?"
-            params.append(obj)
-            and_placeholder = u" AND "
-        if pred:
-            conditions += and_placeholder + u"relationship.pred = ?"
-            params.append(pred)
-            and_placeholder = u" AND "
-        if attrs:
-            tables = u"relationship, attribute"
-            for a_name, a_val in attrs.iteritems():
-                conditions += and_placeholder + u"EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = ? AND subattr.value = ?)"
-                params.extend((a_name, a_val))
-                and_placeholder = u" AND "
+        conditions, params = self._conditions(subj, pred, obj, attrs)
         #querystr = u"SELECT relationship.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value FROM {0} WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
         #SELECT relationship.rawid, attribute.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE relationship.subj = 'http://uche.ogbuji.net' AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@context' AND subattr.value = 'http://uche.ogbuji.net#_metadata') AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@lang' AND subattr.value = 'ig') ORDER BY relationship.rawid;
         #querystr = u"SELECT relationship.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
@@ -113,6 +93,54 @@ ORDER BY relationship.rawid;""".format(tables, conditions)
         #cur.close()
         return self._process_db_rows_iter(cur)
 
+    def _conditions(self, subj=None, pred=None, obj=None, attrs=None):
+        '''
+        Return the SQL condition for a pattern of components, as for match, and its parameters.
+        The condition is just 1 (true) if nothing is bound
+        '''
+        conditions = []
+        params = []
+        if subj:
+            conditions.append(u"relationship.subj = ?")
+            params.append(subj)
+        if obj:
+            conditions.append(u"relationship.obj = ?")
+            params.append(obj)
+        if pred:
+            conditions.append(u"relationship.pred = ?")
+            params.append(pred)
+        if attrs:
+            for a_name, a_val in attrs.items():
+                conditions.append(u"EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = ? AND subattr.value = ?)")
+                params.extend((a_name, a_val))
+        return u" AND ".join(conditions) or u"1", params
+
+    def count(self, subj=None, pred=None, obj=None, attrs=None):
+        '''
+        Return the number of relationships that match a pattern of components, as for match, via SELECT COUNT
+        '''
+        cur = self._conn.cursor()
+        conditions, params = self._conditions(subj, pred, obj, attrs)
+        querystr = u"SELECT COUNT(*) FROM relationship WHERE {0};".format(conditions)
+        self._logger.debug(repr((querystr, params)))
+        cur.execute(querystr, params)
+        result = cur.fetchone()
+        cur.close()
+        return result[0]
+
+    def exists(self, subj=None, pred=None, obj=None, attrs=None):
+        '''
+        Return True if any relationship matches a pattern of components, as for match, via SELECT EXISTS
+        '''
+        cur = self._conn.cursor()
+        conditions, params = self._conditions(subj, pred, obj, attrs)
+        querystr = u"SELECT EXISTS (SELECT 1 FROM relationship WHERE {0});".format(conditions)
+        self._logger.debug(repr((querystr, params)))
+        cur.execute(querystr, params)
+        result = cur.fetchone()
+        cur.close()
+        return bool(result[0])
+
     def _process_db_rows_iter(self, cursor):
         '''
         Turn the low-level rows from the result of a standard query join
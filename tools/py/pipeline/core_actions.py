@@ -218,10 +218,40 @@ def values(*rels):
     return _values
 
 
+def haslink(origin=None, rel=None, target=None, attributes=None, output=False):
+    '''
+    Action function generator to test whether any link matches a pattern,
+    e.g. for use as the test of ifexists. Omitted components match anything
+
+    :param origin: Origin of the links, or expression computing it
+    :param rel: Relationship of the links, or expression computing it
+    :param target: Target of the links, or expression computing it
+    :param attributes: Attributes of the links, or expression computing them
+    :param output: If True test the output model, otherwise the input model
+    :return: Versa action function to do the actual work
+    '''
+    def _haslink(ctx):
+        '''
+        Versa action function Utility to test for links matching a pattern
+
+        :param ctx: Versa context used in processing (e.g. includes the prototype link)
+        :return: True if any link in the model matches
+        '''
+        _origin = origin(ctx) if callable(origin) else origin
+        _rel = rel(ctx) if callable(rel) else rel
+        _target = target(ctx) if callable(target) else target
+        _attributes = attributes(ctx) if callable(attributes) else attributes
+        model = ctx.output_model if output else ctx.input_model
+        #Stops at the first match, rather than building a list of them
+        return model.exists(_origin, _rel, _target, _attributes)
+    return _haslink
+
+
 def ifexists(test, value, alt=None):
     '''
     Action function generator providing a limited if/then/else type primitive
-    :param test: Expression to be tested to determine the branch path
+    :param test: Expression to be tested to determine the branch path, e.g. haslink(...)
+    to branch on whether the model has certain links
     :param value: Expression providing the result if test is true
     :param alt: Expression providing the result if test is false
     :return: Action representing the actual work
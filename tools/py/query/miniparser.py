@@ -179,5 +179,6 @@ def p_expression_group(p):
 def p_error(p):
     print("Syntax error in input!")
 
-# Build the parser
-parser = yacc.yacc()
+# Build the parser. Tables aren't written out, since both parsers would share parsetab.py,
+# and processes importing them at once, e.g. parallel scans, race to write it
+parser = yacc.yacc(write_tables=False, debug=False)
@@ -9,8 +9,15 @@ Utilities to help deal with constructs expressed in Versa
 import re
 import sys
 import json
+import itertools
 from collections import OrderedDict
 
+#Install the C version if available, or fall back to the Python
+try:
+    import mmh3
+except ImportError:
+    from versa.contrib import pymmh3 as mmh3
+
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 from versa import init_localization
 init_localization()
@@ -21,13 +28,14 @@ def versa_list_to_pylist(m, vlistid):
 
 
 def simple_lookup(m, orig, rel):
-    links = list(m.match(orig, rel))
-    return links[0][TARGET] if links else None
+    #Just the first match, without building up the rest
+    link = next(iter(m.match(orig, rel)), None)
+    return link[TARGET] if link else None
 
 
 def simple_lookup_byvalue(m, rel, target):
-    links = list(m.match(None, rel, target))
-    return links[0][ORIGIN] if links else None
+    link = next(iter(m.match(None, rel, target)), None)
+    return link[ORIGIN] if link else None
 
 
 def lookup(m, orig, rel):
@@ -145,9 +153,10 @@ def replace_entity_resource(model, oldres, newres):
     for rid, link in model:
         if link[ORIGIN] == oldres or link[TARGET] == oldres or oldres in link[ATTRIBUTES].values():
             oldrids.add(rid)
+            o, r, t, a = link
             new_link = (newres if o == oldres else o, r, newres if t == oldres else t, dict((k, newres if v == oldres else v) for k, v in a.items()))
             model.add(*new_link)
-    model.delete(oldrids)
+    model.remove(oldrids)
     return
 
 
@@ -169,9 +178,34 @@ def duplicate_statements(model, oldorigin, neworigin, rfilter=None):
 def uniquify(model):
     '''
     Remove all duplicate relationships
+
+    Links are duplicates if their components & attributes compare equal, so e.g. targets
+    1, 1.0 & True are the same, as are an I & a string with the same characters.
+
+    If the model keeps sorted indexes (e.g. versa.driver.memory with sorted_indexes=True)
+    duplicates come out of match adjacent to each other, so only the current run of links
+    with the same origin, rel & target needs to be remembered. Except for links with
+    components other than strings, since values of different types which compare equal
+    aren't sorted together, so those are all remembered
     '''
-    seen = set()
     to_remove = set()
+    if getattr(model, 'sorted_indexes', False):
+        seen_other = set()
+        for _, group in itertools.groupby(model.match(include_ids=True), key=lambda item: item[1][:3]):
+            seen = set()
+            for ix, (o, r, t, a) in group:
+                hashable_attrs = tuple(sorted(a.items()))
+                if isinstance(o, str) and isinstance(r, str) and isinstance(t, str):
+                    curr_seen, key = seen, hashable_attrs
+                else:
+                    curr_seen, key = seen_other, (o, r, t) + hashable_attrs
+                if key in curr_seen:
+                    to_remove.add(ix)
+                curr_seen.add(key)
+        model.remove(to_remove)
+        return
+
+    seen = set()
     for ix, (o, r, t, a) in model:
         hashable_link = (o, r, t) + tuple(sorted(a.items()))
         #print(hashable_link)
@@ -183,6 +217,38 @@ def uniquify(model):
     return
 
 
+FINGERPRINT_MODULUS = 2**128
+
+def link_hash(link):
+    '''
+    Return the 128-bit MurmurHash3 of a link as an int, computed from a canonical
+    serialization, so it's the same across processes & platforms. As in a memory model's
+    canonical repr, targets which are IRI references differ from plain strings, and
+    attribute order makes no difference
+    '''
+    o, r, t, a = link
+    canonical = json.dumps([o, r, t, isinstance(t, I), sorted(a.items())], separators=(',', ':'), default=repr)
+    return mmh3.hash128(canonical)
+
+
+def fingerprint(model):
+    '''
+    Return an order-independent fingerprint of a model's contents, the sum of the
+    link_hash of all its links, modulo 2**128. Models with the same links (including
+    duplicates) have the same fingerprint regardless of order or driver, so models can
+    be compared, even in different processes, without serializing them
+
+    >>> from versa.driver import memory
+    >>> from versa.util import fingerprint
+    >>> m1, m2 = memory.connection(), memory.connection()
+    >>> m1.add_many([('spam', 'eggs', 'ham'), ('spam', 'eggs', 'jam')])
+    >>> m2.add_many([('spam', 'eggs', 'jam'), ('spam', 'eggs', 'ham')])
+    >>> fingerprint(m1) == fingerprint(m2)
+    True
+    '''
+    return sum(link_hash(link) for link in model.match()) % FINGERPRINT_MODULUS
+
+
 def jsonload(model, fp):
     '''
     Load Versa model dumped into JSON form, either raw or canonical